@@ -0,0 +1,149 @@
+# admission.py - BOUNDED CONCURRENCY AND LOAD SHEDDING FOR CHAT TURNS
+"""
+A chat turn holds a thread for seconds (LLM round trips, provider
+searches). Run inline in the async handler it stalls the whole worker;
+queued without bound it turns a burst into minutes of latency for
+everyone, with most answers arriving after their clients gave up.
+
+process_travel_turn therefore runs behind a gate:
+
+- at most CHAT_MAX_CONCURRENCY turns run at once, on their own executor;
+- at most CHAT_MAX_QUEUE wait behind them - more are shed at once with
+  503 + Retry-After (estimated from recent turn durations);
+- a turn that waited longer than CHAT_QUEUE_TIMEOUT_SEC is dropped before
+  it starts (503), its client has likely retried or left;
+- a turn still running after CHAT_DEADLINE_SEC is answered with 504. It
+  cannot be interrupted, so it keeps its slot until it finishes - the
+  gate never admits more work than it can actually run.
+
+The caller's context (usage.metering) travels with the turn.
+
+    response, tool_messages = await chat_gate.run(process_travel_turn, message, key, history)
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CHAT_MAX_CONCURRENCY = int(os.getenv("CHAT_MAX_CONCURRENCY", "16"))
+CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "16"))
+CHAT_QUEUE_TIMEOUT_SEC = float(os.getenv("CHAT_QUEUE_TIMEOUT_SEC", "5"))
+CHAT_DEADLINE_SEC = float(os.getenv("CHAT_DEADLINE_SEC", "60"))
+
+# Weight of the newest turn in the average duration behind Retry-After
+_EWMA_ALPHA = 0.2
+
+
+class QueueTimeout(Exception):
+    """A job waited longer than the gate's queue timeout"""
+
+
+class AdmissionGate:
+    """Bounded executor with a short waiting queue, queue timeout and per-request deadline"""
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int,
+                 queue_timeout_sec: float, deadline_sec: float):
+        self.name = name
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._queue_timeout = queue_timeout_sec
+        self._deadline = deadline_sec
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._admitted = 0      # queued + running
+        self._running = 0
+        self._avg_sec: Optional[float] = None
+        self._stats = Counter(completed=0, failed=0, shed=0, queue_timeouts=0, deadline_exceeded=0)
+
+    def _retry_after(self) -> int:
+        """Seconds until a slot is likely free: the queue ahead drained at the recent pace"""
+        with self._lock:
+            avg = self._avg_sec if self._avg_sec is not None else self._queue_timeout
+            waves = (self._admitted - self._running) / self._max_concurrency + 1
+        return max(1, math.ceil(avg * waves))
+
+    def _overloaded(self, detail: str, status_code: int = 503) -> HTTPException:
+        return HTTPException(status_code=status_code, detail=detail,
+                             headers={"Retry-After": str(self._retry_after())})
+
+    def _run_admitted(self, context: contextvars.Context, fn: Callable[..., T], args: tuple,
+                      enqueued_at: float) -> T:
+        # The slot is given back here, on the worker, whether or not anyone still waits for the turn
+        if time.monotonic() - enqueued_at > self._queue_timeout:
+            with self._lock:
+                self._admitted -= 1
+            raise QueueTimeout()
+        with self._lock:
+            self._running += 1
+        started = time.monotonic()
+        ok = False
+        try:
+            result = context.run(fn, *args)
+            ok = True
+            return result
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._running -= 1
+                self._admitted -= 1
+                self._stats["completed" if ok else "failed"] += 1
+                self._avg_sec = elapsed if self._avg_sec is None else \
+                    _EWMA_ALPHA * elapsed + (1 - _EWMA_ALPHA) * self._avg_sec
+
+    @staticmethod
+    def _retrieve(future: asyncio.Future):
+        # Outcome of a turn whose caller stopped waiting (deadline, disconnect): don't log it as lost
+        if not future.cancelled():
+            future.exception()
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """fn(*args) on the gate's executor; 503 when saturated or queued too long, 504 past the deadline"""
+        with self._lock:
+            if self._admitted >= self._max_concurrency + self._max_queue:
+                self._stats["shed"] += 1
+                shed = True
+            else:
+                self._admitted += 1
+                shed = False
+        if shed:
+            raise self._overloaded("Too many conversations in progress, retry shortly")
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self._run_admitted,
+                                      contextvars.copy_context(), fn, args, time.monotonic())
+        future.add_done_callback(self._retrieve)
+        try:
+            # shield: the turn keeps running (and its slot) when we stop waiting for it
+            return await asyncio.wait_for(asyncio.shield(future), self._deadline)
+        except QueueTimeout:
+            with self._lock:
+                self._stats["queue_timeouts"] += 1
+            raise self._overloaded("Conversation queue timed out, retry shortly")
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._stats["deadline_exceeded"] += 1
+            logger.warning(f"⏱️ {self.name} turn exceeded its {self._deadline:.0f}s deadline")
+            raise self._overloaded("The assistant took too long to answer, retry shortly", status_code=504)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters for /metrics"""
+        with self._lock:
+            return dict(self._stats, running=self._running, queued=self._admitted - self._running,
+                        max_concurrency=self._max_concurrency, max_queue=self._max_queue,
+                        avg_turn_ms=round(self._avg_sec * 1000) if self._avg_sec is not None else None)
+
+
+chat_gate = AdmissionGate("chat", CHAT_MAX_CONCURRENCY, CHAT_MAX_QUEUE, CHAT_QUEUE_TIMEOUT_SEC, CHAT_DEADLINE_SEC)
@@ -0,0 +1,212 @@
+# archive.py - COLD STORAGE FOR IDLE CONVERSATIONS
+"""
+Moves the messages of conversations idle for ARCHIVE_IDLE_DAYS out of the
+messages table into one compressed blob per conversation
+(conversation_archive, on the conversation's own shard).
+
+The blob is columnar - one JSON array per column (ids, roles, contents,
+metadata, timestamps) - so similar values sit together, then zstd
+compressed (zlib when the zstandard package is missing). The
+conversations row stays, so listings and ownership checks are unchanged.
+
+Reads rehydrate transparently: when get_conversation_history or the
+history endpoint finds no messages, rehydrate() restores the archived
+rows with their original ids (so cursors and cached histories stay
+valid) and the conversation is live again until it next goes idle.
+
+    python archive.py --days 30            # archive, report table sizes
+    python archive.py --days 30 --vacuum   # and give freed pages back to the OS
+"""
+
+import os
+import json
+import zlib
+import sqlite3
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from backend.storage import transaction, get_connection, dialect, shard_indexes, all_databases
+except ImportError:
+    from storage import transaction, get_connection, dialect, shard_indexes, all_databases
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_IDLE_DAYS = int(os.getenv("ARCHIVE_IDLE_DAYS", "30"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "200"))              # conversations per transaction
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC", "zstd" if zstandard else "zlib")
+ARCHIVE_ZSTD_LEVEL = int(os.getenv("ARCHIVE_ZSTD_LEVEL", "9"))
+
+_COLUMNS = ("id", "role", "content", "metadata", "timestamp")
+
+_IDLE_CONVERSATIONS = '''
+    SELECT conversation_id FROM messages
+    GROUP BY conversation_id
+    HAVING MAX(timestamp) < ?
+'''
+
+
+def _compress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("ARCHIVE_CODEC=zstd needs the zstandard package")
+        return zstandard.ZstdCompressor(level=ARCHIVE_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(payload: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archived conversation is zstd compressed; install zstandard")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return zlib.decompress(payload)
+
+
+def encode_messages(rows: List[tuple], codec: str = ARCHIVE_CODEC) -> Tuple[bytes, int]:
+    """(id, role, content, metadata, timestamp) rows -> compressed columnar blob and its raw size"""
+    raw = json.dumps({name: [row[i] for row in rows] for i, name in enumerate(_COLUMNS)},
+                     separators=(",", ":")).encode()
+    return _compress(raw, codec), len(raw)
+
+
+def decode_messages(payload: bytes, codec: str) -> List[tuple]:
+    """Inverse of encode_messages"""
+    columns = json.loads(_decompress(bytes(payload), codec))
+    return list(zip(*(columns[name] for name in _COLUMNS)))
+
+
+def restore_messages(conn, conversation_id: str) -> int:
+    """Move an archived conversation back into messages (inside the caller's transaction)"""
+    archived = conn.execute('''
+        DELETE FROM conversation_archive WHERE conversation_id = ?
+        RETURNING codec, payload
+    ''', (conversation_id,)).fetchone()
+    if archived is None:
+        return 0
+    rows = decode_messages(archived[1], archived[0])
+    conn.executemany('''
+        INSERT INTO messages (id, conversation_id, role, content, metadata, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(row[0], conversation_id) + tuple(row[1:]) for row in rows])
+    return len(rows)
+
+
+def rehydrate(conversation_id: str) -> bool:
+    """Restore an archived conversation's messages; False when it was not archived"""
+    archived = get_connection(shard=conversation_id).execute(
+        "SELECT 1 FROM conversation_archive WHERE conversation_id = ?", (conversation_id,)
+    ).fetchone()
+    if archived is None:
+        return False
+    with transaction(immediate=True, shard=conversation_id) as conn:
+        restored = restore_messages(conn, conversation_id)
+    if restored:
+        logger.info(f"🧊 Rehydrated {restored} archived messages of conversation {conversation_id}")
+    return True
+
+
+def _archive_conversation(conn, conversation_id: str, cutoff: str) -> Optional[Tuple[int, int, int]]:
+    """Archive one conversation if still idle; (messages, raw bytes, compressed bytes)"""
+    restore_messages(conn, conversation_id)   # written to after an earlier archive: merge
+    rows = conn.execute('''
+        SELECT id, role, content, metadata, timestamp FROM messages
+        WHERE conversation_id = ?
+        ORDER BY timestamp ASC, id ASC
+    ''', (conversation_id,)).fetchall()
+    if not rows or max(row[4] for row in rows) >= cutoff:
+        return None  # Became active again since the candidates were listed
+    payload, raw_bytes = encode_messages(rows)
+    conn.execute('''
+        INSERT INTO conversation_archive
+            (conversation_id, codec, message_count, raw_bytes, payload, last_message_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (conversation_id, ARCHIVE_CODEC, len(rows), raw_bytes, payload, rows[-1][4]))
+    conn.execute("DELETE FROM messages WHERE conversation_id = ? AND id <= ?",
+                 (conversation_id, max(row[0] for row in rows)))
+    return len(rows), raw_bytes, len(payload)
+
+
+def _database_table_sizes(conn) -> Dict[str, int]:
+    if dialect() == "postgres":
+        return {name: size for name, size in conn.execute(
+            "SELECT relname, pg_total_relation_size(relid) FROM pg_stat_user_tables")}
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+    try:
+        sizes = {name: size for name, size in conn.execute('''
+            SELECT s.tbl_name, SUM(d.pgsize) FROM dbstat d
+            JOIN sqlite_schema s ON s.name = d.name
+            GROUP BY s.tbl_name
+        ''')}
+    except sqlite3.OperationalError:
+        # SQLite built without the dbstat table: whole file only
+        sizes = {"(database)": conn.execute("PRAGMA page_count").fetchone()[0] * page_size - free}
+    sizes["(free pages)"] = free
+    return sizes
+
+
+def table_sizes() -> Dict[str, int]:
+    """Bytes per table (indexes included), summed over every database file"""
+    totals: Dict[str, int] = {}
+    for database in all_databases():
+        for name, size in _database_table_sizes(get_connection(database)).items():
+            totals[name] = totals.get(name, 0) + size
+    return dict(sorted(totals.items()))
+
+
+def run_archive(idle_days: int = ARCHIVE_IDLE_DAYS, batch: int = ARCHIVE_BATCH,
+                vacuum: bool = False) -> Dict:
+    """Archive every conversation idle for idle_days; returns counts and table sizes before/after"""
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=idle_days)).strftime("%Y-%m-%d %H:%M:%S")
+    report = {"cutoff": cutoff, "codec": ARCHIVE_CODEC, "conversations": 0, "messages": 0,
+              "raw_bytes": 0, "compressed_bytes": 0, "tables_before": table_sizes()}
+
+    for shard in shard_indexes():
+        candidates = [row[0] for row in get_connection(shard).execute(_IDLE_CONVERSATIONS, (cutoff,))]
+        for start in range(0, len(candidates), batch):
+            with transaction(immediate=True, shard=shard) as conn:
+                for conversation_id in candidates[start:start + batch]:
+                    archived = _archive_conversation(conn, conversation_id, cutoff)
+                    if archived:
+                        report["conversations"] += 1
+                        report["messages"] += archived[0]
+                        report["raw_bytes"] += archived[1]
+                        report["compressed_bytes"] += archived[2]
+
+    if vacuum and dialect() == "sqlite":
+        for shard in shard_indexes():
+            get_connection(shard).execute("VACUUM")
+    report["tables_after"] = table_sizes()
+    logger.info(f"🧊 Archived {report['conversations']} conversations ({report['messages']} messages, "
+                f"{report['raw_bytes']} -> {report['compressed_bytes']} bytes)")
+    return report
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Archive idle conversations into compressed blobs")
+    parser.add_argument("--days", type=int, default=ARCHIVE_IDLE_DAYS, help="Idle days before archiving")
+    parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH, help="Conversations per transaction")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM afterwards (SQLite)")
+    args = parser.parse_args()
+
+    try:
+        from backend.migrations import migrate
+    except ImportError:
+        from migrations import migrate
+    migrate()
+    result = run_archive(args.days, args.batch, args.vacuum)
+    ratio = result["compressed_bytes"] / result["raw_bytes"] if result["raw_bytes"] else 0
+    print(f"🧊 {result['conversations']} conversations / {result['messages']} messages archived "
+          f"before {result['cutoff']} ({result['codec']}, {ratio:.0%} of raw size)")
+    print(f"   {'table':<28} {'before':>12} {'after':>12}")
+    for table in sorted(set(result["tables_before"]) | set(result["tables_after"])):
+        print(f"   {table:<28} {result['tables_before'].get(table, 0):>12} "
+              f"{result['tables_after'].get(table, 0):>12}")
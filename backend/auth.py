@@ -4,27 +4,72 @@ Handles user registration, login, session management, and learning from user int
 """
 
 import uuid
-import sqlite3
+import math
+import time
+import logging
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 import json
-import hashlib
 
 from fastapi import HTTPException, Request, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from passlib.context import CryptContext
 from jose import JWTError, jwt
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from pydantic import BaseModel, EmailStr
-import secrets
+from redis.exceptions import RedisError
+
+try:
+    from backend.storage import transaction, get_connection, after_commit
+    from backend.migrations import migrate
+    from backend.write_behind import write_behind
+    from backend.profile_aggregator import profile_aggregator
+    from backend.cache import TTLCache
+    from backend.password_hashing import hash_password, verify_password as verify_password_hash
+    from backend.sessions import sessions
+except ImportError:
+    from storage import transaction, get_connection, after_commit
+    from migrations import migrate
+    from write_behind import write_behind
+    from profile_aggregator import profile_aggregator
+    from cache import TTLCache
+    from password_hashing import hash_password, verify_password as verify_password_hash
+    from sessions import sessions
+
+logger = logging.getLogger(__name__)
 
 # Configuration  
 import os
 SECRET_KEY = os.getenv("SECRET_KEY", "travel-chatbot-secret-key-for-jwt-tokens-2024")  # Use consistent key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30 * 24 * 60  # 30 days
+# Anonymous sessions record activity at most this often (retention.py purges inactive ones)
+SESSION_TOUCH_INTERVAL_SEC = int(os.getenv("SESSION_TOUCH_INTERVAL_SEC", "900"))
+
+# Guests carry a signed, stateless id (cookie, or header for non-browser
+# clients): reading it is a signature check. Their users / user_sessions
+# rows are created by the first write of a request that brought a previously
+# issued id back (ensure_anonymous_user).
+ANON_COOKIE_NAME = os.getenv("ANON_COOKIE_NAME", "anon_id")
+ANON_HEADER_NAME = "X-Anonymous-Id"
+ANON_ID_MAX_AGE_DAYS = int(os.getenv("ANON_ID_MAX_AGE_DAYS", "365"))
+ANON_COOKIE_SECURE = os.getenv("ANON_COOKIE_SECURE", "false").lower() == "true"
+
+# Authenticated requests: verified tokens and active users are cached, so the
+# steady state costs a dict lookup and no SQL. Deactivation invalidates the
+# user in every worker (main attaches the RedisInvalidator); with Redis down
+# another worker notices within AUTH_CACHE_TTL.
+AUTH_CACHE_MAX_ITEMS = int(os.getenv("AUTH_CACHE_MAX_ITEMS", "10000"))
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))
+
+# JWT -> (user_id, exp, sid): a signature check never goes stale; expiry and session are re-checked
+token_cache = TTLCache("verified_tokens", max_items=AUTH_CACHE_MAX_ITEMS, ttl=AUTH_CACHE_TTL)
+# user_id -> UserResponse of an active user
+user_cache = TTLCache("auth_users", max_items=AUTH_CACHE_MAX_ITEMS, ttl=AUTH_CACHE_TTL)
+
+_anonymous_signer = URLSafeTimedSerializer(SECRET_KEY, salt="anonymous-identity")
+# Guests whose rows exist and whose activity was recorded within SESSION_TOUCH_INTERVAL_SEC
+persisted_guests = TTLCache("persisted_guests", max_items=AUTH_CACHE_MAX_ITEMS, ttl=SESSION_TOUCH_INTERVAL_SEC)
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer(auto_error=False)
 
 class UserCreate(BaseModel):
@@ -54,102 +99,16 @@ class OnboardingData(BaseModel):
     frequent_destinations: list[str] = []
 
 def init_auth_tables():
-    """Initialize authentication and user tracking tables"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    # Add authentication columns to users table (handle existing columns)
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN password_hash TEXT;')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN is_demo_user BOOLEAN DEFAULT FALSE;')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN last_login TIMESTAMP;')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    try:
-        cursor.execute('ALTER TABLE users ADD COLUMN is_active BOOLEAN DEFAULT TRUE;')
-    except sqlite3.OperationalError:
-        pass  # Column already exists
-    
-    # Sessions table for tracking user sessions
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            session_token TEXT UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            ip_address TEXT,
-            user_agent TEXT,
-            is_active BOOLEAN DEFAULT TRUE,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # User interactions table for learning
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_interactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            interaction_type TEXT,
-            interaction_data TEXT,
-            context TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            session_id TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # User learning data
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_learning_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            data_type TEXT,
-            data_key TEXT,
-            data_value TEXT,
-            confidence_score REAL DEFAULT 0.5,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Analytics table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_analytics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            event_type TEXT,
-            event_data TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            session_id TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Mark existing users as demo users
-    cursor.execute('''
-        UPDATE users SET is_demo_user = TRUE WHERE password_hash IS NULL;
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Initialize authentication and user tracking tables (schema lives in migrations.py)"""
+    migrate()
 
 def get_password_hash(password: str) -> str:
-    """Hash a password for storing"""
-    return pwd_context.hash(password)
+    """Hash a password for storing (blocking - async callers use password_hashing.run_hashing)"""
+    return hash_password(password)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+    return verify_password_hash(plain_password, hashed_password)[0]
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
@@ -163,36 +122,38 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def create_user(user_data: UserCreate) -> UserResponse:
-    """Create a new user account"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
+def create_user(user_data: UserCreate, password_hash: Optional[str] = None) -> UserResponse:
+    """Create a new user account (pass password_hash when it was computed off the event loop)"""
+    # Hash before taking the write lock - bcrypt is deliberately slow
+    if password_hash is None:
+        password_hash = get_password_hash(user_data.password)
     
     try:
-        # Check if user already exists
-        cursor.execute("SELECT id FROM users WHERE email = ?", (user_data.email,))
-        if cursor.fetchone():
-            raise HTTPException(status_code=400, detail="Email already registered")
-        
-        # Create new user
-        user_id = str(uuid.uuid4())
-        password_hash = get_password_hash(user_data.password)
-        
-        cursor.execute('''
-            INSERT INTO users (id, first_name, last_name, email, nationality, password_hash, is_demo_user)
-            VALUES (?, ?, ?, ?, ?, ?, FALSE)
-        ''', (user_id, user_data.first_name, user_data.last_name, user_data.email, 
-              user_data.nationality, password_hash))
-        
-        conn.commit()
-        
-        # Get created user
-        cursor.execute('''
-            SELECT id, email, first_name, last_name, nationality, created_at, is_demo_user
-            FROM users WHERE id = ?
-        ''', (user_id,))
+        with transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            
+            # Check if user already exists
+            cursor.execute("SELECT id FROM users WHERE email = ?", (user_data.email,))
+            if cursor.fetchone():
+                raise HTTPException(status_code=400, detail="Email already registered")
+            
+            # Create new user
+            user_id = str(uuid.uuid4())
+            
+            cursor.execute('''
+                INSERT INTO users (id, first_name, last_name, email, nationality, password_hash, is_demo_user)
+                VALUES (?, ?, ?, ?, ?, ?, FALSE)
+            ''', (user_id, user_data.first_name, user_data.last_name, user_data.email, 
+                  user_data.nationality, password_hash))
+            
+            # Get created user
+            cursor.execute('''
+                SELECT id, email, first_name, last_name, nationality, created_at, is_demo_user
+                FROM users WHERE id = ?
+            ''', (user_id,))
+            
+            user_row = cursor.fetchone()
         
-        user_row = cursor.fetchone()
         if user_row:
             return UserResponse(
                 id=user_row[0],
@@ -205,251 +166,204 @@ def create_user(user_data: UserCreate) -> UserResponse:
             )
         
     except Exception as e:
-        conn.rollback()
         raise HTTPException(status_code=400, detail=str(e))
-    finally:
-        conn.close()
+
+def get_login_row(email: str) -> Optional[tuple]:
+    """(id, email, first_name, last_name, nationality, password_hash, created_at, is_demo_user) of an active user"""
+    return get_connection().execute('''
+        SELECT id, email, first_name, last_name, nationality, password_hash, created_at, is_demo_user
+        FROM users WHERE email = ? AND is_active = TRUE
+    ''', (email,)).fetchone()
+
+def record_login(user_row: tuple, new_password_hash: Optional[str] = None) -> UserResponse:
+    """Stamp last_login (and store the re-hashed password when the bcrypt cost changed)"""
+    with transaction(immediate=True) as conn:
+        if new_password_hash:
+            conn.execute('''
+                UPDATE users SET last_login = CURRENT_TIMESTAMP, password_hash = ? WHERE id = ?
+            ''', (new_password_hash, user_row[0]))
+        else:
+            conn.execute('''
+                UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (user_row[0],))
+    
+    return UserResponse(
+        id=user_row[0],
+        email=user_row[1],
+        first_name=user_row[2],
+        last_name=user_row[3],
+        nationality=user_row[4],
+        created_at=user_row[6],
+        is_demo_user=user_row[7]
+    )
 
 def authenticate_user(email: str, password: str) -> Optional[UserResponse]:
-    """Authenticate user with email and password"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
+    """Authenticate user with email and password (blocking; /auth/login runs the steps separately)"""
+    user_row = get_login_row(email)
+    if not user_row or not user_row[5]:
+        return None
     
-    try:
-        cursor.execute('''
-            SELECT id, email, first_name, last_name, nationality, password_hash, created_at, is_demo_user
-            FROM users WHERE email = ? AND is_active = TRUE
-        ''', (email,))
-        
-        user_row = cursor.fetchone()
-        if not user_row:
-            return None
-        
-        # Verify password
-        if not verify_password(password, user_row[5]):
-            return None
-        
-        # Update last login
-        cursor.execute('''
-            UPDATE users SET last_login = CURRENT_TIMESTAMP WHERE id = ?
-        ''', (user_row[0],))
-        conn.commit()
-        
-        return UserResponse(
-            id=user_row[0],
-            email=user_row[1],
-            first_name=user_row[2],
-            last_name=user_row[3],
-            nationality=user_row[4],
-            created_at=user_row[6],
-            is_demo_user=user_row[7]
-        )
-        
-    finally:
-        conn.close()
+    # Verify password
+    valid, new_hash = verify_password_hash(password, user_row[5])
+    if not valid:
+        return None
+    return record_login(user_row, new_hash)
 
-def get_current_user_from_token(token: str) -> Optional[UserResponse]:
-    """Get current user from JWT token"""
-    print(f"DEBUG: Validating token: {token[:50]}...")
+def verify_token(token: str) -> Optional[Tuple[str, Optional[str]]]:
+    """(user_id, session id) of a valid, unexpired JWT (signature checked once per token)"""
+    cached = token_cache.get(token)
+    if cached is not None:
+        if cached[1] > time.time():
+            return cached[0], cached[2]
+        token_cache.discard(token)
+        return None
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print(f"DEBUG: Token decoded successfully: {payload}")
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            print("DEBUG: No 'sub' field in token payload")
-            return None
-        print(f"DEBUG: Extracted user_id: {user_id}")
     except JWTError as e:
-        print(f"DEBUG: JWT decode error: {e}")
+        logger.debug("JWT rejected: %s", e)
+        return None
+    user_id = payload.get("sub")
+    if user_id is None:
+        logger.debug("JWT without a 'sub' claim")
+        return None
+    # No sid: issued before sessions moved to Redis, or while it was down
+    token_cache.set(token, (user_id, payload.get("exp") or math.inf, payload.get("sid")))
+    return user_id, payload.get("sid")
+
+def cached_user_from_token(token: str) -> Optional[UserResponse]:
+    """The user of an already verified token from memory alone; None means ask get_current_user_from_token"""
+    cached = token_cache.get(token)
+    if cached is None or cached[1] <= time.time():
+        return None
+    if cached[2] and not sessions.cached(cached[2], cached[0]):
         return None
+    return user_cache.get(cached[0])
+
+def get_current_user_from_token(token: str) -> Optional[UserResponse]:
+    """Get current user from JWT token"""
+    claims = verify_token(token)
+    if claims is None:
+        return None
+    user_id, session_id = claims
+    if session_id and not sessions.check(session_id, user_id):
+        logger.debug("Session %s revoked or expired", session_id)
+        return None
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
     
     # Get user from database
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
+    stamp = user_cache.stamp(user_id)
+    user_row = get_connection().execute('''
+        SELECT id, email, first_name, last_name, nationality, created_at, is_demo_user
+        FROM users WHERE id = ? AND is_active = TRUE
+    ''', (user_id,)).fetchone()
+    
+    if not user_row:
+        logger.debug("No active user %s", user_id)
+        return None
     
+    user = UserResponse(
+        id=user_row[0],
+        email=user_row[1],
+        first_name=user_row[2],
+        last_name=user_row[3],
+        nationality=user_row[4],
+        created_at=user_row[5],
+        is_demo_user=user_row[6]
+    )
+    # Skipped when the user was deactivated while we were reading
+    user_cache.set(user_id, user, if_stamp=stamp)
+    return user
+
+def deactivate_user(user_id: str):
+    """Deactivate an account and its sessions; its tokens stop working in every worker"""
+    with transaction(immediate=True) as conn:
+        conn.execute("UPDATE users SET is_active = FALSE WHERE id = ?", (user_id,))
+        conn.execute("UPDATE user_sessions SET is_active = FALSE WHERE user_id = ?", (user_id,))
+        after_commit(user_cache.invalidate, user_id)
     try:
-        cursor.execute('''
-            SELECT id, email, first_name, last_name, nationality, created_at, is_demo_user
-            FROM users WHERE id = ? AND is_active = TRUE
-        ''', (user_id,))
-        
-        user_row = cursor.fetchone()
-        if user_row:
-            print(f"DEBUG: User found in database: {user_row[1]}")
-            return UserResponse(
-                id=user_row[0],
-                email=user_row[1],
-                first_name=user_row[2],
-                last_name=user_row[3],
-                nationality=user_row[4],
-                created_at=user_row[5],
-                is_demo_user=user_row[6]
-            )
-        else:
-            print(f"DEBUG: No user found for ID: {user_id}")
-            return None
-    finally:
-        conn.close()
-    
-    return None
+        sessions.revoke_all(user_id)
+    except RedisError as e:
+        logger.warning(f"Could not revoke sessions of deactivated user {user_id}: {e}")
 
-def create_session(user_id: str, request: Request) -> str:
-    """Create a new user session"""
-    session_id = str(uuid.uuid4())
-    session_token = secrets.token_urlsafe(32)
-    
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    # Get client info
-    ip_address = request.client.host if request.client else "unknown"
-    user_agent = request.headers.get("user-agent", "unknown")
-    
-    cursor.execute('''
-        INSERT INTO user_sessions (id, user_id, session_token, ip_address, user_agent)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, user_id, session_token, ip_address, user_agent))
-    
-    conn.commit()
-    conn.close()
-    
-    return session_token
-
-def get_or_create_anonymous_user(request: Request) -> str:
-    """Get or create anonymous user based on session/fingerprint"""
-    # Create fingerprint from IP + User Agent
-    ip_address = request.client.host if request.client else "unknown"
-    user_agent = request.headers.get("user-agent", "unknown")
-    fingerprint = hashlib.md5(f"{ip_address}:{user_agent}".encode()).hexdigest()
-    
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
+def create_session(user_id: str, request: Request) -> Optional[str]:
+    """Start a login session (sessions.py, in Redis); its id goes into the JWT. None while Redis is down"""
+    return sessions.create(
+        user_id,
+        request.client.host if request.client else "unknown",
+        request.headers.get("user-agent", "unknown"),
+    )
+
+def issue_anonymous_id() -> tuple:
+    """A new guest: (user_id, signed value for the cookie / header)"""
+    user_id = str(uuid.uuid4())
+    return user_id, _anonymous_signer.dumps(user_id)
+
+def read_anonymous_id(signed: Optional[str]) -> Optional[str]:
+    """user_id of a signed guest id; None when missing, tampered with or older than ANON_ID_MAX_AGE_DAYS"""
+    if not signed:
+        return None
     try:
-        # Look for existing anonymous user with this fingerprint
-        cursor.execute('''
-            SELECT user_id FROM user_sessions 
-            WHERE session_token = ? AND is_active = TRUE
-        ''', (fingerprint,))
-        
-        result = cursor.fetchone()
-        if result:
-            return result[0]
-        
-        # Create new anonymous user
-        user_id = str(uuid.uuid4())
-        cursor.execute('''
-            INSERT INTO users (id, first_name, last_name, email, is_demo_user, is_active)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, f"Anonymous", f"User", f"anon_{user_id[:8]}@temp.com", False, True))
-        
-        # Create session with fingerprint as token
-        session_id = str(uuid.uuid4())
-        cursor.execute('''
-            INSERT INTO user_sessions (id, user_id, session_token, ip_address, user_agent)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (session_id, user_id, fingerprint, ip_address, user_agent))
-        
-        conn.commit()
-        return user_id
-        
-    finally:
-        conn.close()
+        return _anonymous_signer.loads(signed, max_age=ANON_ID_MAX_AGE_DAYS * 86400)
+    except BadSignature:
+        return None
+
+def set_anonymous_id(response: Response, signed: str):
+    """Hand a newly issued guest id to the client"""
+    response.set_cookie(ANON_COOKIE_NAME, signed, max_age=ANON_ID_MAX_AGE_DAYS * 86400,
+                        httponly=True, samesite="lax", secure=ANON_COOKIE_SECURE)
+    response.headers[ANON_HEADER_NAME] = signed
+
+def ensure_anonymous_user(user_id: str, request: Request):
+    """
+    Create a guest's users and user_sessions rows before the first write of
+    a request carrying an id issued earlier; later calls record activity
+    for retention.py.
+    Callers skip it while persisted_guests holds the id.
+    """
+    exists = get_connection().execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone()
+    if exists:
+        write_behind.submit('''
+            UPDATE user_sessions SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ? AND is_active = TRUE
+        ''', (user_id,))
+    else:
+        with transaction(immediate=True) as conn:
+            # ON CONFLICT: a concurrent request of the same guest got here first
+            created = conn.execute('''
+                INSERT INTO users (id, first_name, last_name, email, is_demo_user, is_active)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO NOTHING
+            ''', (user_id, "Anonymous", "User", f"anon_{user_id[:8]}@temp.com", False, True)).rowcount
+            if created:
+                conn.execute('''
+                    INSERT INTO user_sessions (id, user_id, session_token, ip_address, user_agent)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (str(uuid.uuid4()), user_id, f"anon:{user_id}",
+                      request.client.host if request.client else "unknown",
+                      request.headers.get("user-agent", "unknown")))
+    persisted_guests.set(user_id, True)
 
 def log_user_interaction(user_id: str, interaction_type: str, interaction_data: Dict[str, Any], 
                         context: str = "", session_id: str = ""):
-    """Log user interaction for learning purposes"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    """Log user interaction for learning purposes (queued, written in batches)"""
+    write_behind.submit('''
         INSERT INTO user_interactions (user_id, interaction_type, interaction_data, context, session_id)
         VALUES (?, ?, ?, ?, ?)
     ''', (user_id, interaction_type, json.dumps(interaction_data), context, session_id))
-    
-    conn.commit()
-    conn.close()
+    profile_aggregator.record_interaction(user_id, interaction_type)
 
 def log_analytics_event(user_id: str, event_type: str, event_data: Dict[str, Any], session_id: str = ""):
-    """Log analytics event"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    """Log analytics event (queued, written in batches)"""
+    write_behind.submit('''
         INSERT INTO user_analytics (user_id, event_type, event_data, session_id)
         VALUES (?, ?, ?, ?)
     ''', (user_id, event_type, json.dumps(event_data), session_id))
-    
-    conn.commit()
-    conn.close()
 
 def learn_from_user_behavior(user_id: str, behavior_data: Dict[str, Any]):
-    """Learn and update user preferences from behavior"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    for data_key, data_value in behavior_data.items():
-        # Check if learning data exists
-        cursor.execute('''
-            SELECT id, confidence_score FROM user_learning_data 
-            WHERE user_id = ? AND data_key = ?
-        ''', (user_id, data_key))
-        
-        existing = cursor.fetchone()
-        
-        if existing:
-            # Update confidence and value
-            new_confidence = min(existing[1] + 0.1, 1.0)  # Increase confidence
-            cursor.execute('''
-                UPDATE user_learning_data 
-                SET data_value = ?, confidence_score = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (str(data_value), new_confidence, existing[0]))
-        else:
-            # Create new learning entry
-            cursor.execute('''
-                INSERT INTO user_learning_data (user_id, data_type, data_key, data_value)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, "behavior", data_key, str(data_value)))
-    
-    conn.commit()
-    conn.close()
+    """Learn and update user preferences from behavior (aggregated in memory, upserted in batches)"""
+    profile_aggregator.record_behavior(user_id, behavior_data)
 
 def get_user_learning_profile(user_id: str) -> Dict[str, Any]:
     """Get learned user profile for personalization"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    # Get learning data
-    cursor.execute('''
-        SELECT data_key, data_value, confidence_score 
-        FROM user_learning_data 
-        WHERE user_id = ?
-        ORDER BY confidence_score DESC
-    ''', (user_id,))
-    
-    learning_data = {}
-    for row in cursor.fetchall():
-        learning_data[row[0]] = {
-            "value": row[1],
-            "confidence": row[2]
-        }
-    
-    # Get interaction patterns
-    cursor.execute('''
-        SELECT interaction_type, COUNT(*) as count
-        FROM user_interactions 
-        WHERE user_id = ?
-        GROUP BY interaction_type
-        ORDER BY count DESC
-    ''', (user_id,))
-    
-    interaction_patterns = dict(cursor.fetchall())
-    
-    conn.close()
-    
-    return {
-        "learned_preferences": learning_data,
-        "interaction_patterns": interaction_patterns,
-        "user_id": user_id
-    } 
\ No newline at end of file
+    return profile_aggregator.get_profile(user_id)
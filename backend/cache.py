@@ -0,0 +1,230 @@
+# cache.py - BOUNDED IN-PROCESS CACHES WITH CROSS-WORKER INVALIDATION
+"""
+TTLCache is an LRU map bounded by item count and approximate bytes, with a
+per-entry time to live and hit/miss/eviction counters for /metrics.
+
+Each worker process has its own caches. A RedisInvalidator shares
+invalidations between them: invalidate() drops the local entry and
+publishes the key, and every other worker drops theirs. While the Redis
+subscription is down, `invalidator.connected` is False and callers must
+validate cached entries themselves (see get_conversation_history).
+
+    history = TTLCache("conversation_history", max_items=2000, ttl=900, sizeof=...)
+    RedisInvalidator(rds).attach(history)
+"""
+
+import os
+import sys
+import time
+import uuid
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "cache:invalidate")
+
+_registry: Dict[str, "TTLCache"] = {}
+
+
+class TTLCache:
+    """Thread-safe LRU cache with TTL, item and byte bounds"""
+
+    def __init__(self, name: str, max_items: int = 1024, max_bytes: int = 0, ttl: float = 300.0,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.name = name
+        self.max_items = max_items
+        self.max_bytes = max_bytes          # 0 = no byte bound
+        self.ttl = ttl
+        self._sizeof = sizeof or sys.getsizeof
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Any, list]" = OrderedDict()    # key -> [value, expires_at, size]
+        self._bytes = 0
+        self._invalidator: Optional["RedisInvalidator"] = None
+        # Write stamps: lets a reader skip caching a value a concurrent write made stale
+        self._stamps: "OrderedDict[Any, int]" = OrderedDict()
+        self._clock = itertools.count(1)
+        self._stats = {"hits": 0, "misses": 0, "sets": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+        _registry[name] = self
+
+    @property
+    def distributed(self) -> bool:
+        """True while invalidations from other workers are being received"""
+        return self._invalidator is not None and self._invalidator.connected
+
+    def get(self, key: Any) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[1] < time.monotonic():
+                self._drop(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def stamp(self, key: Any) -> int:
+        """Take before loading a value; pass to set(if_stamp=) to drop it if the key was written since"""
+        with self._lock:
+            return self._stamps.get(key, 0)
+
+    def set(self, key: Any, value: Any, if_stamp: Optional[int] = None) -> bool:
+        size = self._sizeof(value)
+        with self._lock:
+            if if_stamp is not None and self._stamps.get(key, 0) != if_stamp:
+                return False
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = [value, time.monotonic() + self.ttl, size]
+            self._bytes += size
+            self._stats["sets"] += 1
+            self._evict()
+            return True
+
+    def update(self, key: Any, fn: Callable[[Any], Optional[Any]]) -> bool:
+        """Replace a cached value with fn(value) in place; fn returning None drops the entry"""
+        with self._lock:
+            self._touch(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            value = fn(entry[0])
+            if value is None:
+                self._drop(key)
+                return False
+            size = self._sizeof(value)
+            self._bytes += size - entry[2]
+            entry[0], entry[1], entry[2] = value, time.monotonic() + self.ttl, size
+            self._entries.move_to_end(key)
+            self._evict()
+            return True
+
+    def invalidate(self, key: Any, publish: bool = True) -> None:
+        """Drop a key here and, when publish is set, in every other worker"""
+        self.discard(key)
+        if publish:
+            self.invalidate_peers(key)
+
+    def invalidate_peers(self, key: Any) -> None:
+        """Drop a key in every other worker only (this one already holds the new value)"""
+        if self._invalidator is not None:
+            self._invalidator.publish(self.name, key)
+
+    def discard(self, key: Any) -> None:
+        with self._lock:
+            self._touch(key)
+            if key in self._entries:
+                self._drop(key)
+                self._stats["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _touch(self, key: Any):
+        # Caller holds the lock
+        self._stamps[key] = next(self._clock)
+        self._stamps.move_to_end(key)
+        while len(self._stamps) > max(1024, 2 * self.max_items):
+            self._stamps.popitem(last=False)
+
+    def _drop(self, key: Any):
+        # Caller holds the lock
+        self._bytes -= self._entries.pop(key)[2]
+
+    def _evict(self):
+        # Caller holds the lock; least recently used first
+        while self._entries and (len(self._entries) > self.max_items
+                                 or (self.max_bytes and self._bytes > self.max_bytes)):
+            self._drop(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats,
+                        items=len(self._entries),
+                        bytes=self._bytes,
+                        hit_rate=round(self._stats["hits"] / lookups, 4) if lookups else None,
+                        distributed=self.distributed)
+
+
+class RedisInvalidator:
+    """Fan cache invalidations out to other workers over Redis pub/sub"""
+
+    def __init__(self, client, channel: str = CACHE_INVALIDATION_CHANNEL, retry_seconds: float = 5.0):
+        self._client = client
+        self._channel = channel
+        self._retry = retry_seconds
+        self._origin = uuid.uuid4().hex[:12]
+        self._caches: Dict[str, TTLCache] = {}
+        self._thread = None
+        self.connected = False
+
+    def attach(self, cache: TTLCache) -> "RedisInvalidator":
+        cache._invalidator = self
+        self._caches[cache.name] = cache
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._listen, name="cache-invalidator", daemon=True)
+            self._thread.start()
+        return self
+
+    def publish(self, name: str, key: Any) -> None:
+        if not self.connected:
+            return
+        try:
+            self._client.publish(self._channel, f"{self._origin}|{name}|{key}")
+        except Exception as e:
+            logger.warning(f"Cache invalidation publish failed: {e}")
+
+    def _listen(self):
+        warned = False
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                # Invalidations sent while we were not subscribed are lost
+                for cache in self._caches.values():
+                    cache.clear()
+                self.connected = True
+                warned = False
+                logger.info(f"🧹 Cache invalidation subscribed to {self._channel}")
+                for message in pubsub.listen():
+                    self._handle(message.get("data"))
+            except Exception as e:
+                if not warned:
+                    logger.warning(f"Cache invalidation unavailable ({e}); validating cached entries locally")
+                    warned = True
+            finally:
+                self.connected = False
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(self._retry)
+
+    def _handle(self, data: Any):
+        if isinstance(data, bytes):
+            data = data.decode()
+        if not isinstance(data, str):
+            return
+        origin, _, rest = data.partition("|")
+        name, _, key = rest.partition("|")
+        cache = self._caches.get(name)
+        if origin != self._origin and cache is not None:
+            cache.discard(key)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Counters of every cache in this process (for /metrics)"""
+    return {name: cache.stats() for name, cache in _registry.items()}
@@ -0,0 +1,319 @@
+# cassette.py - RECORD/REPLAY OF OUTBOUND HTTP AND LLM CALLS
+"""
+Capture real sessions once, replay them offline.
+
+Covers every `requests` call (Amadeus, RapidAPI) and every OpenAI chat
+completion (`openai_client.chat.completions.create` and ChatOpenAI, which
+goes through the same SDK method). Calls are stored as gzip'd JSON lines
+keyed by a normalized request hash.
+
+    CASSETTE_MODE=record CASSETTE_PATH=session.cassette.gz uvicorn main:app
+    CASSETTE_MODE=replay CASSETTE_PATH=session.cassette.gz CASSETTE_LATENCY=zero uvicorn main:app
+
+or in code:
+
+    with Cassette("session.cassette.gz", mode="replay", latency="zero"):
+        process_travel_request(...)
+
+    python cassette.py info session.cassette.gz
+    python cassette.py profile session.cassette.gz "Find flights from NYC to Lisbon"
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import atexit
+import hashlib
+import logging
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+from openai.resources.chat.completions import Completions
+from openai.types.chat import ChatCompletion
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()          # "", record, replay
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "session.cassette.gz")
+CASSETTE_LATENCY = os.getenv("CASSETTE_LATENCY", "recorded")     # recorded, zero
+
+# Request fields that change between otherwise identical sessions
+_REDACTED_FIELDS = {"client_id", "client_secret", "access_token", "x-rapidapi-key", "authorization"}
+_TEXT_NORMALIZERS = [
+    (re.compile(r"(today's date is )\d{4}-\d{2}-\d{2}", re.IGNORECASE), r"\1<today>"),
+    (re.compile(r"\b(FL|HT)[A-Z0-9]{6}\b"), r"\1<ref>"),
+]
+# OpenAI kwargs that do not affect the completion
+_IGNORED_LLM_KWARGS = {"extra_headers", "extra_query", "extra_body", "timeout", "stream_options", "user"}
+
+
+class CassetteMiss(RuntimeError):
+    """Replay found no recorded call for a request"""
+
+
+def _normalize_text(text: str) -> str:
+    for pattern, replacement in _TEXT_NORMALIZERS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def _normalize(value: Any) -> Any:
+    """Drop secrets and volatile text so equivalent requests hash the same"""
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in sorted(value.items())
+                if k.lower() not in _REDACTED_FIELDS and v is not None}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        return _normalize_text(value)
+    return value
+
+
+def _hash(payload: Any) -> str:
+    raw = json.dumps(payload, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+
+def _is_given(value: Any) -> bool:
+    # openai uses a NotGiven sentinel for omitted kwargs
+    return value is not None and type(value).__name__ != "NotGiven"
+
+
+class _Entry:
+    __slots__ = ("key", "route", "kind", "response", "ms", "used")
+
+    def __init__(self, key: str, route: str, kind: str, response: Any, ms: float):
+        self.key, self.route, self.kind, self.response, self.ms = key, route, kind, response, ms
+        self.used = False
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"k": self.key, "r": self.route, "t": self.kind, "ms": round(self.ms, 1), "res": self.response}
+
+
+class Cassette:
+    """Patch outbound calls to record into or replay from one cassette file"""
+
+    def __init__(self, path: str, mode: str = "replay", latency: str = "recorded", reuse: bool = True):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.reuse = reuse
+        self._lock = threading.Lock()
+        self._entries: List[_Entry] = []
+        self._by_key: Dict[str, deque] = {}
+        self._by_route: Dict[str, deque] = {}
+        self._last_by_key: Dict[str, _Entry] = {}
+        self._originals: Dict[str, Any] = {}
+        self.stats = {"recorded": 0, "replayed": 0, "fallback": 0, "reused": 0, "misses": 0}
+        if mode == "replay":
+            self._load()
+
+    # ── persistence ─────────────────────────────────────────
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                raw = json.loads(line)
+                entry = _Entry(raw["k"], raw["r"], raw["t"], raw["res"], raw.get("ms", 0.0))
+                self._entries.append(entry)
+                self._by_key.setdefault(entry.key, deque()).append(entry)
+                self._by_route.setdefault(entry.route, deque()).append(entry)
+        logger.info(f"📼 Loaded {len(self._entries)} calls from {self.path}")
+
+    def save(self):
+        if self.mode != "record":
+            return
+        with self._lock:
+            entries = list(self._entries)
+        with gzip.open(self.path, "wt", encoding="utf-8", compresslevel=9) as f:
+            for entry in entries:
+                f.write(json.dumps(entry.to_json(), separators=(",", ":")) + "\n")
+        logger.info(f"📼 Saved {len(entries)} calls to {self.path}")
+
+    # ── matching ────────────────────────────────────────────
+
+    def _record(self, key: str, route: str, kind: str, response: Any, ms: float):
+        with self._lock:
+            self._entries.append(_Entry(key, route, kind, response, ms))
+            self.stats["recorded"] += 1
+
+    def _take(self, key: str, route: str) -> _Entry:
+        """Exact key first, then the next unused call on the same route, then reuse"""
+        with self._lock:
+            for index, stat in ((self._by_key.get(key), "replayed"), (self._by_route.get(route), "fallback")):
+                while index:
+                    entry = index.popleft()
+                    if not entry.used:
+                        entry.used = True
+                        self._last_by_key[key] = entry
+                        self.stats[stat] += 1
+                        return entry
+            if self.reuse:
+                entry = self._last_by_key.get(key)
+                if entry is None:
+                    entry = next((e for e in reversed(self._entries) if e.key == key), None)
+                if entry is not None:
+                    self.stats["reused"] += 1
+                    return entry
+            self.stats["misses"] += 1
+        raise CassetteMiss(f"No recorded call for {route} (key {key}) in {self.path}")
+
+    def _sleep(self, entry: _Entry):
+        if self.latency == "recorded" and entry.ms:
+            time.sleep(entry.ms / 1000.0)
+
+    # ── patched call sites ──────────────────────────────────
+
+    def _http_request(self, session, method, url, params=None, data=None, headers=None, json=None, **kwargs):
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        if isinstance(params, dict):
+            query.update({k: v for k, v in params.items() if v is not None})
+        route = f"{method.upper()} {parts.netloc}{parts.path}"
+        key = _hash([route, _normalize({k: str(v) for k, v in query.items()}),
+                     _normalize(data if isinstance(data, (dict, list)) else str(data or "")),
+                     _normalize(json)])
+
+        if self.mode == "replay":
+            entry = self._take(key, route)
+            self._sleep(entry)
+            response = requests.Response()
+            response.status_code = entry.response["status"]
+            response.reason = entry.response.get("reason", "")
+            response.headers.update(entry.response.get("headers", {}))
+            response._content = entry.response["body"].encode("utf-8")
+            response.encoding = "utf-8"
+            response.url = url
+            return response
+
+        start = time.perf_counter()
+        response = self._originals["requests"](session, method, url, params=params, data=data,
+                                               headers=headers, json=json, **kwargs)
+        self._record(key, route, "http", {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "body": response.text,
+        }, (time.perf_counter() - start) * 1000)
+        return response
+
+    def _chat_completion(self, completions, *args, **kwargs):
+        request = {k: v for k, v in kwargs.items() if _is_given(v) and k not in _IGNORED_LLM_KWARGS}
+        route = f"openai.chat.completions {request.get('model', '')}"
+        key = _hash([route, _normalize(request)])
+
+        if self.mode == "replay":
+            if request.get("stream"):
+                raise CassetteMiss("Streaming completions are not supported by the cassette")
+            entry = self._take(key, route)
+            self._sleep(entry)
+            return ChatCompletion.model_validate(entry.response)
+
+        start = time.perf_counter()
+        response = self._originals["openai"](completions, *args, **kwargs)
+        if isinstance(response, ChatCompletion):
+            self._record(key, route, "llm", response.model_dump(mode="json", exclude_none=True),
+                         (time.perf_counter() - start) * 1000)
+        return response
+
+    # ── install / uninstall ─────────────────────────────────
+
+    def install(self) -> "Cassette":
+        if self._originals:
+            return self
+        cassette = self
+        self._originals["requests"] = requests.sessions.Session.request
+        self._originals["openai"] = Completions.create
+
+        def patched_request(session, method, url, *args, **kwargs):
+            return cassette._http_request(session, method, url, *args, **kwargs)
+
+        def patched_create(completions, *args, **kwargs):
+            return cassette._chat_completion(completions, *args, **kwargs)
+
+        requests.sessions.Session.request = patched_request
+        Completions.create = patched_create
+        logger.info(f"📼 Cassette {self.mode} active: {self.path} (latency={self.latency})")
+        return self
+
+    def uninstall(self):
+        if not self._originals:
+            return
+        requests.sessions.Session.request = self._originals.pop("requests")
+        Completions.create = self._originals.pop("openai")
+        self.save()
+
+    def __enter__(self) -> "Cassette":
+        return self.install()
+
+    def __exit__(self, *exc):
+        self.uninstall()
+
+
+_active: Optional[Cassette] = None
+
+
+def install_from_env() -> Optional[Cassette]:
+    """Activate a cassette when CASSETTE_MODE is set; no-op otherwise"""
+    global _active
+    if not CASSETTE_MODE or _active is not None:
+        return _active
+    _active = Cassette(CASSETTE_PATH, mode=CASSETTE_MODE, latency=CASSETTE_LATENCY).install()
+    if CASSETTE_MODE == "record":
+        atexit.register(_active.save)
+    return _active
+
+
+def _print_info(path: str):
+    cassette = Cassette(path, mode="replay")
+    routes: Dict[str, List[float]] = {}
+    for entry in cassette._entries:
+        routes.setdefault(entry.route, []).append(entry.ms)
+    print(f"📼 {path}: {len(cassette._entries)} calls, {os.path.getsize(path)} bytes")
+    for route, latencies in sorted(routes.items()):
+        print(f"   {route:<70} {len(latencies):>5} calls  {sum(latencies) / len(latencies):>8.1f} ms avg")
+
+
+def _profile(path: str, message: str, repeat: int):
+    """Run the workflow against a cassette with zero latency under cProfile"""
+    import cProfile
+    import pstats
+    from workflow import process_travel_request
+
+    api_key = os.getenv("OPENAI_API_KEY", "sk-cassette")
+    with Cassette(path, mode="replay", latency="zero") as cassette:
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        for _ in range(repeat):
+            process_travel_request(message, api_key, [])
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+    print(f"⏱️  {repeat} runs in {elapsed:.3f}s ({elapsed / repeat * 1000:.1f} ms/run), cassette stats {cassette.stats}")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect cassettes or profile the workflow offline")
+    sub = parser.add_subparsers(dest="command", required=True)
+    info = sub.add_parser("info")
+    info.add_argument("path")
+    prof = sub.add_parser("profile")
+    prof.add_argument("path")
+    prof.add_argument("message")
+    prof.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "info":
+        _print_info(args.path)
+    else:
+        _profile(args.path, args.message, args.repeat)
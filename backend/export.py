@@ -0,0 +1,239 @@
+# export.py - STREAMING NDJSON / COLUMNAR EXPORT OF RAW TABLES
+"""
+Streams user_analytics, user_interactions, bookings and messages out of
+the database without ever holding a table (or a long transaction) in
+memory.
+
+Rows are read in keyset batches (WHERE id > last_id ORDER BY id LIMIT n),
+each batch its own short query - the equivalent of a server-side cursor
+that neither pins a WAL snapshot on SQLite nor a pooled connection on
+PostgreSQL for the length of the download - and are encoded as they
+arrive, so memory stays at one batch whatever the table size. messages
+are read shard by shard.
+
+Formats:
+    ndjson     one JSON object per row
+    columnar   one JSON object per batch: {"columns": [...], "data": {column: [values...]}}
+    parquet    CLI only, needs pyarrow: one row group per batch
+
+JSON text columns (event_data, booking_data, ...) are spliced in as-is.
+
+    GET /export/messages?since=2025-01-01&until=2025-02-01&format=ndjson
+        (header X-Export-Token: $EXPORT_API_TOKEN; disabled when unset)
+    python export.py user_analytics --since 2025-01-01 --out analytics.ndjson
+"""
+
+import os
+import sys
+import hmac
+import json
+import argparse
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    from backend.storage import get_connection, run_db, shard_indexes
+    from backend.pagination import RawJSON
+except ImportError:
+    from storage import get_connection, run_db, shard_indexes
+    from pagination import RawJSON
+
+EXPORT_BATCH_ROWS = int(os.getenv("EXPORT_BATCH_ROWS", "1000"))
+EXPORT_API_TOKEN = os.getenv("EXPORT_API_TOKEN", "")
+
+# table -> (time column filtered by since/until, exported columns (id first), JSON text columns)
+EXPORT_TABLES: Dict[str, Tuple[str, Tuple[str, ...], frozenset]] = {
+    "user_analytics": ("timestamp",
+                       ("id", "user_id", "event_type", "event_data", "session_id", "timestamp"),
+                       frozenset({"event_data"})),
+    "user_interactions": ("timestamp",
+                          ("id", "user_id", "interaction_type", "interaction_data", "context",
+                           "session_id", "timestamp"),
+                          frozenset({"interaction_data"})),
+    "bookings": ("created_at",
+                 ("id", "booking_reference", "user_id", "booking_type", "booking_data", "status",
+                  "created_at", "updated_at"),
+                 frozenset({"booking_data"})),
+    "messages": ("timestamp",
+                 ("id", "conversation_id", "role", "content", "metadata", "timestamp"),
+                 frozenset({"metadata"})),
+}
+# Tables living on the conversation shards
+SHARDED_TABLES = frozenset({"messages"})
+
+FORMATS = {"ndjson": "application/x-ndjson", "columnar": "application/x-ndjson"}
+
+
+def parse_time(value: Optional[str]) -> Optional[str]:
+    """ISO date or datetime -> stored timestamp text; ValueError when malformed"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def fetch_batch(table: str, shard: Optional[int], after_id: int, since: Optional[str],
+                until: Optional[str], limit: int) -> List[tuple]:
+    """The next batch of rows after after_id in id order"""
+    time_column, columns, _ = EXPORT_TABLES[table]
+    where, params = ["id > ?"], [after_id]
+    if since:
+        where.append(f"{time_column} >= ?")
+        params.append(since)
+    if until:
+        where.append(f"{time_column} < ?")
+        params.append(until)
+    return get_connection(shard).execute(f'''
+        SELECT {", ".join(columns)} FROM {table}
+        WHERE {" AND ".join(where)}
+        ORDER BY id
+        LIMIT ?
+    ''', params + [limit]).fetchall()
+
+
+def _databases(table: str) -> List[Optional[int]]:
+    return shard_indexes() if table in SHARDED_TABLES else [None]
+
+
+def iter_batches(table: str, since: Optional[str] = None, until: Optional[str] = None,
+                 batch: int = EXPORT_BATCH_ROWS) -> Iterator[List[tuple]]:
+    """Batches of rows in (shard, id) order"""
+    for shard in _databases(table):
+        after_id = 0
+        while True:
+            rows = fetch_batch(table, shard, after_id, since, until, batch)
+            if rows:
+                yield rows
+            if len(rows) < batch:
+                break
+            after_id = rows[-1][0]
+
+
+async def aiter_batches(table: str, since: Optional[str] = None, until: Optional[str] = None,
+                        batch: int = EXPORT_BATCH_ROWS) -> AsyncIterator[List[tuple]]:
+    """iter_batches for the event loop: every batch is read on the DB executor"""
+    for shard in _databases(table):
+        after_id = 0
+        while True:
+            rows = await run_db(fetch_batch, table, shard, after_id, since, until, batch)
+            if rows:
+                yield rows
+            if len(rows) < batch:
+                break
+            after_id = rows[-1][0]
+
+
+def _json_value(value, raw: bool) -> str:
+    if raw and value is not None:
+        return RawJSON(value)
+    return json.dumps(value, default=str)
+
+
+def encode_batch(table: str, rows: List[tuple], fmt: str) -> str:
+    """One batch as NDJSON lines (ndjson) or a single columnar line"""
+    _, columns, json_columns = EXPORT_TABLES[table]
+    raw = [name in json_columns for name in columns]
+    if fmt == "columnar":
+        data = ",".join(
+            f"{json.dumps(name)}:[{','.join(_json_value(row[i], raw[i]) for row in rows)}]"
+            for i, name in enumerate(columns)
+        )
+        head = json.dumps({"table": table, "rows": len(rows), "columns": columns}, separators=(",", ":"))
+        return head[:-1] + ',"data":{' + data + "}}\n"
+    return "".join(
+        "{" + ",".join(f"{json.dumps(name)}:{_json_value(row[i], raw[i])}" for i, name in enumerate(columns)) + "}\n"
+        for row in rows
+    )
+
+
+def check_operator_token(token: Optional[str]) -> None:
+    """Gate of the operator endpoints (export, analytics summary): 404 when disabled, 403 when wrong"""
+    if not EXPORT_API_TOKEN:
+        raise HTTPException(status_code=404, detail="Export is disabled (set EXPORT_API_TOKEN)")
+    if not token or not hmac.compare_digest(token, EXPORT_API_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid export token")
+
+
+def _check_request(table: str, fmt: str, token: Optional[str]) -> None:
+    check_operator_token(token)
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"Unknown table; exportable: {', '.join(EXPORT_TABLES)}")
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+
+
+def export_response(table: str, since: Optional[str], until: Optional[str], fmt: str,
+                    token: Optional[str]) -> StreamingResponse:
+    """Streaming HTTP export of one table (checks the export token)"""
+    _check_request(table, fmt, token)
+    try:
+        since, until = parse_time(since), parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since/until must be ISO dates or datetimes")
+
+    async def body():
+        async for rows in aiter_batches(table, since, until):
+            yield encode_batch(table, rows, fmt)
+
+    return StreamingResponse(body(), media_type=FORMATS[fmt], headers={
+        "Content-Disposition": f'attachment; filename="{table}.{"ndjson" if fmt == "ndjson" else "columnar.ndjson"}"'
+    })
+
+
+def write_parquet(table: str, batches: Iterator[List[tuple]], path: str) -> int:
+    """Write batches as Parquet row groups; returns rows written"""
+    if pyarrow is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    _, columns, _ = EXPORT_TABLES[table]
+    schema = pyarrow.schema([(name, pyarrow.int64() if name == "id" else pyarrow.string()) for name in columns])
+    written = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array([row[i] if i == 0 or row[i] is None else str(row[i]) for row in rows],
+                               type=schema.field(i).type)
+                 for i in range(len(columns))],
+                schema=schema))
+            written += len(rows)
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a table out as NDJSON, columnar NDJSON or Parquet")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    parser.add_argument("--since", help="ISO date/datetime (inclusive)")
+    parser.add_argument("--until", help="ISO date/datetime (exclusive)")
+    parser.add_argument("--format", choices=sorted(FORMATS) + ["parquet"], default="ndjson")
+    parser.add_argument("--batch", type=int, default=EXPORT_BATCH_ROWS)
+    parser.add_argument("--out", help="Output file (default: stdout; required for parquet)")
+    args = parser.parse_args()
+
+    try:
+        from backend.migrations import migrate
+    except ImportError:
+        from migrations import migrate
+    migrate()
+    batches = iter_batches(args.table, parse_time(args.since), parse_time(args.until), args.batch)
+    if args.format == "parquet":
+        if not args.out:
+            parser.error("--out is required for parquet")
+        total = write_parquet(args.table, batches, args.out)
+    else:
+        total = 0
+        out = open(args.out, "w") if args.out else sys.stdout
+        try:
+            for rows in batches:
+                out.write(encode_batch(args.table, rows, args.format))
+                total += len(rows)
+        finally:
+            if args.out:
+                out.close()
+    print(f"📤 Exported {total} {args.table} rows", file=sys.stderr)
@@ -0,0 +1,389 @@
+# fake_providers.py - LOCAL STAND-IN FOR AMADEUS, RAPIDAPI BOOKING AND OPENAI
+"""
+Fake upstream providers for load testing.
+
+Implements only the endpoints mcp_tools.py and workflow.py use:
+  Amadeus  : oauth2 token, reference-data/locations, v2 flight-offers
+  Booking  : searchDestination, searchHotels
+  OpenAI   : /v1/chat/completions (with tool calls)
+
+Run it and point the backend at it:
+    python fake_providers.py --port 9100 --latency lognormal:250:0.5 --error-rate 0.01
+    PROVIDER_STUB_URL=http://localhost:9100 OPENAI_API_KEY=sk-fake \\
+        AMADEUS_CLIENT_ID=fake AMADEUS_CLIENT_SECRET=fake RAPID_API_KEY=fake \\
+        uvicorn main:app --port 8000
+
+Latency specs are DIST:MS[:SPREAD] where DIST is fixed, uniform, normal or
+lognormal. MS is the median (mean for normal/uniform). SPREAD is the
+lognormal sigma, normal stddev in ms, or uniform half-width in ms.
+
+The fake model calls a search tool for every message that asks for flights
+or hotels. With --answer-followups it instead answers a follow-up that
+names no new route or place from tool results already in the history.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import hashlib
+from dataclasses import dataclass, asdict
+from datetime import date, timedelta
+from typing import Dict, Any, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+PROVIDERS = ("amadeus", "booking", "openai")
+
+
+@dataclass
+class ProviderProfile:
+    """Latency and failure behaviour of one fake provider"""
+    latency_dist: str = "lognormal"
+    latency_ms: float = 200.0
+    latency_spread: float = 0.5
+    error_rate: float = 0.0
+
+    def sample_latency(self, rng: random.Random) -> float:
+        """Latency in seconds drawn from the configured distribution"""
+        if self.latency_dist == "fixed":
+            ms = self.latency_ms
+        elif self.latency_dist == "uniform":
+            ms = rng.uniform(self.latency_ms - self.latency_spread, self.latency_ms + self.latency_spread)
+        elif self.latency_dist == "normal":
+            ms = rng.gauss(self.latency_ms, self.latency_spread)
+        else:
+            ms = self.latency_ms * rng.lognormvariate(0.0, self.latency_spread)
+        return max(ms, 0.0) / 1000.0
+
+
+@dataclass
+class FakeConfig:
+    flight_offers: int = 10
+    hotels: int = 20
+    reply_words: int = 60
+    seed: Optional[int] = None
+    answer_followups: bool = False
+
+
+profiles: Dict[str, ProviderProfile] = {name: ProviderProfile() for name in PROVIDERS}
+config = FakeConfig()
+counters: Dict[str, int] = {}
+_rng = random.Random()
+
+app = FastAPI(title="Fake travel providers", version="1.0.0")
+
+
+def parse_latency_spec(spec: str, profile: ProviderProfile) -> None:
+    """Apply a DIST:MS[:SPREAD] spec to a profile"""
+    parts = spec.split(":")
+    profile.latency_dist = parts[0]
+    if len(parts) > 1:
+        profile.latency_ms = float(parts[1])
+    if len(parts) > 2:
+        profile.latency_spread = float(parts[2])
+
+
+async def _simulate(provider: str, endpoint: str, error_status: int = 500) -> Optional[JSONResponse]:
+    """Sleep for the sampled latency; maybe return an injected error"""
+    profile = profiles[provider]
+    counters[endpoint] = counters.get(endpoint, 0) + 1
+    await asyncio.sleep(profile.sample_latency(_rng))
+    if profile.error_rate and _rng.random() < profile.error_rate:
+        counters[f"{endpoint}:error"] = counters.get(f"{endpoint}:error", 0) + 1
+        return JSONResponse(status_code=error_status, content={"error": "injected failure", "provider": provider})
+    return None
+
+
+def _seeded(*parts: Any) -> random.Random:
+    """Deterministic generator per request so identical searches return identical payloads"""
+    raw = "|".join(str(p) for p in parts) + f"|{config.seed}"
+    return random.Random(int(hashlib.md5(raw.encode()).hexdigest()[:12], 16))
+
+
+# ── Amadeus ──────────────────────────────────────────────────
+
+@app.post("/v1/security/oauth2/token")
+async def amadeus_token():
+    if (err := await _simulate("amadeus", "amadeus.token")) is not None:
+        return err
+    return {
+        "type": "amadeusOAuth2Token",
+        "access_token": f"fake-{uuid.uuid4().hex}",
+        "token_type": "Bearer",
+        "expires_in": 1799,
+        "state": "approved",
+    }
+
+
+@app.get("/v1/reference-data/locations")
+async def amadeus_locations(keyword: str = "", subType: str = "AIRPORT"):
+    if (err := await _simulate("amadeus", "amadeus.locations")) is not None:
+        return err
+    letters = re.sub(r"[^A-Za-z]", "", keyword).upper() or "XXX"
+    code = (letters + "XXX")[:3]
+    return {"data": [{"type": "location", "subType": subType, "name": keyword.upper(),
+                      "iataCode": code, "address": {"cityName": keyword.upper()}}]}
+
+
+@app.get("/v2/shopping/flight-offers")
+async def amadeus_flight_offers(originLocationCode: str, destinationLocationCode: str,
+                                departureDate: str, adults: int = 1,
+                                returnDate: Optional[str] = None, max: int = 10,
+                                currencyCode: str = "USD"):
+    if (err := await _simulate("amadeus", "amadeus.flight_offers")) is not None:
+        return err
+    rng = _seeded(originLocationCode, destinationLocationCode, departureDate, returnDate, adults)
+    carriers = ["AA", "DL", "UA", "BA", "LH", "AF", "KL", "IB", "TP"]
+    offers = []
+    for i in range(config.flight_offers):
+        carrier = rng.choice(carriers)
+        legs = [(originLocationCode, destinationLocationCode, departureDate)]
+        if returnDate:
+            legs.append((destinationLocationCode, originLocationCode, returnDate))
+        itineraries = []
+        for dep, arr, day in legs:
+            hour = rng.randint(5, 22)
+            minutes = rng.randint(60, 900)
+            itineraries.append({
+                "duration": f"PT{minutes // 60}H{minutes % 60}M",
+                "segments": [{
+                    "departure": {"iataCode": dep, "at": f"{day}T{hour:02d}:{rng.choice(['00', '15', '30', '45'])}:00"},
+                    "arrival": {"iataCode": arr, "at": f"{day}T{(hour + minutes // 60) % 24:02d}:00:00"},
+                    "carrierCode": carrier,
+                    "number": str(rng.randint(10, 9999)),
+                    "aircraft": {"code": rng.choice(["320", "321", "738", "77W", "789"])},
+                    "numberOfStops": 0,
+                }],
+            })
+        total = f"{rng.uniform(89, 1450) * adults:.2f}"
+        offers.append({
+            "type": "flight-offer",
+            "id": str(i + 1),
+            "source": "GDS",
+            "oneWay": not returnDate,
+            "numberOfBookableSeats": rng.randint(1, 9),
+            "itineraries": itineraries,
+            "price": {"currency": currencyCode, "total": total, "base": total, "grandTotal": total},
+            "validatingAirlineCodes": [carrier],
+        })
+    return {
+        "meta": {"count": len(offers)},
+        "data": offers[:max] if max else offers,
+        "dictionaries": {"carriers": {c: f"{c} AIRLINES" for c in carriers}},
+    }
+
+
+# ── Booking.com via RapidAPI ─────────────────────────────────
+
+@app.get("/api/v1/hotels/searchDestination")
+async def booking_search_destination(query: str = ""):
+    if (err := await _simulate("booking", "booking.search_destination", error_status=429)) is not None:
+        return err
+    rng = _seeded("dest", query.lower())
+    return {"status": True, "message": "Success", "data": [{
+        "dest_id": str(-rng.randint(100000, 9999999)),
+        "search_type": "city",
+        "dest_type": "city",
+        "label": query.title(),
+        "name": query.title(),
+        "hotels": rng.randint(50, 3000),
+    }]}
+
+
+@app.get("/api/v1/hotels/searchHotels")
+async def booking_search_hotels(dest_id: str, arrival_date: str = "", departure_date: str = "",
+                                adults: int = 1, room_qty: int = 1, currency_code: str = "USD"):
+    if (err := await _simulate("booking", "booking.search_hotels", error_status=429)) is not None:
+        return err
+    rng = _seeded(dest_id, arrival_date, departure_date, adults, room_qty)
+    hotels = []
+    for i in range(config.hotels):
+        price = rng.uniform(45, 650) * room_qty
+        hotels.append({
+            "hotel_id": rng.randint(100000, 9999999),
+            "accessibilityLabel": f"Hotel {i + 1}",
+            "property": {
+                "name": f"{rng.choice(['Grand', 'Royal', 'Central', 'Harbour', 'Old Town'])} Hotel {i + 1}",
+                "reviewScore": round(rng.uniform(6.0, 9.8), 1),
+                "reviewCount": rng.randint(10, 8000),
+                "propertyClass": rng.randint(1, 5),
+                "checkinDate": arrival_date,
+                "checkoutDate": departure_date,
+                "priceBreakdown": {"grossPrice": {"value": round(price, 2), "currency": currency_code}},
+            },
+        })
+    return {"status": True, "message": "Success", "data": {"hotels": hotels, "meta": [{"title": f"{len(hotels)} properties"}]}}
+
+
+# ── OpenAI chat completions ──────────────────────────────────
+
+_FIELD_RE = re.compile(r"^(Origin|Destination|Departure|Return) text\s*:\s*(.*)$", re.MULTILINE)
+_ROUTE_RE = re.compile(r"from\s+([A-Za-z .]+?)\s+to\s+([A-Za-z .]+?)(?:\s+on\s+|\s+in\s+|[,.?!]|$)", re.IGNORECASE)
+_IN_RE = re.compile(r"\bin\s+([A-Z][A-Za-z .]+?)(?:\s+from\s+|\s+for\s+|[,.?!]|$)")
+
+
+def _content_text(message: Dict[str, Any]) -> str:
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def _iso_or_default(text: str, days_ahead: int) -> str:
+    match = re.search(r"\d{4}-\d{2}-\d{2}", text or "")
+    return match.group(0) if match else (date.today() + timedelta(days=days_ahead)).isoformat()
+
+
+def _tool_call(name: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    return {"id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+            "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+
+def _fake_reply(messages: List[Dict[str, Any]], tools: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Decide what the fake model says: normalization JSON, a tool call or prose"""
+    last = messages[-1] if messages else {}
+    text = _content_text(last)
+
+    # _translate_flight_query normalization prompt
+    if "Return EXACTLY this JSON shape" in text:
+        fields = {k.lower(): v.strip() for k, v in _FIELD_RE.findall(text)}
+        to_code = lambda s: (re.sub(r"[^A-Za-z]", "", s).upper() + "XXX")[:3]
+        ret = fields.get("return")
+        return {"content": json.dumps({
+            "origin": to_code(fields.get("origin", "")),
+            "destination": to_code(fields.get("destination", "")),
+            "departure": _iso_or_default(fields.get("departure", ""), 30),
+            "return": _iso_or_default(ret, 37) if ret else None,
+        })}
+
+    # get_airport_code_intelligent prompt
+    if "airport code" in text.lower():
+        city = re.search(r"airport code for (.+?)\?", text)
+        return {"content": (re.sub(r"[^A-Za-z]", "", city.group(1) if city else "XXX").upper() + "XXX")[:3]}
+
+    tool_names = {t.get("function", {}).get("name") for t in tools or []}
+    if last.get("role") == "tool":
+        try:
+            payload = json.loads(text)
+        except ValueError:
+            payload = {}
+        found = payload.get("data")
+        count = len(found) if isinstance(found, list) else len((found or {}).get("hotels", [])) if isinstance(found, dict) else 0
+        return {"content": f"I found {count} options for you. " + " ".join(["Details follow."] * max(config.reply_words // 2, 1))}
+
+    lowered = text.lower()
+    # Opt-in: a follow-up that names no new route or place is answered from replayed tool results
+    earlier_results = sum(1 for m in messages[:-1] if m.get("role") == "tool")
+    if config.answer_followups and earlier_results and ("flight" in lowered or "hotel" in lowered) \
+            and not _ROUTE_RE.search(text) and not _IN_RE.search(text):
+        return {"content": f"From the {earlier_results} earlier search result(s): "
+                           + " ".join(["Details follow."] * max(config.reply_words // 2, 1))}
+    if "search_flights" in tool_names and "flight" in lowered:
+        route = _ROUTE_RE.search(text)
+        origin, destination = (route.group(1), route.group(2)) if route else ("New York", "Paris")
+        return {"tool_calls": [_tool_call("search_flights", {
+            "origin": origin.strip(), "destination": destination.strip(),
+            "departure_date": _iso_or_default(text, 30), "passengers": 1,
+        })]}
+    if "search_hotels" in tool_names and "hotel" in lowered:
+        place = _IN_RE.search(text)
+        return {"tool_calls": [_tool_call("search_hotels", {
+            "location": place.group(1).strip() if place else "Lisbon",
+            "check_in": _iso_or_default(text, 30), "check_out": _iso_or_default("", 33),
+        })]}
+
+    words = ["Happy", "to", "help", "with", "your", "trip", "planning", "today."]
+    return {"content": " ".join(words[i % len(words)] for i in range(config.reply_words))}
+
+
+@app.post("/v1/chat/completions")
+async def openai_chat_completions(request: Request):
+    if (err := await _simulate("openai", "openai.chat_completions", error_status=429)) is not None:
+        return err
+    body = await request.json()
+    messages = body.get("messages", [])
+    reply = _fake_reply(messages, body.get("tools") or [])
+
+    message: Dict[str, Any] = {"role": "assistant", "content": reply.get("content")}
+    if reply.get("tool_calls"):
+        message["tool_calls"] = reply["tool_calls"]
+    prompt_tokens = sum(len(_content_text(m)) for m in messages) // 4 + 1
+    completion_tokens = len(reply.get("content") or json.dumps(reply.get("tool_calls"))) // 4 + 1
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{"index": 0, "message": message, "logprobs": None,
+                     "finish_reason": "tool_calls" if reply.get("tool_calls") else "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+# ── Control endpoints ────────────────────────────────────────
+
+@app.get("/_fake/config")
+async def get_fake_config():
+    return {"profiles": {k: asdict(v) for k, v in profiles.items()}, "config": asdict(config)}
+
+
+@app.post("/_fake/config")
+async def update_fake_config(update: Dict[str, Any]):
+    """Change behaviour mid-run, e.g. {"profiles": {"openai": {"error_rate": 0.2}}}"""
+    for name, fields in (update.get("profiles") or {}).items():
+        for key, value in fields.items():
+            setattr(profiles[name], key, value)
+    for key, value in (update.get("config") or {}).items():
+        setattr(config, key, value)
+    return await get_fake_config()
+
+
+@app.get("/_fake/stats")
+async def get_fake_stats():
+    return {"requests": counters}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Amadeus / Booking / OpenAI providers")
+    parser.add_argument("--host", default=os.getenv("FAKE_PROVIDERS_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("FAKE_PROVIDERS_PORT", "9100")))
+    parser.add_argument("--latency", default=os.getenv("FAKE_LATENCY", "lognormal:200:0.5"),
+                        help="DIST:MS[:SPREAD] for every provider")
+    parser.add_argument("--error-rate", type=float, default=float(os.getenv("FAKE_ERROR_RATE", "0")))
+    for name in PROVIDERS:
+        parser.add_argument(f"--{name}-latency", help=f"Latency spec override for {name}")
+        parser.add_argument(f"--{name}-error-rate", type=float, help=f"Error rate override for {name}")
+    parser.add_argument("--flight-offers", type=int, default=config.flight_offers)
+    parser.add_argument("--hotels", type=int, default=config.hotels)
+    parser.add_argument("--reply-words", type=int, default=config.reply_words)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--answer-followups", action="store_true",
+                        default=os.getenv("FAKE_ANSWER_FOLLOWUPS", "false").lower() in ("1", "true", "yes"),
+                        help="Answer follow-ups without a new route or place from earlier tool results")
+    args = parser.parse_args()
+
+    for name, profile in profiles.items():
+        parse_latency_spec(getattr(args, f"{name}_latency") or args.latency, profile)
+        override = getattr(args, f"{name}_error_rate")
+        profile.error_rate = args.error_rate if override is None else override
+    config.flight_offers = args.flight_offers
+    config.hotels = args.hotels
+    config.reply_words = args.reply_words
+    config.seed = args.seed
+    config.answer_followups = args.answer_followups
+    if args.seed is not None:
+        _rng.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
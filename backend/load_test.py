@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+End-to-end load generator for the travel chatbot API
+
+Drives /chat, /auth/login, /bookings and /conversations/{id}/history with a
+mix of conversation scenarios and reports throughput and p50/p95/p99
+latency per endpoint and per phase (ramp, steady).
+
+Typical use against the fake providers (see fake_providers.py):
+    python load_test.py --spawn --users 50 --duration 60 --out run.json
+    python load_test.py --spawn --baseline baseline.json --threshold 0.15
+    python load_test.py --compare baseline.json run.json
+
+Login storm - extra users logging in back to back on top of the normal
+mix; compare /chat latency and "/auth/login (storm)" throughput with and
+without it (503s from password-hashing admission control count as errors):
+    python load_test.py --spawn --login-storm 20 --out storm.json
+
+Multi-replica runs against PostgreSQL (any number of --api-workers share it):
+    python load_test.py --spawn --api-workers 4 --database-url postgresql://app@localhost/chatbot
+
+Exits non-zero when a baseline comparison regresses past the threshold.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+SEARCH_MESSAGES = [
+    "Find flights from New York to Lisbon on 2026-12-01",
+    "Find flights from London to Tokyo on 2026-11-15",
+    "Find a hotel in Lisbon",
+    "Find a hotel in Barcelona for 2 guests",
+    "Search flights from Paris to Rome on 2026-12-20",
+]
+FOLLOW_UP_MESSAGES = [
+    "Which one is the cheapest?",
+    "Any morning departures?",
+    "What about something with a better review score?",
+]
+CHITCHAT_MESSAGES = [
+    "hi",
+    "What is the best time of year to visit Japan?",
+    "Do I need a visa for Portugal?",
+    "thanks, that's helpful",
+]
+
+# name -> (weight, authenticated, search heavy, turns)
+SCENARIOS = {
+    "anon_chitchat": (0.30, False, False, 2),
+    "anon_search":   (0.25, False, True,  3),
+    "auth_search":   (0.30, True,  True,  4),
+    "auth_chitchat": (0.15, True,  False, 2),
+}
+
+PERCENTILES = (50, 95, 99)
+
+# Guest identity the API hands out (and reads back) - see auth.set_anonymous_id
+ANON_HEADER_NAME = "X-Anonymous-Id"
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    phase: str
+    latency: float
+    ok: bool
+
+
+@dataclass
+class RunState:
+    base_url: str
+    accounts: List[Tuple[str, str]] = field(default_factory=list)
+    samples: List[Sample] = field(default_factory=list)
+    phase: str = "ramp"
+    phase_started: Dict[str, float] = field(default_factory=dict)
+    phase_ended: Dict[str, float] = field(default_factory=dict)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+async def timed(state: RunState, client: httpx.AsyncClient, endpoint: str,
+                method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+    """Issue one request and record its latency under the endpoint label"""
+    start = time.perf_counter()
+    response = None
+    try:
+        response = await client.request(method, path, **kwargs)
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+    state.samples.append(Sample(endpoint, state.phase, time.perf_counter() - start, ok))
+    return response
+
+
+async def run_conversation(state: RunState, client: httpx.AsyncClient, rng: random.Random):
+    """Play one scenario picked by weight"""
+    names = list(SCENARIOS)
+    name = rng.choices(names, weights=[SCENARIOS[n][0] for n in names])[0]
+    _, authenticated, search_heavy, turns = SCENARIOS[name]
+
+    headers = {"user-agent": f"load-test/{uuid.uuid4().hex[:8]}"}
+    user_id = None
+    if authenticated and state.accounts:
+        email, password = rng.choice(state.accounts)
+        rsp = await timed(state, client, "/auth/login", "POST", "/auth/login",
+                          json={"email": email, "password": password}, headers=headers)
+        if rsp is not None and rsp.status_code == 200:
+            body = rsp.json()
+            headers["Authorization"] = f"Bearer {body['access_token']}"
+            user_id = body["user"]["id"]
+
+    conversation_id = None
+    for turn in range(turns):
+        if search_heavy:
+            message = rng.choice(SEARCH_MESSAGES) if turn == 0 else rng.choice(FOLLOW_UP_MESSAGES)
+        else:
+            message = rng.choice(CHITCHAT_MESSAGES)
+        rsp = await timed(state, client, "/chat", "POST", "/chat",
+                          json={"conversation_id": conversation_id, "message": message}, headers=headers)
+        if rsp is not None and rsp.status_code == 200:
+            conversation_id = rsp.json().get("conversation_id", conversation_id)
+        # A guest keeps the id issued on its first turn, for this conversation only
+        if rsp is not None and ANON_HEADER_NAME in rsp.headers:
+            headers[ANON_HEADER_NAME] = rsp.headers[ANON_HEADER_NAME]
+
+    if conversation_id:
+        await timed(state, client, "/conversations/{id}/history", "GET",
+                    f"/conversations/{conversation_id}/history", headers=headers)
+    if user_id:
+        await timed(state, client, "/bookings", "GET", "/bookings",
+                    params={"user_id": user_id}, headers=headers)
+
+
+async def virtual_user(state: RunState, client: httpx.AsyncClient, seed: int,
+                       start_delay: float, stop_at: float, think_time: float):
+    rng = random.Random(seed)
+    await asyncio.sleep(start_delay)
+    while time.monotonic() < stop_at:
+        await run_conversation(state, client, rng)
+        if think_time:
+            await asyncio.sleep(rng.expovariate(1.0 / think_time))
+
+
+async def login_storm_user(state: RunState, client: httpx.AsyncClient, seed: int,
+                           start_delay: float, stop_at: float):
+    """Log in again and again without pausing (mass re-login after an outage, credential stuffing)"""
+    rng = random.Random(seed)
+    headers = {"user-agent": f"load-test-storm/{uuid.uuid4().hex[:8]}"}
+    await asyncio.sleep(start_delay)
+    while time.monotonic() < stop_at and state.accounts:
+        email, password = rng.choice(state.accounts)
+        await timed(state, client, "/auth/login (storm)", "POST", "/auth/login",
+                    json={"email": email, "password": password}, headers=headers)
+
+
+async def register_accounts(state: RunState, client: httpx.AsyncClient, count: int):
+    """Create the account pool authenticated scenarios log in with (not measured)"""
+    run_tag = uuid.uuid4().hex[:6]
+    for i in range(count):
+        email = f"loadtest_{run_tag}_{i}@example.com"
+        password = f"pw-{run_tag}-{i}"
+        rsp = await client.post("/auth/register", json={
+            "email": email, "password": password, "first_name": "Load", "last_name": f"User{i}"
+        })
+        if rsp.status_code == 200:
+            state.accounts.append((email, password))
+    print(f"👥 Registered {len(state.accounts)}/{count} load-test accounts")
+
+
+async def run_load(args) -> Dict:
+    state = RunState(base_url=args.base_url)
+    connections = (args.users + args.login_storm) * 2
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    # The client is shared by every virtual user: a cookie jar would make all guests one guest
+    no_cookies = CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits,
+                                 cookies=no_cookies) as client:
+        try:
+            args.storage_backend = (await client.get("/health")).json().get("storage_backend")
+        except (httpx.HTTPError, ValueError):
+            args.storage_backend = None
+        await register_accounts(state, client, args.accounts)
+
+        now = time.monotonic()
+        stop_at = now + args.ramp + args.duration
+        state.phase_started["ramp"] = now
+        users = [
+            asyncio.create_task(virtual_user(
+                state, client, args.seed + i,
+                args.ramp * i / max(args.users, 1), stop_at, args.think_time
+            ))
+            for i in range(args.users)
+        ] + [
+            asyncio.create_task(login_storm_user(
+                state, client, args.seed + args.users + i,
+                args.ramp * i / max(args.login_storm, 1), stop_at
+            ))
+            for i in range(args.login_storm)
+        ]
+        await asyncio.sleep(args.ramp)
+        state.phase_ended["ramp"] = state.phase_started["steady"] = time.monotonic()
+        state.phase = "steady"
+        await asyncio.gather(*users)
+        state.phase_ended["steady"] = time.monotonic()
+
+    return summarize(state, args)
+
+
+def summarize(state: RunState, args) -> Dict:
+    """Aggregate samples into per-phase, per-endpoint statistics"""
+    report = {
+        "meta": {
+            "base_url": args.base_url,
+            "users": args.users,
+            "login_storm": args.login_storm,
+            "ramp": args.ramp,
+            "duration": args.duration,
+            "label": args.label,
+            "storage_backend": getattr(args, "storage_backend", None),
+            "api_workers": args.api_workers if args.spawn else None,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "phases": {},
+    }
+    for phase, started in state.phase_started.items():
+        elapsed = max(state.phase_ended.get(phase, started) - started, 1e-9)
+        by_endpoint: Dict[str, List[Sample]] = {}
+        for sample in state.samples:
+            if sample.phase == phase:
+                by_endpoint.setdefault(sample.endpoint, []).append(sample)
+                by_endpoint.setdefault("ALL", []).append(sample)
+        endpoints = {}
+        for endpoint, samples in sorted(by_endpoint.items()):
+            latencies = sorted(s.latency * 1000 for s in samples)
+            stats = {
+                "requests": len(samples),
+                "errors": sum(1 for s in samples if not s.ok),
+                "throughput_rps": round(len(samples) / elapsed, 3),
+                "mean_ms": round(sum(latencies) / len(latencies), 2),
+                "max_ms": round(latencies[-1], 2),
+            }
+            for pct in PERCENTILES:
+                stats[f"p{pct}_ms"] = round(percentile(latencies, pct), 2)
+            endpoints[endpoint] = stats
+        report["phases"][phase] = {"elapsed_s": round(elapsed, 2), "endpoints": endpoints}
+    return report
+
+
+def print_report(report: Dict):
+    for phase, data in report["phases"].items():
+        print(f"\n📈 Phase: {phase} ({data['elapsed_s']}s)")
+        print(f"   {'endpoint':<30} {'reqs':>6} {'err':>5} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}")
+        for endpoint, s in data["endpoints"].items():
+            print(f"   {endpoint:<30} {s['requests']:>6} {s['errors']:>5} {s['throughput_rps']:>8.2f} "
+                  f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f}")
+
+
+def compare_reports(baseline: Dict, current: Dict, threshold: float, phase: str = "steady") -> List[str]:
+    """Print a comparison and return the list of regressions past the threshold"""
+    regressions = []
+    base_eps = baseline.get("phases", {}).get(phase, {}).get("endpoints", {})
+    cur_eps = current.get("phases", {}).get(phase, {}).get("endpoints", {})
+    print(f"\n🔍 Comparing phase '{phase}' (threshold {threshold:.0%})")
+    for endpoint in sorted(set(base_eps) & set(cur_eps)):
+        base, cur = base_eps[endpoint], cur_eps[endpoint]
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("p99_ms", True),
+                                        ("throughput_rps", False)):
+            if not base.get(metric):
+                continue
+            change = (cur[metric] - base[metric]) / base[metric]
+            worse = change > threshold if higher_is_worse else change < -threshold
+            marker = "❌" if worse else "✅"
+            print(f"   {marker} {endpoint:<30} {metric:<15} {base[metric]:>10.2f} → {cur[metric]:>10.2f} ({change:+.1%})")
+            if worse:
+                regressions.append(f"{endpoint} {metric} {change:+.1%}")
+        base_err = base["errors"] / max(base["requests"], 1)
+        cur_err = cur["errors"] / max(cur["requests"], 1)
+        if cur_err > base_err + threshold / 10:
+            regressions.append(f"{endpoint} error rate {base_err:.2%} → {cur_err:.2%}")
+    return regressions
+
+
+def spawn_stack(args) -> List[subprocess.Popen]:
+    """Start fake_providers.py and the API wired to it"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    env = dict(os.environ,
+               PROVIDER_STUB_URL=stub_url,
+               OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-fake"),
+               AMADEUS_CLIENT_ID="fake", AMADEUS_CLIENT_SECRET="fake", RAPID_API_KEY="fake",
+               # Every virtual user comes from 127.0.0.1: measure capacity, not the per-IP limit
+               RATE_LIMIT_ENABLED=os.getenv("RATE_LIMIT_ENABLED", "false"))
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+    procs = [
+        subprocess.Popen([sys.executable, "fake_providers.py", "--port", str(args.stub_port),
+                          "--latency", args.stub_latency, "--error-rate", str(args.stub_error_rate)],
+                         cwd=here, env=env),
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.api_port),
+                          "--workers", str(args.api_workers), "--log-level", "warning"],
+                         cwd=here, env=env, stdout=subprocess.DEVNULL),
+    ]
+    args.base_url = f"http://127.0.0.1:{args.api_port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{args.base_url}/health", timeout=1).status_code == 200:
+                print(f"🚀 Stack up: API {args.base_url}, providers {stub_url}")
+                return procs
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    for proc in procs:
+        proc.terminate()
+    raise RuntimeError("API did not become healthy within 60s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the travel chatbot API")
+    parser.add_argument("--base-url", default=os.getenv("LOAD_TEST_BASE_URL", "http://127.0.0.1:8000"))
+    parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users")
+    parser.add_argument("--ramp", type=float, default=10.0, help="Ramp-up phase seconds")
+    parser.add_argument("--duration", type=float, default=30.0, help="Steady phase seconds")
+    parser.add_argument("--think-time", type=float, default=0.5, help="Mean pause between conversations")
+    parser.add_argument("--accounts", type=int, default=10, help="Accounts to register for auth scenarios")
+    parser.add_argument("--login-storm", type=int, default=0,
+                        help="Extra users that only log in, back to back")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--label", default="", help="Free-form tag stored in the report")
+    parser.add_argument("--out", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="Report to compare against; fail on regression")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed relative regression")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Only compare two saved reports")
+    parser.add_argument("--spawn", action="store_true", help="Start fake providers and the API locally")
+    parser.add_argument("--api-port", type=int, default=8100)
+    parser.add_argument("--api-workers", type=int, default=1)
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""),
+                        help="postgresql://... for the spawned API (default: its SQLite file)")
+    parser.add_argument("--stub-port", type=int, default=9100)
+    parser.add_argument("--stub-latency", default="lognormal:200:0.5")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        regressions = compare_reports(baseline, current, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    procs = spawn_stack(args) if args.spawn else []
+    try:
+        report = asyncio.run(run_load(args))
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+    print_report(report)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Report written to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.threshold)
+        if regressions:
+            print("\n❌ Regressions past threshold:")
+            for line in regressions:
+                print(f"   • {line}")
+            sys.exit(1)
+        print("\n✅ No regressions past threshold")
+
+
+if __name__ == "__main__":
+    main()
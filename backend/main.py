@@ -1,14 +1,15 @@
 # main.py - CLEAN INTEGRATION WITH INTELLIGENT WORKFLOW
 import os
 import uuid
-import sqlite3
 import logging
+import asyncio
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from fastapi import FastAPI, HTTPException, Request, Depends, Header
+from typing import List, Optional, Dict, Any, Tuple
+from fastapi import FastAPI, HTTPException, Request, Response, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from redis.exceptions import RedisError
 from dotenv import load_dotenv
 from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
 import json
@@ -28,33 +29,82 @@ print("DEBUG AMADEUS_CLIENT_ID =", os.getenv("AMADEUS_CLIENT_ID"))
 
 # Import the INTELLIGENT workflow - NO HARDCODING
 try:
-    from workflow import process_travel_request
-    from mcp_tools import get_real_mcp_tools
+    from workflow import process_travel_turn, serialize_tool_exchange, deserialize_tool_exchange
+    from mcp_tools import get_real_mcp_tools, rds
+    from cassette import install_from_env as install_cassette_from_env
+    from storage import (transaction, get_connection, after_commit, run_db, fan_out, shard_count,
+                         dialect as storage_dialect, close_all as close_db_connections)
+    from migrations import migrate
+    from archive import rehydrate as rehydrate_archived
+    from search import search_messages
+    from export import export_response, check_operator_token
+    from write_behind import write_behind
+    from profile_aggregator import profile_aggregator
+    from retention import retention
+    from sessions import sessions
+    from rollups import rollups, summary as analytics_summary, SEARCH_EVENT, BOOKING_EVENT
+    from singleflight import stats as singleflight_stats
+    from usage import metering
+    from admission import chat_gate
+    from rate_limit import (rate_limiter, run_limiter, client_ip, subject_of, too_many_requests,
+                            headers as rate_limit_headers)
+    from password_hashing import (run_hashing, hash_password, verify_password as verify_password_hash,
+                                  stats as password_hashing_stats)
+    from pagination import RawJSON, encode_cursor, decode_cursor, clamp_limit, parse_fields, stream_page, all_pages
+    from cache import TTLCache, RedisInvalidator, stats as cache_stats
     from auth import (
         init_auth_tables, UserCreate, UserLogin, UserResponse,
         create_user, authenticate_user, create_access_token, 
-        get_current_user_from_token, get_or_create_anonymous_user,
+        get_current_user_from_token, cached_user_from_token,
         log_user_interaction, log_analytics_event, learn_from_user_behavior,
-        get_user_learning_profile, create_session
+        get_user_learning_profile, create_session, deactivate_user, user_cache,
+        get_login_row, record_login, ANON_COOKIE_NAME, ANON_HEADER_NAME, issue_anonymous_id,
+        read_anonymous_id, set_anonymous_id, ensure_anonymous_user, persisted_guests, verify_token
     )
 except ImportError:
     # Fallback for different directory structures
     import sys
     sys.path.append('.')
-    from workflow import process_travel_request
-    from mcp_tools import get_real_mcp_tools
+    from workflow import process_travel_turn, serialize_tool_exchange, deserialize_tool_exchange
+    from mcp_tools import get_real_mcp_tools, rds
+    from cassette import install_from_env as install_cassette_from_env
+    from storage import (transaction, get_connection, after_commit, run_db, fan_out, shard_count,
+                         dialect as storage_dialect, close_all as close_db_connections)
+    from migrations import migrate
+    from archive import rehydrate as rehydrate_archived
+    from search import search_messages
+    from export import export_response, check_operator_token
+    from write_behind import write_behind
+    from profile_aggregator import profile_aggregator
+    from retention import retention
+    from sessions import sessions
+    from rollups import rollups, summary as analytics_summary, SEARCH_EVENT, BOOKING_EVENT
+    from singleflight import stats as singleflight_stats
+    from usage import metering
+    from admission import chat_gate
+    from rate_limit import (rate_limiter, run_limiter, client_ip, subject_of, too_many_requests,
+                            headers as rate_limit_headers)
+    from password_hashing import (run_hashing, hash_password, verify_password as verify_password_hash,
+                                  stats as password_hashing_stats)
+    from pagination import RawJSON, encode_cursor, decode_cursor, clamp_limit, parse_fields, stream_page, all_pages
+    from cache import TTLCache, RedisInvalidator, stats as cache_stats
     from auth import (
         init_auth_tables, UserCreate, UserLogin, UserResponse,
         create_user, authenticate_user, create_access_token,
-        get_current_user_from_token, get_or_create_anonymous_user,
+        get_current_user_from_token, cached_user_from_token,
         log_user_interaction, log_analytics_event, learn_from_user_behavior,
-        get_user_learning_profile, create_session
+        get_user_learning_profile, create_session, deactivate_user, user_cache,
+        get_login_row, record_login, ANON_COOKIE_NAME, ANON_HEADER_NAME, issue_anonymous_id,
+        read_anonymous_id, set_anonymous_id, ensure_anonymous_user, persisted_guests, verify_token
     )
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Record or replay outbound provider calls when CASSETTE_MODE is set
+install_cassette_from_env()
+
 # Validate environment variables
 REQUIRED_ENV_VARS = [
     "OPENAI_API_KEY",  # Required for LLM intelligence
@@ -82,93 +132,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[ANON_HEADER_NAME],
+)
+
+# Hot cache of deserialized conversation histories
+HISTORY_CACHE_MAX_ITEMS = int(os.getenv("HISTORY_CACHE_MAX_ITEMS", "2000"))
+HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "900"))
+
+# conversation_id -> (id of the newest message, [HumanMessage / AIMessage / ToolMessage, ...])
+history_cache = TTLCache(
+    "conversation_history",
+    max_items=HISTORY_CACHE_MAX_ITEMS,
+    max_bytes=HISTORY_CACHE_MAX_BYTES,
+    ttl=HISTORY_CACHE_TTL,
+    sizeof=lambda entry: 64 + sum(200 + len(message.content) for message in entry[1]),
 )
 
 # Database initialization
 def init_db():
-    """Initialize database for conversation tracking"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
-    # Enable foreign keys
-    cursor.execute("PRAGMA foreign_keys = ON")
-    
-    # Users table (with all auth columns)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            first_name TEXT,
-            last_name TEXT,
-            email TEXT UNIQUE,
-            nationality TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            password_hash TEXT,
-            is_demo_user BOOLEAN DEFAULT FALSE,
-            last_login TIMESTAMP,
-            is_active BOOLEAN DEFAULT TRUE
-        )
-    ''')
-    
-    # Conversations table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id TEXT PRIMARY KEY,
-            user_id TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Messages table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            conversation_id TEXT NOT NULL,
-            role TEXT NOT NULL,
-            content TEXT NOT NULL,
-            metadata TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-        )
-    ''')
-    
-    # Bookings table for tracking mock bookings
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bookings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            booking_reference TEXT UNIQUE NOT NULL,
-            user_id TEXT,
-            booking_type TEXT,
-            booking_data TEXT,
-            status TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # User preferences
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_preferences (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            preference_type TEXT NOT NULL,
-            preference_value TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """Initialize database for conversation tracking (applies pending migrations)"""
+    migrate()
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize application on startup"""
-    init_db()
+    await run_db(init_db)
+    write_behind.start()
+    retention.start()
+    rollups.start()
+    RedisInvalidator(rds).attach(history_cache).attach(user_cache).attach(sessions.live)
     try:
-        init_auth_tables()
+        await run_db(init_auth_tables)
         logger.info("✅ Auth tables initialized")
     except Exception as e:
         logger.warning(f"Auth initialization issue: {e}")
@@ -179,6 +174,15 @@ async def startup_event():
     logger.info("📋 Mock bookings: Generates confirmations without real charges")
     logger.info("🚫 NO HARDCODING - Pure AI intelligence")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Flush queued analytics writes and release pooled database connections"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, retention.stop)
+    await loop.run_in_executor(None, rollups.stop)
+    await loop.run_in_executor(None, write_behind.stop)
+    close_db_connections()
+
 # Request/Response models
 class ChatRequest(BaseModel):
     conversation_id: Optional[str] = None
@@ -191,12 +195,14 @@ class ChatResponse(BaseModel):
     booking_reference: Optional[str] = None
 
 # Authentication dependency
-async def get_current_user(request: Request, authorization: Optional[str] = Header(None)) -> Dict:
-    """Get current user from token or create anonymous"""
+async def get_current_user(request: Request, response: Response,
+                           authorization: Optional[str] = Header(None)) -> Dict:
+    """Get current user from token, or the guest of the signed anonymous id (issued when missing)"""
     if authorization and authorization.startswith("Bearer "):
         token = authorization.split(" ")[1]
         try:
-            user = get_current_user_from_token(token)
+            # Known token and user: no executor hop, no SQL
+            user = cached_user_from_token(token) or await run_db(get_current_user_from_token, token)
             if user:
                 return {
                     "id": user.id,
@@ -209,81 +215,180 @@ async def get_current_user(request: Request, authorization: Optional[str] = Head
         except Exception as e:
             logger.warning(f"Token validation failed: {e}")
     
-    # Create or get anonymous user
-    user_id = get_or_create_anonymous_user(request)
+    # Guest: a signature check, no SQL - rows are created once the id comes back
+    user_id = read_anonymous_id(request.cookies.get(ANON_COOKIE_NAME) or request.headers.get(ANON_HEADER_NAME))
+    is_new_guest = user_id is None
+    if is_new_guest:
+        user_id, signed = issue_anonymous_id()
+        set_anonymous_id(response, signed)
     return {
         "id": user_id,
         "email": f"anon_{user_id[:8]}@temp.com",
         "first_name": "Guest",
         "last_name": "User",
         "is_authenticated": False,
-        "is_demo_user": False
+        "is_demo_user": False,
+        "is_new_guest": is_new_guest
     }
 def create_conversation(user_id: str = "anonymous") -> str:
     """Create a new conversation"""
     conversation_id = str(uuid.uuid4())
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO conversations (id, user_id) VALUES (?, ?)
-    ''', (conversation_id, user_id))
-    conn.commit()
-    conn.close()
+    with transaction(immediate=True, shard=conversation_id) as conn:
+        conn.execute('''
+            INSERT INTO conversations (id, user_id) VALUES (?, ?)
+        ''', (conversation_id, user_id))
+        after_commit(history_cache.set, conversation_id, (None, []))
     
     return conversation_id
 
-def save_message(conversation_id: str, role: str, content: str):
-    """Save a message to database"""
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO messages (conversation_id, role, content)
-        VALUES (?, ?, ?)
-    ''', (conversation_id, role, content))
-    conn.commit()
-    conn.close()
+def _to_messages(role: str, content: str, metadata: Optional[str] = None) -> List[BaseMessage]:
+    """LangChain messages for one stored row - an assistant reply is preceded by its tool exchange"""
+    if role == "user":
+        return [HumanMessage(content=content)]
+    if role == "assistant":
+        tool_exchange = json.loads(metadata).get("tool_exchange", []) if metadata else []
+        return deserialize_tool_exchange(tool_exchange) + [AIMessage(content=content)]
+    return []
+
+def _last_message_id(conn, conversation_id: str) -> Optional[int]:
+    return conn.execute(
+        "SELECT MAX(id) FROM messages WHERE conversation_id = ?", (conversation_id,)
+    ).fetchone()[0]
+
+def _append_cached_message(conversation_id: str, previous_id: Optional[int], message_id: int,
+                           role: str, content: str, metadata: Optional[str] = None):
+    """Write-through for a committed message; other workers drop their copy"""
+    new_messages = _to_messages(role, content, metadata)
+
+    def append(entry):
+        last_id, messages = entry
+        if previous_id is not None and last_id != previous_id:
+            return None  # Cached copy missed another worker's write - reload on next read
+        messages.extend(new_messages)
+        return (message_id, messages)
+
+    history_cache.update(conversation_id, append)
+    history_cache.invalidate_peers(conversation_id)
+
+def save_message(conversation_id: str, role: str, content: str, metadata: Optional[Dict] = None):
+    """Save a message to database (appended to the cached history once committed)"""
+    metadata_json = json.dumps(metadata, separators=(",", ":")) if metadata else None
+    with transaction(immediate=True, shard=conversation_id) as conn:
+        # Without cross-worker invalidation, only append if nobody else wrote since we cached
+        previous_id = None if history_cache.distributed else _last_message_id(conn, conversation_id)
+        message_id = conn.execute('''
+            INSERT INTO messages (conversation_id, role, content, metadata)
+            VALUES (?, ?, ?, ?)
+            RETURNING id
+        ''', (conversation_id, role, content, metadata_json)).fetchone()[0]
+        after_commit(_append_cached_message, conversation_id, previous_id, message_id,
+                     role, content, metadata_json)
 
 def get_conversation_history(conversation_id: str) -> List[BaseMessage]:
-    """Get conversation history"""
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    messages = []
-    
-    cursor.execute('''
-        SELECT role, content FROM messages
+    """Get conversation history (from history_cache when warm; callers get their own list)"""
+    conn = get_connection(shard=conversation_id)
+    cached = history_cache.get(conversation_id)
+    if cached is not None:
+        last_id, messages = cached
+        if history_cache.distributed or _last_message_id(conn, conversation_id) == last_id:
+            return list(messages)
+        history_cache.discard(conversation_id)
+
+    stamp = history_cache.stamp(conversation_id)
+    query = '''
+        SELECT id, role, content, metadata FROM messages
         WHERE conversation_id = ?
-        ORDER BY timestamp ASC
-    ''', (conversation_id,))
-    
-    for role, content in cursor.fetchall():
-        if role == "user":
-            messages.append(HumanMessage(content=content))
-        elif role == "assistant":
-            messages.append(AIMessage(content=content))
-    
-    conn.close()
-    return messages
+        ORDER BY timestamp ASC, id ASC
+    '''
+    rows = conn.execute(query, (conversation_id,)).fetchall()
+    if not rows and rehydrate_archived(conversation_id):
+        rows = conn.execute(query, (conversation_id,)).fetchall()
+
+    messages = []
+    for _, role, content, metadata in rows:
+        messages.extend(_to_messages(role, content, metadata))
+
+    history_cache.set(conversation_id, (rows[-1][0] if rows else None, messages), if_stamp=stamp)
+    return list(messages)
 
 def save_booking(booking_reference: str, user_id: str, booking_type: str, booking_data: Dict):
-    """Save a real booking to database"""
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    
-    import json
-    cursor.execute('''
-        INSERT INTO bookings (booking_reference, user_id, booking_type, booking_data, status)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (booking_reference, user_id, booking_type, json.dumps(booking_data), "CONFIRMED"))
-    conn.commit()
-    conn.close()
+    """Save a real booking to database (idempotent: a reference is stored once)"""
+    with transaction(immediate=True) as conn:
+        conn.execute('''
+            INSERT INTO bookings (booking_reference, user_id, booking_type, booking_data, status)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (booking_reference) DO NOTHING
+        ''', (booking_reference, user_id, booking_type, json.dumps(booking_data), "CONFIRMED"))
+
+def record_turn_analytics(user_id: str, conversation_id: str, tool_exchange: Optional[List[Dict]],
+                          booking_reference: Optional[str], booking_type: str):
+    """Analytics events of one chat turn - chat, searches by route, bookings (folded by rollups.py)"""
+    log_analytics_event(user_id, "chat_turn", {"conversation_id": conversation_id})
+    for item in tool_exchange or []:
+        for call in item.get("tool_calls", []):
+            args = call.get("args") or {}
+            if call.get("name") == "search_flights":
+                origin, destination = (str(args.get(key, "")).strip().upper() for key in ("origin", "destination"))
+                log_analytics_event(user_id, SEARCH_EVENT, {"type": "flight", "route": f"{origin}-{destination}"})
+            elif call.get("name") == "search_hotels":
+                log_analytics_event(user_id, SEARCH_EVENT,
+                                    {"type": "hotel", "route": str(args.get("location", "")).strip().upper()})
+    if booking_reference:
+        log_analytics_event(user_id, BOOKING_EVENT, {"type": booking_type, "booking_reference": booking_reference})
+
+def persist_chat_turn(conversation_id: str, current_user: Dict, message: str, response: str,
+                      booking_reference: Optional[str] = None, tool_exchange: Optional[List[Dict]] = None):
+    """
+    Write what a chat turn produced: both messages in one transaction on the
+    conversation's database, then the booking, if any, on the main database.
+    With SQLITE_SHARDS > 1 those are two databases and the pair is not
+    atomic - a crash in between leaves the messages without their booking,
+    never a booking nobody was told about. save_booking is idempotent, so
+    writing it again is safe.
+    """
+    booking_type = "flight" if "flight" in message.lower() else "hotel"
+    with transaction(immediate=True, shard=conversation_id):
+        save_message(conversation_id, "user", message)
+        # Tool calls and their (compacted) results are replayed on follow-up turns
+        save_message(conversation_id, "assistant", response,
+                     {"tool_exchange": tool_exchange} if tool_exchange else None)
+
+    if booking_reference:
+        # Save the mock booking once the conversation that announced it is committed
+        save_booking(
+            booking_reference,
+            current_user["id"],
+            booking_type,
+            {"message": message, "response": response}
+        )
+
+    # Every user, anonymous included, counts towards the dashboards (queued)
+    try:
+        record_turn_analytics(current_user["id"], conversation_id, tool_exchange, booking_reference, booking_type)
+    except Exception:
+        pass  # Non-critical
+
+    # Log and learn from interaction if authenticated (queued, written in batches)
+    if current_user.get("is_authenticated"):
+        try:
+            log_user_interaction(
+                current_user["id"],
+                "chat_message",
+                {"message": message, "conversation_id": conversation_id}
+            )
+            learn_from_user_behavior(
+                current_user["id"],
+                {"interaction": "chat", "topic": "travel"}
+            )
+        except Exception:
+            pass  # Non-critical
 
 # Main chat endpoint - INTELLIGENT PROCESSING ONLY
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(
     payload: ChatRequest,
     request: Request,
+    http_response: Response,
     current_user: Dict = Depends(get_current_user)
 ):
     """
@@ -301,35 +406,41 @@ async def chat_endpoint(
             detail="OpenAI API key not configured - required for intelligent processing"
         )
     
-    # Get or create conversation
+    # Per-client and per-IP budgets of requests, LLM tokens and provider calls (429 when spent)
+    subject, ip = subject_of(current_user), client_ip(request)
+    if rate_limiter.enabled:
+        decision = await run_limiter(rate_limiter.acquire, subject, ip)
+        if not decision.allowed:
+            raise too_many_requests(decision)
+        http_response.headers.update(rate_limit_headers(decision))
+    
+    # A guest's user row is created once a request brings its id back: a client
+    # that drops the id (crawler, no cookies) would otherwise add a row per request.
+    # Until then its conversation has no owner row (retention purges those too).
+    if not current_user.get("is_authenticated") and not current_user.get("is_new_guest") \
+            and persisted_guests.get(current_user["id"]) is None:
+        await run_db(ensure_anonymous_user, current_user["id"], request)
+    
+    # Get or create conversation (a new conversation has no history to read)
     conversation_id = payload.conversation_id
     if not conversation_id:
-        conversation_id = create_conversation(current_user["id"])
-    
-    # Get conversation history
-    history = get_conversation_history(conversation_id)
-    
-    # Save user message
-    save_message(conversation_id, "user", payload.message)
-    
-    # Log interaction if authenticated
-    if current_user.get("is_authenticated"):
-        try:
-            log_user_interaction(
-                current_user["id"],
-                "chat_message",
-                {"message": payload.message, "conversation_id": conversation_id}
-            )
-        except:
-            pass  # Non-critical
+        conversation_id = await run_db(create_conversation, current_user["id"])
+        history = []
+    else:
+        history = await run_db(get_conversation_history, conversation_id)
     
     try:
         # Process with INTELLIGENT workflow - NO HARDCODING
-        response = process_travel_request(
-            message=payload.message,
-            openai_api_key=os.getenv("OPENAI_API_KEY"),
-            history=history
-        )
+        with metering() as usage:
+            try:
+                # Off the event loop, behind the admission gate (503 when saturated, 504 past the deadline)
+                response, tool_messages = await chat_gate.run(
+                    process_travel_turn, payload.message, os.getenv("OPENAI_API_KEY"), history
+                )
+            finally:
+                # What the turn consumed, also when it failed halfway
+                if rate_limiter.enabled:
+                    await run_limiter(rate_limiter.charge, subject, ip, usage)
         
         # Check if response contains booking information
         booking_reference = None
@@ -343,28 +454,13 @@ async def chat_endpoint(
             if ref_match:
                 booking_reference = ref_match.group(1)
                 action_taken = "BOOKING_CONFIRMED"
-                
-                # Save the mock booking
-                save_booking(
-                    booking_reference,
-                    current_user["id"],
-                    "flight" if "flight" in payload.message.lower() else "hotel",
-                    {"message": payload.message, "response": response}
-                )
-        
-        # Save assistant response
-        save_message(conversation_id, "assistant", response)
-        
-        # Learn from interaction if authenticated
-        if current_user.get("is_authenticated"):
-            try:
-                learn_from_user_behavior(
-                    current_user["id"],
-                    {"interaction": "chat", "topic": "travel"}
-                )
-            except:
-                pass  # Non-critical
         
+        # All of the turn's writes commit together
+        await run_db(
+            persist_chat_turn, conversation_id, current_user, payload.message, response, booking_reference,
+            serialize_tool_exchange(tool_messages)
+        )
+
         return ChatResponse(
             conversation_id=conversation_id,
             response=response,
@@ -372,10 +468,13 @@ async def chat_endpoint(
             booking_reference=booking_reference
         )
         
+    except HTTPException:
+        # Shed or timed out: not processed, nothing to store
+        raise
     except Exception as e:
         logger.error(f"Chat processing error: {str(e)}")
         error_response = f"System error: {str(e)}"
-        save_message(conversation_id, "assistant", error_response)
+        await run_db(persist_chat_turn, conversation_id, current_user, payload.message, error_response)
         
         return ChatResponse(
             conversation_id=conversation_id,
@@ -387,14 +486,14 @@ async def chat_endpoint(
 async def register_user(user_data: UserCreate, request: Request):
     """Register new user with proper authentication"""
     try:
-        # Create the user
-        user = create_user(user_data)
+        # Create the user (bcrypt on its own bounded executor, 503 when saturated)
+        password_hash = await run_hashing(hash_password, user_data.password)
+        user = await run_db(create_user, user_data, password_hash)
         
-        # Create access token
-        access_token = create_access_token(data={"sub": user.id})
-        
-        # Create session
-        session_token = create_session(user.id, request)
+        # Create session (Redis) and an access token bound to it
+        session_id = await run_db(create_session, user.id, request)
+        access_token = create_access_token(data={"sub": user.id, "sid": session_id} if session_id
+                                           else {"sub": user.id})
         
         # Log registration event
         try:
@@ -426,17 +525,21 @@ async def register_user(user_data: UserCreate, request: Request):
 async def login_user(user_login: UserLogin, request: Request):
     """Login user with email and password"""
     try:
-        # Authenticate user
-        user = authenticate_user(user_login.email, user_login.password)
+        # Authenticate user: lookup on the DB executor, bcrypt on its own bounded executor
+        user_row = await run_db(get_login_row, user_login.email)
+        valid, new_hash = False, None
+        if user_row and user_row[5]:
+            valid, new_hash = await run_hashing(verify_password_hash, user_login.password, user_row[5])
         
-        if not user:
+        if not valid:
             raise HTTPException(status_code=401, detail="Invalid email or password")
+        # Re-hashed when BCRYPT_ROUNDS changed since the password was stored
+        user = await run_db(record_login, user_row, new_hash)
         
-        # Create access token
-        access_token = create_access_token(data={"sub": user.id})
-        
-        # Create session
-        session_token = create_session(user.id, request)
+        # Create session (Redis) and an access token bound to it
+        session_id = await run_db(create_session, user.id, request)
+        access_token = create_access_token(data={"sub": user.id, "sid": session_id} if session_id
+                                           else {"sub": user.id})
         
         # Log login event
         try:
@@ -468,56 +571,122 @@ async def get_current_user_info(current_user: Dict = Depends(get_current_user)):
     """Get current user information"""
     return current_user
 
+@app.post("/auth/deactivate", response_model=dict)
+async def deactivate_account(current_user: Dict = Depends(get_current_user)):
+    """Deactivate the current account; its tokens are rejected from the next request on"""
+    if not current_user.get("is_authenticated"):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    await run_db(deactivate_user, current_user["id"])
+    return {"message": "Account deactivated"}
+
+def bearer_claims(authorization: Optional[str]) -> Optional[Tuple[str, Optional[str]]]:
+    """(user_id, session id) of the Authorization header's token, None when absent or invalid"""
+    if not authorization or not authorization.startswith("Bearer "):
+        return None
+    return verify_token(authorization.split(" ")[1])
+
 @app.post("/auth/logout", response_model=dict)
-async def logout_user(request: Request):
-    """Logout current user"""
-    # In a real implementation, you'd invalidate the session here
+async def logout_user(authorization: Optional[str] = Header(None)):
+    """Logout current user: the token's session is revoked in every worker"""
+    claims = bearer_claims(authorization)
+    if claims and claims[1]:
+        try:
+            await run_db(sessions.revoke, claims[1], claims[0])
+        except RedisError:
+            raise HTTPException(status_code=503, detail="Session store unavailable, try again")
     return {"message": "Logged out successfully"}
-@app.get("/bookings")
-async def get_user_bookings(user_id: str = "user"):
-    """Get all bookings for a user"""
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT booking_reference, booking_type, booking_data, status, created_at
+
+@app.get("/auth/sessions", response_model=dict)
+async def list_sessions(current_user: Dict = Depends(get_current_user),
+                        authorization: Optional[str] = Header(None)):
+    """Live sessions of the current user (the one making the request is marked current)"""
+    if not current_user.get("is_authenticated"):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    try:
+        live = await run_db(sessions.list, current_user["id"])
+    except RedisError:
+        raise HTTPException(status_code=503, detail="Session store unavailable, try again")
+    claims = bearer_claims(authorization)
+    for session in live:
+        session["current"] = bool(claims) and session["session_id"] == claims[1]
+    return {"sessions": live}
+
+@app.delete("/auth/sessions/{session_id}", response_model=dict)
+async def revoke_session(session_id: str, current_user: Dict = Depends(get_current_user)):
+    """Sign one of the current user's sessions out (another device, say)"""
+    if not current_user.get("is_authenticated"):
+        raise HTTPException(status_code=401, detail="Authentication required")
+    try:
+        revoked = await run_db(sessions.revoke, session_id, current_user["id"])
+    except RedisError:
+        raise HTTPException(status_code=503, detail="Session store unavailable, try again")
+    if not revoked:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"message": "Session revoked"}
+# Projectable fields -> column; id and the sort column are always read for the cursor
+BOOKING_FIELDS = {
+    "booking_reference": "booking_reference",
+    "type": "booking_type",
+    "details": "booking_data",
+    "status": "status",
+    "created_at": "created_at",
+}
+MESSAGE_FIELDS = {"role": "role", "content": "content", "timestamp": "timestamp"}
+CONVERSATION_FIELDS = {"created_at": "created_at", "updated_at": "updated_at"}
+
+def fetch_user_bookings(user_id: str, limit: int, after: Optional[tuple] = None,
+                        fields: Optional[set] = None) -> Tuple[List[Dict], Optional[str]]:
+    """One page of a user's bookings, newest first, plus the cursor of the next page"""
+    names = [name for name in BOOKING_FIELDS if fields is None or name in fields]
+    columns = ", ".join(["id", "created_at"] + [BOOKING_FIELDS[name] for name in names])
+    where, params = "user_id = ?", [user_id]
+    if after:
+        where += " AND (created_at, id) < (?, ?)"
+        params += list(after)
+    rows = get_connection().execute(f'''
+        SELECT {columns}
         FROM bookings
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-    ''', (user_id,))
+        WHERE {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
     
     bookings = []
-    for ref, type_, data, status, created in cursor.fetchall():
-        import json
-        bookings.append({
-            "booking_reference": ref,
-            "type": type_,
-            "details": json.loads(data),
-            "status": status,
-            "created_at": created
-        })
-    
-    conn.close()
-    return {"bookings": bookings}
+    for row in rows[:limit]:
+        booking = dict(zip(names, row[2:]))
+        if "details" in booking:
+            booking["details"] = RawJSON(booking["details"])   # stored by json.dumps - no parse needed
+        bookings.append(booking)
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return bookings, next_cursor
+
+def fetch_booking(booking_reference: str) -> Optional[tuple]:
+    """Load one booking row by reference"""
+    return get_connection().execute('''
+        SELECT * FROM bookings WHERE booking_reference = ?
+    ''', (booking_reference,)).fetchone()
+
+@app.get("/bookings")
+async def get_user_bookings(user_id: str = "user", limit: Optional[int] = None,
+                            cursor: Optional[str] = None, fields: Optional[str] = None):
+    """Get a user's bookings, newest first; all of them unless limit or cursor asks for a page"""
+    after = decode_cursor(cursor)
+    wanted = parse_fields(fields, BOOKING_FIELDS)
+    if limit is None and cursor is None:
+        bookings, next_cursor = await run_db(all_pages, fetch_user_bookings, user_id, wanted), None
+    else:
+        bookings, next_cursor = await run_db(fetch_user_bookings, user_id, clamp_limit(limit), after, wanted)
+    return stream_page("bookings", bookings, next_cursor=next_cursor)
 
 # Get specific booking
 @app.get("/bookings/{booking_reference}")
 async def get_booking(booking_reference: str):
     """Get details of a specific booking"""
-    conn = sqlite3.connect('travel_assistant.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM bookings WHERE booking_reference = ?
-    ''', (booking_reference,))
-    
-    result = cursor.fetchone()
-    conn.close()
+    result = await run_db(fetch_booking, booking_reference)
     
     if not result:
         raise HTTPException(status_code=404, detail="Booking not found")
     
-    import json
     return {
         "booking_reference": result[1],
         "user_id": result[2],
@@ -549,50 +718,150 @@ async def health_check():
             "cancel_refund": True,
             "create_itineraries": True
         },
+        "storage_backend": storage_dialect(),
+        "conversation_shards": shard_count(),
         "timestamp": datetime.now().isoformat()
     }
 
+# Internal pipeline metrics
+@app.get("/metrics")
+async def metrics():
+    """Background pipeline, chat admission, password hashing, rate limiting, cache and request-coalescing counters"""
+    return {
+        "write_behind": write_behind.stats(),
+        "profile_aggregator": profile_aggregator.pending(),
+        "retention": retention.stats(),
+        "chat_admission": chat_gate.stats(),
+        "password_hashing": password_hashing_stats(),
+        "rate_limit": rate_limiter.stats(),
+        "rollups": rollups.stats(),
+        "caches": cache_stats(),
+        "singleflight": singleflight_stats(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def get_conversation_owner(conversation_id: str) -> Optional[str]:
+    """user_id that owns a conversation, None when unknown"""
+    result = get_connection(shard=conversation_id).execute('''
+        SELECT user_id FROM conversations WHERE id = ?
+    ''', (conversation_id,)).fetchone()
+    return result[0] if result else None
+
+def fetch_conversation_messages(conversation_id: str, limit: int, after: Optional[tuple] = None,
+                                fields: Optional[set] = None) -> Tuple[List[Dict], Optional[str]]:
+    """One page of a conversation's messages, oldest first, plus the cursor of the next page"""
+    names = [name for name in MESSAGE_FIELDS if fields is None or name in fields]
+    columns = ", ".join(["id", "timestamp"] + [MESSAGE_FIELDS[name] for name in names])
+    where, params = "conversation_id = ?", [conversation_id]
+    if after:
+        where += " AND (timestamp, id) > (?, ?)"
+        params += list(after)
+    query = f'''
+        SELECT {columns}
+        FROM messages
+        WHERE {where}
+        ORDER BY timestamp ASC, id ASC
+        LIMIT ?
+    '''
+    conn = get_connection(shard=conversation_id)
+    rows = conn.execute(query, params + [limit + 1]).fetchall()
+    if not rows and rehydrate_archived(conversation_id):
+        rows = conn.execute(query, params + [limit + 1]).fetchall()
+    
+    messages = [dict(zip(names, row[2:])) for row in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return messages, next_cursor
+
+def _conversations_page(conn, user_id: str, limit: int, after: Optional[tuple]) -> List[tuple]:
+    where, params = "user_id = ?", [user_id]
+    if after:
+        where += " AND (created_at, id) < (?, ?)"
+        params += list(after)
+    return conn.execute(f'''
+        SELECT id, created_at, updated_at
+        FROM conversations
+        WHERE {where}
+        ORDER BY created_at DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+
+def fetch_user_conversations(user_id: str, limit: int, after: Optional[tuple] = None,
+                             fields: Optional[set] = None) -> Tuple[List[Dict], Optional[str]]:
+    """One page of a user's conversations, newest first - every shard is queried in parallel and merged"""
+    names = [name for name in CONVERSATION_FIELDS if fields is None or name in fields]
+    rows = [row for shard_rows in fan_out(_conversations_page, user_id, limit, after) for row in shard_rows]
+    rows.sort(key=lambda row: (row[1], row[0]), reverse=True)
+
+    conversations = []
+    for row in rows[:limit]:
+        conversation = {"conversation_id": row[0]}
+        conversation.update((name, row[1 if name == "created_at" else 2]) for name in names)
+        conversations.append(conversation)
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return conversations, next_cursor
+
+# List the current user's conversations
+@app.get("/conversations")
+async def list_conversations(limit: Optional[int] = None, cursor: Optional[str] = None,
+                             fields: Optional[str] = None, current_user: Dict = Depends(get_current_user)):
+    """Get the current user's conversations, newest first; follow next_cursor for older pages"""
+    after = decode_cursor(cursor)
+    wanted = parse_fields(fields, CONVERSATION_FIELDS)
+    conversations, next_cursor = await run_db(
+        fetch_user_conversations, current_user["id"], clamp_limit(limit), after, wanted
+    )
+    return stream_page("conversations", conversations, next_cursor=next_cursor)
+
+# Full-text search over the current user's conversations
+@app.get("/conversations/search")
+async def search_conversations(q: str, limit: Optional[int] = None,
+                               current_user: Dict = Depends(get_current_user)):
+    """Best matching messages of the current user's conversations, with highlighted snippets"""
+    results = await run_db(search_messages, current_user["id"], q, clamp_limit(limit))
+    return {"query": q, "results": results}
+
 # Conversation history
 @app.get("/conversations/{conversation_id}/history")
 async def get_conversation_history_endpoint(
     conversation_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
     current_user: Dict = Depends(get_current_user)
 ):
-    """Get conversation history"""
-    conn = sqlite3.connect('travel_chatbot.db')
-    cursor = conn.cursor()
-    
+    """Get conversation history, oldest first; all of it unless limit or cursor asks for a page"""
+    after = decode_cursor(cursor)
+    wanted = parse_fields(fields, MESSAGE_FIELDS)
     # Verify user owns conversation (skip for anonymous users)
     if current_user.get("is_authenticated"):
-        cursor.execute('''
-            SELECT user_id FROM conversations WHERE id = ?
-        ''', (conversation_id,))
-        result = cursor.fetchone()
-        
-        if result and result[0] != current_user["id"]:
-            conn.close()
+        owner = await run_db(get_conversation_owner, conversation_id)
+        if owner and owner != current_user["id"]:
             raise HTTPException(status_code=403, detail="Access denied")
     
-    cursor.execute('''
-        SELECT role, content, timestamp
-        FROM messages
-        WHERE conversation_id = ?
-        ORDER BY timestamp ASC
-    ''', (conversation_id,))
-    
-    messages = []
-    for role, content, timestamp in cursor.fetchall():
-        messages.append({
-            "role": role,
-            "content": content,
-            "timestamp": timestamp
-        })
-    
-    conn.close()
-    return {
-        "conversation_id": conversation_id,
-        "messages": messages
-    }
+    if limit is None and cursor is None:
+        messages, next_cursor = await run_db(all_pages, fetch_conversation_messages, conversation_id, wanted), None
+    else:
+        messages, next_cursor = await run_db(
+            fetch_conversation_messages, conversation_id, clamp_limit(limit), after, wanted
+        )
+    return stream_page("messages", messages, conversation_id=conversation_id, next_cursor=next_cursor)
+
+# Streaming export of raw tables (operators; needs EXPORT_API_TOKEN)
+@app.get("/export/{table}")
+async def export_table(table: str, since: Optional[str] = None, until: Optional[str] = None,
+                       format: str = "ndjson", x_export_token: Optional[str] = Header(None)):
+    """Stream user_analytics, user_interactions, bookings or messages as NDJSON or columnar batches"""
+    return export_response(table, since, until, format, x_export_token)
+
+# Dashboard aggregates (operators; needs EXPORT_API_TOKEN) - reads the rollup tables only
+@app.get("/analytics/summary")
+async def get_analytics_summary(days: int = 7, granularity: str = "day",
+                                x_export_token: Optional[str] = Header(None)):
+    """Active users, searches per route and booking conversion per day (or hour)"""
+    check_operator_token(x_export_token)
+    if not 1 <= days <= 366 or granularity not in ("day", "hour"):
+        raise HTTPException(status_code=400, detail="days must be 1-366 and granularity day or hour")
+    return await run_db(analytics_summary, days, granularity)
 
 # List available tools (for debugging)
 @app.get("/tools")
@@ -632,7 +901,7 @@ async def get_user_profile(current_user: Dict = Depends(get_current_user)):
     if not current_user.get("is_authenticated"):
         raise HTTPException(status_code=401, detail="Authentication required")
     
-    learning_profile = get_user_learning_profile(current_user["id"])
+    learning_profile = await run_db(get_user_learning_profile, current_user["id"])
     
     return {
         "user": current_user,
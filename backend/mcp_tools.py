@@ -13,6 +13,13 @@ import random
 import string
 import re
 
+try:
+    from backend.singleflight import SingleFlight, make_key
+    from backend.usage import record_llm_tokens, record_upstream_call
+except ImportError:
+    from singleflight import SingleFlight, make_key
+    from usage import record_llm_tokens, record_upstream_call
+
 logger = logging.getLogger(__name__)
 
 # Initialize real API clients
@@ -21,8 +28,15 @@ AMADEUS_CLIENT_SECRET = os.getenv("AMADEUS_CLIENT_SECRET")
 RAPID_API_KEY = os.getenv("RAPID_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Provider endpoints - point PROVIDER_STUB_URL at fake_providers.py to load-test offline
+PROVIDER_STUB_URL = os.getenv("PROVIDER_STUB_URL", "").rstrip("/")
+AMADEUS_BASE_URL = os.getenv("AMADEUS_BASE_URL", PROVIDER_STUB_URL or "https://test.api.amadeus.com").rstrip("/")
+BOOKING_API_HOST = os.getenv("BOOKING_API_HOST", "booking-com15.p.rapidapi.com")
+BOOKING_BASE_URL = os.getenv("BOOKING_BASE_URL", PROVIDER_STUB_URL or f"https://{BOOKING_API_HOST}").rstrip("/")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", f"{PROVIDER_STUB_URL}/v1" if PROVIDER_STUB_URL else "") or None
+
 # Initialize OpenAI for intelligent processing
-openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL) if OPENAI_API_KEY else None
 print("DEBUG  ‣ OPENAI_API_KEY starts with:", OPENAI_API_KEY[:10] if OPENAI_API_KEY else "None")
 
 
@@ -43,6 +57,22 @@ def _translate_flight_query(
     if not openai_client:
         return origin[:3].upper(), destination[:3].upper(), dep_text, ret_text
 
+    key = make_key(
+        datetime.utcnow().date().isoformat(),
+        origin.strip().lower(), destination.strip().lower(),
+        dep_text.strip().lower(), (ret_text or "").strip().lower()
+    )
+    return _translate_flight.do(
+        key, _translate_flight_query_upstream, origin, destination, dep_text, ret_text
+    )
+
+
+def _translate_flight_query_upstream(
+    origin: str,
+    destination: str,
+    dep_text: str,
+    ret_text: Optional[str] = None
+) -> tuple[str, str, str, Optional[str]]:
     today = datetime.utcnow().date()
     prompt = f"""
 Assume today's date is {today.isoformat()}.
@@ -65,6 +95,7 @@ Return text      : {ret_text or ""}
         max_tokens=40,
         messages=[{"role": "user", "content": prompt.strip()}]
     )
+    record_llm_tokens(rsp.usage)
 
     raw = rsp.choices[0].message.content.strip()
     if raw.startswith("```"):
@@ -116,6 +147,7 @@ def _validate_iata(code: str) -> str:
         raise ValueError("Amadeus credentials missing")
 
     url = f"{amadeus_api.base_url}/v1/reference-data/locations"
+    record_upstream_call()
     resp = requests.get(
         url,
         params={"keyword": code, "subType": "AIRPORT"},
@@ -137,8 +169,8 @@ class AmadeusAPI:
     def __init__(self):
         self.token = None
         self.token_expiry = 0
-        self.base_url = "https://test.api.amadeus.com"
-        self.token_url = "https://test.api.amadeus.com/v1/security/oauth2/token"
+        self.base_url = AMADEUS_BASE_URL
+        self.token_url = f"{AMADEUS_BASE_URL}/v1/security/oauth2/token"
     
     def get_token(self) -> Optional[str]:
         import time
@@ -146,6 +178,14 @@ class AmadeusAPI:
         if self.token and time.time() < self.token_expiry:
             return self.token
 
+        # Concurrent cache misses share one token request
+        return _amadeus_token_flight.do("token", self._fetch_token)
+
+    def _fetch_token(self) -> Optional[str]:
+        import time
+        if self.token and time.time() < self.token_expiry:
+            return self.token
+
         if not AMADEUS_CLIENT_ID or not AMADEUS_CLIENT_SECRET:
             logger.error("Amadeus credentials not configured in ENV")
             return None
@@ -185,7 +225,25 @@ class AmadeusAPI:
         1) Normalize free-form → IATA + ISO dates via GPT
         2) Validate IATA codes via autocomplete
         3) Call Amadeus flight-offers
+        Identical concurrent searches share a single upstream call.
         """
+        key = make_key(
+            origin.strip().lower(), destination.strip().lower(),
+            departure_date.strip(), (return_date or "").strip(), adults
+        )
+        return _flight_search_flight.do(
+            key, self._search_flights_upstream,
+            origin, destination, departure_date, return_date, adults
+        )
+
+    def _search_flights_upstream(
+        self,
+        origin: str,
+        destination: str,
+        departure_date: str,
+        return_date: Optional[str] = None,
+        adults: int = 1
+    ) -> Dict:
         # ── 1) normalize via GPT ─────────────────────────────────
         logging.debug(f"🔄 Translating query: {origin}, {destination}, {departure_date}, {return_date}")
         origin, destination, departure_date, return_date = _translate_flight_query(
@@ -220,6 +278,7 @@ class AmadeusAPI:
 
         endpoint = f"{self.base_url}/v2/shopping/flight-offers"
         headers = {"Authorization": f"Bearer {token}"}
+        record_upstream_call()
         resp = requests.get(endpoint, headers=headers, params=params, timeout=15)
 
         if resp.status_code != 200:
@@ -230,9 +289,21 @@ class AmadeusAPI:
             
 class BookingAPI:
     """Real hotel search using Booking.com via RapidAPI"""
-    
+
+    def __init__(self):
+        self.base_url = BOOKING_BASE_URL
+        self.host = BOOKING_API_HOST
+
     def search_hotels_real(self, location: str, check_in: str, check_out: str,
                            guests: int = 1, rooms: int = 1) -> Dict:
+        """Identical concurrent hotel searches share a single upstream call"""
+        key = make_key(location.strip().lower(), check_in.strip(), check_out.strip(), guests, rooms)
+        return _hotel_search_flight.do(
+            key, self._search_hotels_upstream, location, check_in, check_out, guests, rooms
+        )
+
+    def _search_hotels_upstream(self, location: str, check_in: str, check_out: str,
+                                guests: int = 1, rooms: int = 1) -> Dict:
 
 
         check_in  = _translate_flight_query("","",check_in)[2]   # reuse date normaliser
@@ -244,12 +315,13 @@ class BookingAPI:
         
         try:
             # First, search for destination
-            dest_url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/searchDestination"
+            dest_url = f"{self.base_url}/api/v1/hotels/searchDestination"
             headers = {
                 'x-rapidapi-key': RAPID_API_KEY,
-                'x-rapidapi-host': "booking-com15.p.rapidapi.com"
+                'x-rapidapi-host': self.host
             }
             
+            record_upstream_call()
             dest_response = requests.get(
                 dest_url,
                 headers=headers,
@@ -267,8 +339,9 @@ class BookingAPI:
             dest_id = dest_data["data"][0]["dest_id"]
             
             # Search hotels
-            search_url = "https://booking-com15.p.rapidapi.com/api/v1/hotels/searchHotels"
+            search_url = f"{self.base_url}/api/v1/hotels/searchHotels"
             
+            record_upstream_call()
             search_response = requests.get(
                 search_url,
                 headers=headers,
@@ -306,7 +379,13 @@ def get_airport_code_intelligent(city_name: str) -> str:
     """Use LLM to intelligently convert city to airport code"""
     if not openai_client:
         return city_name[:3].upper()
-    
+
+    return _airport_code_flight.do(
+        make_key(city_name.strip().lower()), _airport_code_upstream, city_name
+    )
+
+
+def _airport_code_upstream(city_name: str) -> str:
     try:
         response = openai_client.chat.completions.create(
             model="gpt-4o-mini",
@@ -320,6 +399,7 @@ def get_airport_code_intelligent(city_name: str) -> str:
             max_tokens=10,
             temperature=0
         )
+        record_llm_tokens(response.usage)
         code = response.choices[0].message.content.strip().upper()
         if len(code) == 3:
             return code
@@ -384,6 +464,14 @@ BOOKING_HOLD_EXPIRY_SEC = 7 * 24 * 3600          # 1 week
 rds = redis.Redis.from_url(REDIS_URL, decode_responses=True)
 log = logging.getLogger(__name__)
 
+# Singleflight groups for upstream calls (see singleflight.py).
+# Redis is only consulted when SINGLEFLIGHT_REDIS is enabled.
+_translate_flight      = SingleFlight("openai.translate_flight_query", lambda: rds, decode=tuple)
+_airport_code_flight   = SingleFlight("openai.airport_code", lambda: rds)
+_amadeus_token_flight  = SingleFlight("amadeus.token")
+_flight_search_flight  = SingleFlight("amadeus.flight_offers", lambda: rds)
+_hotel_search_flight   = SingleFlight("booking.search_hotels", lambda: rds)
+
 
 def _rand_ref(prefix: str) -> str:
     return f"{prefix}{''.join(random.choices(string.ascii_uppercase + string.digits, k=6))}"
@@ -0,0 +1,525 @@
+# migrations.py - VERSIONED SCHEMA MIGRATIONS
+"""
+Schema changes are numbered and run exactly once per database.
+
+schema_migrations records what has been applied; migrate() applies the
+rest in order, each inside its own write transaction, re-checking the
+version under the lock so several workers can start at the same time.
+Add a new (version, name, function) entry to MIGRATIONS - never edit one
+that has shipped.
+
+The same migrations run on SQLite and PostgreSQL: storage translates the
+SQLite DDL, and on PostgreSQL an advisory lock stands in for BEGIN
+IMMEDIATE so replicas starting together apply each migration once.
+
+    python migrations.py                 # apply pending migrations
+    python migrations.py --check-plans   # verify hot queries use indexes
+    python migrations.py --reshard [N]   # move conversations to their shard after
+                                         # changing SQLITE_SHARDS (N = previous count)
+
+With SQLITE_SHARDS > 1 every conversation shard file is migrated too, so
+all files share one schema (tables unused on a file simply stay empty).
+"""
+
+import sys
+import logging
+from typing import Callable, List, Optional, Tuple
+
+try:
+    from backend.storage import transaction, get_connection, dialect, shard_of, all_databases
+    from backend.archive import restore_messages
+except ImportError:
+    from storage import transaction, get_connection, dialect, shard_of, all_databases
+    from archive import restore_messages
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_xact_lock key shared by every migrating process
+MIGRATION_LOCK_ID = 7318004
+
+
+def _column_exists(conn, table: str, column: str) -> bool:
+    if dialect() == "postgres":
+        return conn.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = ? AND column_name = ?",
+            (table, column)).fetchone() is not None
+    return any(row[1] == column for row in conn.execute(f"PRAGMA table_info({table})"))
+
+
+def _lock(conn):
+    """Serialize migrating processes (SQLite already did at BEGIN IMMEDIATE)"""
+    if dialect() == "postgres":
+        conn.execute("SELECT pg_advisory_xact_lock(?)", (MIGRATION_LOCK_ID,))
+
+
+def _baseline_schema(conn):
+    """Tables previously created by init_db() and init_auth_tables()"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            first_name TEXT,
+            last_name TEXT,
+            email TEXT UNIQUE,
+            nationality TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            password_hash TEXT,
+            is_demo_user BOOLEAN DEFAULT FALSE,
+            last_login TIMESTAMP,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    ''')
+
+    # Databases created before the auth columns existed
+    for column, ddl in (("password_hash", "TEXT"),
+                        ("is_demo_user", "BOOLEAN DEFAULT FALSE"),
+                        ("last_login", "TIMESTAMP"),
+                        ("is_active", "BOOLEAN DEFAULT TRUE")):
+        if not _column_exists(conn, "users", column):
+            conn.execute(f"ALTER TABLE users ADD COLUMN {column} {ddl}")
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            metadata TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_reference TEXT UNIQUE NOT NULL,
+            user_id TEXT,
+            booking_type TEXT,
+            booking_data TEXT,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            preference_type TEXT NOT NULL,
+            preference_value TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            session_token TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ip_address TEXT,
+            user_agent TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_interactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            interaction_type TEXT,
+            interaction_data TEXT,
+            context TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            session_id TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_learning_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            data_type TEXT,
+            data_key TEXT,
+            data_value TEXT,
+            confidence_score REAL DEFAULT 0.5,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_analytics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            event_type TEXT,
+            event_data TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            session_id TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Mark existing users as demo users (used to run on every startup)
+    conn.execute("UPDATE users SET is_demo_user = TRUE WHERE password_hash IS NULL")
+
+
+def _hot_query_indexes(conn):
+    """Composite / covering indexes for the per-request queries"""
+    # get_conversation_history, history endpoint: WHERE conversation_id ORDER BY timestamp
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation_ts
+        ON messages (conversation_id, timestamp)
+    ''')
+    # /bookings: WHERE user_id ORDER BY created_at DESC
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_bookings_user_created
+        ON bookings (user_id, created_at)
+    ''')
+    # Anonymous lookup (WHERE session_token AND is_active) is already served by
+    # the UNIQUE(session_token) index - at most one row to check
+
+    # learn_from_user_behavior: WHERE user_id AND data_key -> id, confidence_score
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_learning_user_key
+        ON user_learning_data (user_id, data_key, confidence_score)
+    ''')
+    # get_user_learning_profile: WHERE user_id GROUP BY interaction_type
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_interactions_user_type
+        ON user_interactions (user_id, interaction_type)
+    ''')
+    conn.execute("ANALYZE")
+
+
+def _profile_aggregates(conn):
+    """Materialized per-user profile state for profile_aggregator upserts"""
+    # One learning row per (user, key): keep the most confident duplicate
+    conn.execute('''
+        DELETE FROM user_learning_data WHERE id NOT IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (
+                    PARTITION BY user_id, data_key ORDER BY confidence_score DESC, id DESC
+                ) AS rn
+                FROM user_learning_data
+            ) AS ranked WHERE rn = 1
+        )
+    ''')
+    conn.execute("DROP INDEX IF EXISTS idx_learning_user_key")
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_learning_user_key
+        ON user_learning_data (user_id, data_key)
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_interaction_counts (
+            user_id TEXT NOT NULL,
+            interaction_type TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, interaction_type)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT INTO user_interaction_counts (user_id, interaction_type, count)
+        SELECT user_id, interaction_type, COUNT(*)
+        FROM user_interactions
+        WHERE user_id IS NOT NULL AND interaction_type IS NOT NULL
+        GROUP BY user_id, interaction_type
+    ''')
+    conn.execute("ANALYZE")
+
+
+def _conversation_listing_index(conn):
+    """GET /conversations: WHERE user_id ORDER BY created_at DESC (on every shard)"""
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_created
+        ON conversations (user_id, created_at)
+    ''')
+    conn.execute("ANALYZE")
+
+
+def _conversation_archive(conn):
+    """Compressed message blobs of idle conversations (archive.py)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_archive (
+            conversation_id TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            payload BLOB NOT NULL,
+            last_message_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _retention_indexes(conn):
+    """Lookups of the retention engine (retention.py)"""
+    # Inactive anonymous users: partial index, registered users are never candidates
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_anonymous_created
+        ON users (created_at) WHERE password_hash IS NULL
+    ''')
+    # NOT EXISTS (recent session of this user), and stale sessions by age
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_activity
+        ON user_sessions (user_id, last_activity)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_activity
+        ON user_sessions (last_activity)
+    ''')
+    # Per-user deletes (user_interactions already has idx_interactions_user_type)
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_analytics_user
+        ON user_analytics (user_id)
+    ''')
+    conn.execute("ANALYZE")
+
+
+def _message_search_index(conn):
+    """Full-text index over messages.content (search.py), maintained on every write"""
+    if dialect() == "postgres":
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_messages_fts
+            ON messages USING GIN (to_tsvector('english', content))
+        ''')
+        return
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content, content='messages', content_rowid='id', tokenize='porter unicode61'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+        END
+    ''')
+    # Index what is already there
+    conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+
+def _analytics_rollups(conn):
+    """Hourly / daily aggregates and high-water marks of the rollup job (rollups.py)"""
+    for table in ("analytics_rollup_hourly", "analytics_rollup_daily"):
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                dimension TEXT NOT NULL,
+                value INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, metric, dimension)
+            ) WITHOUT ROWID
+        ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_daily_users (
+            day TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            PRIMARY KEY (day, kind, user_id)
+        ) WITHOUT ROWID
+    ''')
+    # Starts at 0: the first run backfills from the raw tables
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            source TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "baseline schema", _baseline_schema),
+    (2, "hot query indexes", _hot_query_indexes),
+    (3, "profile aggregates", _profile_aggregates),
+    (4, "conversation listing index", _conversation_listing_index),
+    (5, "conversation archive", _conversation_archive),
+    (6, "retention indexes", _retention_indexes),
+    (7, "message search index", _message_search_index),
+    (8, "analytics rollups", _analytics_rollups),
+]
+
+
+def _ensure_version_table(conn):
+    _lock(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _applied_versions(conn) -> set:
+    return {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+
+
+def current_version() -> int:
+    with transaction(immediate=True) as conn:
+        _ensure_version_table(conn)
+        return max(_applied_versions(conn), default=0)
+
+
+def _migrate_database(shard: Optional[int]) -> List[int]:
+    with transaction(immediate=True, shard=shard) as conn:
+        _ensure_version_table(conn)
+        if _applied_versions(conn) >= {version for version, _, _ in MIGRATIONS}:
+            return []
+
+    applied = []
+    where = "" if shard is None else f" (shard {shard})"
+    for version, name, apply in MIGRATIONS:
+        with transaction(immediate=True, shard=shard) as conn:
+            _lock(conn)
+            # Another worker may have applied it while we waited for the lock
+            if version in _applied_versions(conn):
+                continue
+            apply(conn)
+            conn.execute("INSERT INTO schema_migrations (version, name) VALUES (?, ?)", (version, name))
+        applied.append(version)
+        logger.info(f"🗄️  Applied migration {version}: {name}{where}")
+    return applied
+
+
+def migrate() -> List[int]:
+    """Apply pending migrations in order to every database; returns the versions applied"""
+    applied = set()
+    for shard in all_databases():
+        applied.update(_migrate_database(shard))
+    return sorted(applied)
+
+
+def reshard(previous_shards: int = 0) -> int:
+    """
+    Move conversations (and their messages) that are not on the shard
+    SQLITE_SHARDS routes them to: after turning sharding on, changing the
+    shard count, or turning it off (pass the previous count so its files
+    are drained). Message ids are reassigned in order on the target, so
+    archived conversations are rehydrated before they move.
+    Returns the number of conversations moved.
+    """
+    sources = all_databases() + [index for index in range(previous_shards) if index not in all_databases()]
+    migrate()
+    for source in sources:
+        if source is not None and source not in all_databases():
+            _migrate_database(source)
+    moved = 0
+    for source in sources:
+        misplaced = [row[0] for row in get_connection(source).execute("SELECT id FROM conversations")
+                     if shard_of(row[0]) != source]
+        for conversation_id in misplaced:
+            with transaction(immediate=True, shard=source) as src:
+                restore_messages(src, conversation_id)
+                conversation = src.execute(
+                    "SELECT id, user_id, created_at, updated_at FROM conversations WHERE id = ?",
+                    (conversation_id,)).fetchone()
+                messages = src.execute('''
+                    SELECT conversation_id, role, content, metadata, timestamp FROM messages
+                    WHERE conversation_id = ? ORDER BY timestamp ASC, id ASC
+                ''', (conversation_id,)).fetchall()
+                # Target commits first: a crash in between leaves a duplicate, never a loss
+                with transaction(immediate=True, shard=conversation_id) as dst:
+                    dst.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                    dst.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+                    dst.execute("INSERT INTO conversations (id, user_id, created_at, updated_at) "
+                                "VALUES (?, ?, ?, ?)", conversation)
+                    dst.executemany("INSERT INTO messages (conversation_id, role, content, metadata, timestamp) "
+                                    "VALUES (?, ?, ?, ?, ?)", messages)
+                src.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+                src.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            moved += 1
+        if misplaced:
+            logger.info(f"🔀 Moved {len(misplaced)} conversations off {'main' if source is None else f'shard {source}'}")
+    return moved
+
+
+# Hot queries and the plan fragment (normally the index name) each must show -
+# checked by test_chatbot.test_query_plans
+HOT_QUERIES = [
+    ("conversation history",
+     "SELECT id, role, content FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC, id ASC",
+     ("c",), "idx_messages_conversation_ts"),
+    ("last message id",
+     "SELECT MAX(id) FROM messages WHERE conversation_id = ?",
+     ("c",), "idx_messages_conversation_ts"),
+    ("conversation history page",
+     "SELECT id, timestamp, role, content FROM messages WHERE conversation_id = ? "
+     "AND (timestamp, id) > (?, ?) ORDER BY timestamp ASC, id ASC LIMIT ?",
+     ("c", "2024-01-01", 0, 51), "idx_messages_conversation_ts"),
+    ("user bookings page",
+     "SELECT id, created_at, booking_reference, booking_type, booking_data, status FROM bookings "
+     "WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?",
+     ("u", "2024-01-01", 0, 51), "idx_bookings_user_created"),
+    ("user conversations page",
+     "SELECT id, created_at, updated_at FROM conversations "
+     "WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?",
+     ("u", "2024-01-01", "c", 51), "idx_conversations_user_created"),
+    ("guest session touch",
+     "UPDATE user_sessions SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ? AND is_active = TRUE",
+     ("u",), "idx_sessions_user_activity"),
+    ("learned preferences",
+     "SELECT data_key, data_value, confidence_score FROM user_learning_data WHERE user_id = ?",
+     ("u",), "ux_learning_user_key"),
+    ("interaction counts",
+     "SELECT interaction_type, count FROM user_interaction_counts WHERE user_id = ?",
+     ("u",), "PRIMARY KEY (user_id=?)"),
+]
+
+
+def check_query_plans() -> List[str]:
+    """Return a problem description for every hot query not served by its index"""
+    if dialect() == "postgres":
+        return []  # EXPLAIN QUERY PLAN is SQLite's; PostgreSQL plans depend on table statistics
+    conn = get_connection()
+    problems = []
+    for name, sql, params, expected in HOT_QUERIES:
+        plan = " | ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        if expected not in plan:
+            problems.append(f"{name}: expected {expected}, got: {plan}")
+        elif "USE TEMP B-TREE FOR ORDER BY" in plan and "GROUP BY" not in sql:
+            problems.append(f"{name}: sorts instead of reading index order: {plan}")
+    return problems
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    versions = migrate()
+    print(f"Schema at version {current_version()} (applied now: {versions or 'none'})")
+    if "--reshard" in sys.argv:
+        position = sys.argv.index("--reshard") + 1
+        previous = int(sys.argv[position]) if len(sys.argv) > position and sys.argv[position].isdigit() else 0
+        print(f"Moved {reshard(previous)} conversations to their shards")
+    if "--check-plans" in sys.argv:
+        problems = check_query_plans()
+        for problem in problems:
+            print(f"❌ {problem}")
+        sys.exit(1 if problems else 0)
@@ -0,0 +1,112 @@
+# pagination.py - KEYSET PAGINATION, FIELD PROJECTION AND STREAMED JSON PAGES
+"""
+Helpers for list endpoints that can grow without bound.
+
+Pages are addressed by an opaque cursor holding the sort key of the last
+row served, so the next page is an index range scan (WHERE (ts, id) > ?)
+instead of an OFFSET that re-reads everything before it.
+
+    cursor = decode_cursor(request_cursor)           # None on the first page
+    rows = ... LIMIT limit + 1                       # one extra row = "has more"
+    next_cursor = encode_cursor(last_ts, last_id) if has_more else None
+    return stream_page("bookings", items, next_cursor=next_cursor)
+
+Endpoints that predate pagination (/bookings, conversation history) still
+return the whole list when a request sends neither limit nor cursor -
+all_pages reads it page by page.
+"""
+
+import os
+import json
+import base64
+import binascii
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "50"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "500"))
+STREAM_CHUNK_ITEMS = 100
+
+
+class RawJSON(str):
+    """Text that is already valid JSON - emitted as-is instead of parsed and re-encoded"""
+
+
+def encode_cursor(*key: Any) -> str:
+    raw = json.dumps(key, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str], arity: int = 2) -> Optional[Tuple]:
+    """Sort key from a cursor; 400 for anything that did not come from encode_cursor"""
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, list) or len(key) != arity:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple(key)
+
+
+def clamp_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        return PAGE_SIZE_DEFAULT
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    return min(limit, PAGE_SIZE_MAX)
+
+
+def all_pages(fetch: Callable[..., Tuple[List[Dict[str, Any]], Optional[str]]], key: Any,
+              fields: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
+    """Every item of a keyset-paged fetch(key, limit, after, fields), PAGE_SIZE_MAX rows per query"""
+    items: List[Dict[str, Any]] = []
+    after = None
+    while True:
+        page, next_cursor = fetch(key, PAGE_SIZE_MAX, after, fields)
+        items.extend(page)
+        if next_cursor is None:
+            return items
+        after = decode_cursor(next_cursor)
+
+
+def parse_fields(fields: Optional[str], allowed: Sequence[str]) -> Set[str]:
+    """Requested projection (comma separated); all allowed fields when omitted"""
+    if not fields:
+        return set(allowed)
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(allowed)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+
+def _encode_item(item: Dict[str, Any]) -> str:
+    return "{" + ",".join(
+        f"{json.dumps(key)}:{value if isinstance(value, RawJSON) else json.dumps(value, default=str)}"
+        for key, value in item.items()
+    ) + "}"
+
+
+def _page_chunks(key: str, items: Iterable[Dict[str, Any]], extra: Dict[str, Any]) -> Iterator[str]:
+    head = json.dumps(extra, default=str)[:-1]
+    yield (head + ", " if extra else "{") + json.dumps(key) + ": ["
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(_encode_item(item))
+        if len(chunk) >= STREAM_CHUNK_ITEMS:
+            yield ("" if first else ",") + ",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ("" if first else ",") + ",".join(chunk)
+    yield "]}"
+
+
+def stream_page(key: str, items: Iterable[Dict[str, Any]], **extra: Any) -> StreamingResponse:
+    """{**extra, key: [items...]} serialized incrementally, RawJSON values spliced in verbatim"""
+    return StreamingResponse(_page_chunks(key, items, extra), media_type="application/json")
@@ -0,0 +1,116 @@
+# password_hashing.py - BCRYPT OFF THE EVENT LOOP WITH ADMISSION CONTROL
+"""
+bcrypt is deliberately slow (~250ms at 12 rounds). Run inline in an async
+handler it stalls every request of the worker, chat included; on the
+shared DB executor it would starve database calls instead.
+
+Hashing and verification run on their own bounded executor
+(PASSWORD_HASH_WORKERS threads - bcrypt releases the GIL, so up to one per
+core). Admission control sheds login storms instead of queueing them
+without bound:
+
+- at most PASSWORD_HASH_MAX_QUEUE jobs wait behind the running ones; more
+  are refused at once with 503 + Retry-After;
+- a job that waited longer than PASSWORD_HASH_QUEUE_TIMEOUT_SEC is dropped
+  (its client has likely given up) and its request answered with 503.
+
+The cost factor is BCRYPT_ROUNDS. Stored hashes with another cost are
+re-hashed transparently at the next successful login (verify returns the
+new hash), so raising or lowering it needs no migration.
+
+    hashed = await run_hashing(hash_password, password)
+    valid, new_hash = await run_hashing(verify_password, password, hashed)
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "32"))
+PASSWORD_HASH_QUEUE_TIMEOUT_SEC = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT_SEC", "3"))
+
+# min = max = default: hashes of any other cost need an update
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+_lock = threading.Lock()
+_in_flight = 0
+_stats = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0, "timed_out": 0}
+
+
+class QueueTimeout(Exception):
+    """A hashing job waited longer than PASSWORD_HASH_QUEUE_TIMEOUT_SEC"""
+
+
+def hash_password(password: str) -> str:
+    """bcrypt hash at BCRYPT_ROUNDS (blocking)"""
+    hashed = pwd_context.hash(password)
+    _count("hashed")
+    return hashed
+
+
+def verify_password(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """(valid, replacement hash when the stored cost differs from BCRYPT_ROUNDS) (blocking)"""
+    valid, new_hash = pwd_context.verify_and_update(password, hashed)
+    _count("verified")
+    if new_hash:
+        _count("rehashed")
+    return valid, new_hash
+
+
+def _count(name: str):
+    with _lock:
+        _stats[name] += 1
+
+
+def _overloaded(detail: str) -> HTTPException:
+    return HTTPException(status_code=503, detail=detail,
+                         headers={"Retry-After": str(max(1, round(PASSWORD_HASH_QUEUE_TIMEOUT_SEC)))})
+
+
+def _run_admitted(fn: Callable[..., T], args: tuple, enqueued_at: float) -> T:
+    if time.monotonic() - enqueued_at > PASSWORD_HASH_QUEUE_TIMEOUT_SEC:
+        raise QueueTimeout()
+    return fn(*args)
+
+
+async def run_hashing(fn: Callable[..., T], *args: Any) -> T:
+    """Run hash_password / verify_password on the hashing executor; 503 when it is saturated"""
+    global _in_flight
+    with _lock:
+        if _in_flight >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_MAX_QUEUE:
+            _stats["rejected"] += 1
+            raise _overloaded("Too many logins in progress, retry shortly")
+        _in_flight += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, _run_admitted, fn, args, time.monotonic())
+    except QueueTimeout:
+        _count("timed_out")
+        raise _overloaded("Login queue timed out, retry shortly")
+    finally:
+        with _lock:
+            _in_flight -= 1
+
+
+def stats() -> Dict[str, Any]:
+    """Counters for /metrics"""
+    with _lock:
+        return dict(_stats, in_flight=_in_flight, workers=PASSWORD_HASH_WORKERS,
+                    max_queue=PASSWORD_HASH_MAX_QUEUE, rounds=BCRYPT_ROUNDS)
@@ -0,0 +1,148 @@
+# profile_aggregator.py - INCREMENTAL USER PROFILE AGGREGATES
+"""
+Per-user learning data and interaction counts, maintained incrementally.
+
+Requests only bump in-memory deltas; the first delta after a flush
+schedules one flush job on the write-behind queue, which applies all of
+them with batched INSERT ... ON CONFLICT DO UPDATE upserts. Deltas are
+additive, so several workers can flush into the same tables.
+
+Profile reads touch one row per learned key plus one per interaction
+type (user_learning_data and user_interaction_counts), never a user's
+full interaction history, and include deltas not yet flushed.
+"""
+
+import threading
+from typing import Any, Dict
+
+try:
+    from backend.storage import get_connection
+    from backend.write_behind import write_behind
+except ImportError:
+    from storage import get_connection
+    from write_behind import write_behind
+
+# Confidence model of the original learn_from_user_behavior: new keys start at
+# 0.5 and every further observation adds 0.1, capped at 1.0
+BASE_CONFIDENCE = 0.5
+CONFIDENCE_STEP = 0.1
+
+_UPSERT_LEARNING = '''
+    INSERT INTO user_learning_data (user_id, data_type, data_key, data_value, confidence_score)
+    VALUES (?, 'behavior', ?, ?, ?)
+    ON CONFLICT (user_id, data_key) DO UPDATE SET
+        data_value = excluded.data_value,
+        confidence_score = CASE WHEN user_learning_data.confidence_score + ? < 1.0
+                                THEN user_learning_data.confidence_score + ? ELSE 1.0 END,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+_UPSERT_INTERACTIONS = '''
+    INSERT INTO user_interaction_counts (user_id, interaction_type, count)
+    VALUES (?, ?, ?)
+    ON CONFLICT (user_id, interaction_type) DO UPDATE SET
+        count = user_interaction_counts.count + excluded.count
+'''
+
+
+class ProfileAggregator:
+    """In-memory deltas for user profiles, flushed in batches"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._learning: Dict[str, Dict[str, list]] = {}      # user -> key -> [value, observations]
+        self._interactions: Dict[str, Dict[str, int]] = {}   # user -> type -> count
+        self._flush_scheduled = False
+
+    def record_behavior(self, user_id: str, behavior_data: Dict[str, Any]) -> None:
+        with self._lock:
+            user_learning = self._learning.setdefault(user_id, {})
+            for data_key, data_value in behavior_data.items():
+                pending = user_learning.setdefault(data_key, [None, 0])
+                pending[0] = str(data_value)
+                pending[1] += 1
+            schedule = self._claim_flush()
+        if schedule:
+            self._schedule_flush()
+
+    def record_interaction(self, user_id: str, interaction_type: str) -> None:
+        with self._lock:
+            counts = self._interactions.setdefault(user_id, {})
+            counts[interaction_type] = counts.get(interaction_type, 0) + 1
+            schedule = self._claim_flush()
+        if schedule:
+            self._schedule_flush()
+
+    def _claim_flush(self) -> bool:
+        # Caller holds the lock; only the first delta after a flush schedules one
+        if self._flush_scheduled:
+            return False
+        self._flush_scheduled = True
+        return True
+
+    def _schedule_flush(self):
+        # Outside the lock: a blocking submit must not stall the writer's flush()
+        if not write_behind.submit_call(self.flush):
+            with self._lock:
+                self._flush_scheduled = False   # queue full; the next delta tries again
+
+    def flush(self) -> None:
+        """Upsert pending deltas (runs inside the write-behind batch transaction)"""
+        with self._lock:
+            learning, self._learning = self._learning, {}
+            interactions, self._interactions = self._interactions, {}
+            self._flush_scheduled = False
+        if not learning and not interactions:
+            return
+        conn = get_connection()
+        if learning:
+            conn.executemany(_UPSERT_LEARNING, [
+                (user_id, key, value, min(BASE_CONFIDENCE + CONFIDENCE_STEP * (n - 1), 1.0),
+                 CONFIDENCE_STEP * n, CONFIDENCE_STEP * n)
+                for user_id, pending in learning.items()
+                for key, (value, n) in pending.items()
+            ])
+        if interactions:
+            conn.executemany(_UPSERT_INTERACTIONS, [
+                (user_id, interaction_type, n)
+                for user_id, counts in interactions.items()
+                for interaction_type, n in counts.items()
+            ])
+
+    def get_profile(self, user_id: str) -> Dict[str, Any]:
+        """Learned preferences and interaction counts, including unflushed deltas"""
+        conn = get_connection()
+        learned = {
+            key: {"value": value, "confidence": confidence}
+            for key, value, confidence in conn.execute('''
+                SELECT data_key, data_value, confidence_score
+                FROM user_learning_data WHERE user_id = ?
+            ''', (user_id,))
+        }
+        patterns = dict(conn.execute('''
+            SELECT interaction_type, count FROM user_interaction_counts WHERE user_id = ?
+        ''', (user_id,)))
+
+        with self._lock:
+            for key, (value, n) in self._learning.get(user_id, {}).items():
+                if key in learned:
+                    confidence = learned[key]["confidence"] + CONFIDENCE_STEP * n
+                else:
+                    confidence = BASE_CONFIDENCE + CONFIDENCE_STEP * (n - 1)
+                learned[key] = {"value": value, "confidence": min(confidence, 1.0)}
+            for interaction_type, n in self._interactions.get(user_id, {}).items():
+                patterns[interaction_type] = patterns.get(interaction_type, 0) + n
+
+        return {
+            "learned_preferences": dict(sorted(learned.items(), key=lambda item: -item[1]["confidence"])),
+            "interaction_patterns": dict(sorted(patterns.items(), key=lambda item: -item[1])),
+            "user_id": user_id
+        }
+
+    def pending(self) -> Dict[str, int]:
+        with self._lock:
+            return {"users": len(self._learning.keys() | self._interactions.keys()),
+                    "learning_keys": sum(len(keys) for keys in self._learning.values())}
+
+
+profile_aggregator = ProfileAggregator()
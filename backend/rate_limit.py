@@ -0,0 +1,282 @@
+# rate_limit.py - PER-USER / PER-IP TOKEN BUCKETS FOR /chat
+"""
+A chat turn spends our OpenAI tokens and Amadeus / Booking.com quota, so
+one client must not be able to spend it for everyone. Every /chat request
+passes two sets of token buckets, shared by all workers through Redis:
+
+    ratelimit:{scope}:{dimension}     hash: t (tokens), ts (ms of last refill)
+
+    scope       user:{id} (signed in), guest:{anonymous id} and ip:{address}
+                - a fresh guest id is one cookie deletion away, the address
+                  is not; ip limits are RATE_LIMIT_IP_MULTIPLIER x the
+                  per-client ones (households, offices and NATs share one)
+    dimension   requests        1 per request, RATE_LIMIT_CHAT_PER_MIN
+                llm_tokens      RATE_LIMIT_LLM_TOKENS_PER_HOUR
+                upstream_calls  RATE_LIMIT_UPSTREAM_CALLS_PER_HOUR
+
+Buckets hold up to their budget and refill continuously. A request costs
+one `requests` token up front; what it consumes otherwise is only known
+afterwards (see usage.py), so it is admitted while those buckets are
+positive and its actual usage is debited when it finishes - a bucket may
+go into debt (at most one budget deep), which then delays the next
+request. All buckets of a check are read, tested and debited in one Lua
+script: concurrent requests of one client cannot overdraw them.
+
+Refused requests get 429 with Retry-After; every answer carries
+RateLimit-Limit / RateLimit-Remaining / RateLimit-Reset for the tightest
+requests bucket. While Redis is unreachable each worker keeps its own
+buckets (limits then apply per worker).
+
+acquire and charge block on Redis; handlers await them through
+run_limiter, on a small executor of their own so a slow Redis never
+holds up database work (run_db).
+"""
+
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException, Request
+from redis.exceptions import RedisError
+
+try:
+    from backend.usage import Usage
+except ImportError:
+    from usage import Usage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+RATE_LIMIT_CHAT_PER_MIN = float(os.getenv("RATE_LIMIT_CHAT_PER_MIN", "10"))
+RATE_LIMIT_LLM_TOKENS_PER_HOUR = float(os.getenv("RATE_LIMIT_LLM_TOKENS_PER_HOUR", "200000"))
+RATE_LIMIT_UPSTREAM_CALLS_PER_HOUR = float(os.getenv("RATE_LIMIT_UPSTREAM_CALLS_PER_HOUR", "300"))
+RATE_LIMIT_IP_MULTIPLIER = float(os.getenv("RATE_LIMIT_IP_MULTIPLIER", "5"))
+# Behind a reverse proxy the client address is the first X-Forwarded-For hop
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "false").lower() in ("1", "true", "yes")
+RATE_LIMIT_LOCAL_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_LOCAL_MAX_BUCKETS", "50000"))
+RATE_LIMIT_WORKERS = int(os.getenv("RATE_LIMIT_WORKERS", "4"))
+
+REQUESTS = "requests"
+LLM_TOKENS = "llm_tokens"
+UPSTREAM_CALLS = "upstream_calls"
+
+# A debit that is never refused (usage charged after the fact)
+_ALWAYS = -1e18
+
+
+class Limit(NamedTuple):
+    capacity: float     # budget, and the most a bucket holds
+    per_sec: float      # refill rate
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    dimension: str      # bucket reported in the headers: the tightest requests bucket, or the one that refused
+    limit: float
+    remaining: float
+    reset_sec: float    # until that bucket is full again
+    retry_after_sec: float
+
+
+DEFAULT_LIMITS = {
+    REQUESTS: Limit(RATE_LIMIT_CHAT_PER_MIN, RATE_LIMIT_CHAT_PER_MIN / 60),
+    LLM_TOKENS: Limit(RATE_LIMIT_LLM_TOKENS_PER_HOUR, RATE_LIMIT_LLM_TOKENS_PER_HOUR / 3600),
+    UPSTREAM_CALLS: Limit(RATE_LIMIT_UPSTREAM_CALLS_PER_HOUR, RATE_LIMIT_UPSTREAM_CALLS_PER_HOUR / 3600),
+}
+
+# KEYS: buckets; ARGV: per bucket capacity, refill per ms, cost, tokens needed.
+# Refill all, debit all only if every bucket has what it needs.
+# Returns allowed, then per bucket floor(tokens), ms until full, ms until enough.
+_TAKE_LUA = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local tokens = {}
+local allowed = 1
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 4 - 3])
+    local rate = tonumber(ARGV[i * 4 - 2])
+    local state = redis.call('HMGET', key, 't', 'ts')
+    local t = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens[i] = math.min(capacity, t + math.max(0, now - ts) * rate)
+    if tokens[i] < tonumber(ARGV[i * 4]) then
+        allowed = 0
+    end
+end
+local result = {allowed}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 4 - 3])
+    local rate = tonumber(ARGV[i * 4 - 2])
+    local need = tonumber(ARGV[i * 4])
+    local t = tokens[i]
+    if allowed == 1 then
+        t = math.max(t - tonumber(ARGV[i * 4 - 1]), -capacity)
+    end
+    local full = math.ceil((capacity - t) / rate)
+    redis.call('HSET', key, 't', tostring(t), 'ts', now)
+    redis.call('PEXPIRE', key, full + 1000)
+    result[#result + 1] = math.floor(t)
+    result[#result + 1] = full
+    result[#result + 1] = t < need and math.ceil((need - t) / rate) or 0
+end
+return result
+"""
+
+
+def _take_local(buckets: Dict[str, Tuple[float, float]], specs: List[tuple], now_ms: float) -> List[float]:
+    """_TAKE_LUA on an in-process dict (key -> (tokens, ms)); the caller holds the lock"""
+    tokens = []
+    allowed = 1
+    for key, capacity, rate, _, need in specs:
+        t, ts = buckets.get(key, (capacity, now_ms))
+        t = min(capacity, t + max(0.0, now_ms - ts) * rate)
+        tokens.append(t)
+        if t < need:
+            allowed = 0
+    result = [allowed]
+    for (key, capacity, rate, cost, need), t in zip(specs, tokens):
+        if allowed:
+            t = max(t - cost, -capacity)
+        buckets.pop(key, None)  # re-insert: dict order is least recently used first
+        buckets[key] = (t, now_ms)
+        result += [math.floor(t), math.ceil((capacity - t) / rate), math.ceil((need - t) / rate) if t < need else 0]
+    return result
+
+
+def client_ip(request: Request) -> str:
+    """Address the ip buckets are keyed by"""
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for", "")
+        if forwarded.strip():
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def subject_of(user: Dict) -> str:
+    """Per-client scope of a get_current_user dict"""
+    return f"{'user' if user.get('is_authenticated') else 'guest'}:{user['id']}"
+
+
+class RateLimiter:
+    """Distributed token buckets per client and per IP address"""
+
+    def __init__(self, client_factory: Optional[Callable[[], Any]], limits: Dict[str, Limit] = None,
+                 ip_multiplier: float = RATE_LIMIT_IP_MULTIPLIER, enabled: bool = RATE_LIMIT_ENABLED):
+        self._client_factory = client_factory
+        # A usage budget of 0 switches that dimension off
+        self._limits = {dimension: limit for dimension, limit in (limits or DEFAULT_LIMITS).items()
+                        if limit.capacity > 0 or dimension == REQUESTS}
+        self._ip_multiplier = ip_multiplier
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._local: Dict[str, Tuple[float, float]] = {}
+        self._stats = Counter(allowed=0, limited=0, local_fallbacks=0)
+        self._warned = False
+
+    def _specs(self, scopes: List[str], costs: Dict[str, float], needs: Dict[str, float]) -> List[tuple]:
+        specs = []
+        for scope in scopes:
+            scale = self._ip_multiplier if scope.startswith("ip:") else 1
+            for dimension, limit in self._limits.items():
+                specs.append((f"ratelimit:{scope}:{dimension}", limit.capacity * scale, limit.per_sec * scale / 1000,
+                              costs.get(dimension, 0), needs.get(dimension, _ALWAYS)))
+        return specs
+
+    def _take(self, specs: List[tuple]) -> List[float]:
+        if self._client_factory is not None:
+            try:
+                args = [value for _, capacity, rate, cost, need in specs for value in (capacity, rate, cost, need)]
+                result = self._client_factory().eval(_TAKE_LUA, len(specs), *[spec[0] for spec in specs], *args)
+                self._warned = False
+                return [float(value) for value in result]
+            except RedisError as e:
+                if not self._warned:
+                    logger.warning(f"Rate limiter store unavailable ({e}); limiting per worker")
+                    self._warned = True
+        with self._lock:
+            self._stats["local_fallbacks"] += 1
+            result = _take_local(self._local, specs, time.time() * 1000)
+            while len(self._local) > RATE_LIMIT_LOCAL_MAX_BUCKETS:
+                del self._local[next(iter(self._local))]
+            return result
+
+    def acquire(self, subject: str, ip: str) -> Decision:
+        """Admit one request: spends a request token, needs the usage buckets in credit (blocking)"""
+        needs = {dimension: 1 for dimension in self._limits}
+        specs = self._specs([subject, f"ip:{ip}"], {REQUESTS: 1}, needs)
+        result = self._take(specs)
+        allowed = bool(result[0])
+        reported, retry_after = None, 0.0
+        for i, (key, capacity, _, _, _) in enumerate(specs):
+            tokens, full_ms, wait_ms = result[1 + 3 * i: 4 + 3 * i]
+            dimension = key.rsplit(":", 1)[1]
+            if allowed and dimension == REQUESTS and (reported is None or tokens < reported.remaining):
+                reported = Decision(True, dimension, capacity, max(0.0, tokens), full_ms / 1000, 0.0)
+            elif not allowed and wait_ms / 1000 > retry_after:
+                retry_after = wait_ms / 1000
+                reported = Decision(False, dimension, capacity, max(0.0, tokens), full_ms / 1000, retry_after)
+        with self._lock:
+            self._stats["allowed" if allowed else "limited"] += 1
+            if not allowed:
+                self._stats[f"limited_{reported.dimension}"] += 1
+        return reported
+
+    def charge(self, subject: str, ip: str, usage: Usage):
+        """Debit what a finished request consumed; never refused (blocking)"""
+        spent = usage.as_dict()
+        if not any(spent.values()):
+            return
+        self._take(self._specs([subject, f"ip:{ip}"], spent, {}))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled, local_buckets=len(self._local),
+                        limits={dimension: limit.capacity for dimension, limit in self._limits.items()},
+                        ip_multiplier=self._ip_multiplier)
+
+
+_executor = ThreadPoolExecutor(max_workers=RATE_LIMIT_WORKERS, thread_name_prefix="ratelimit")
+
+
+async def run_limiter(fn: Callable[..., T], *args: Any) -> T:
+    """Run RateLimiter.acquire / charge on the limiter's executor"""
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+def headers(decision: Decision) -> Dict[str, str]:
+    """RateLimit-* (and on refusal Retry-After) response headers"""
+    values = {
+        "RateLimit-Limit": str(int(decision.limit)),
+        "RateLimit-Remaining": str(int(decision.remaining)),
+        "RateLimit-Reset": str(math.ceil(decision.reset_sec)),
+    }
+    if not decision.allowed:
+        values["Retry-After"] = str(max(1, math.ceil(decision.retry_after_sec)))
+    return values
+
+
+def too_many_requests(decision: Decision) -> HTTPException:
+    """429 for a refused Decision"""
+    what = {REQUESTS: "requests", LLM_TOKENS: "AI usage", UPSTREAM_CALLS: "travel searches"}.get(
+        decision.dimension, decision.dimension)
+    return HTTPException(status_code=429, headers=headers(decision),
+                         detail=f"Rate limit exceeded ({what}), retry in {max(1, math.ceil(decision.retry_after_sec))}s")
+
+
+def _redis():
+    try:
+        from backend.mcp_tools import rds
+    except ImportError:
+        from mcp_tools import rds
+    return rds
+
+
+rate_limiter = RateLimiter(_redis)
@@ -0,0 +1,279 @@
+# retention.py - RETENTION AND PURGE OF ANONYMOUS USERS AND STALE SESSIONS
+"""
+A guest that comes back with its id and writes something gets an
+anonymous users row and a user_sessions row (auth.ensure_anonymous_user);
+a first visit only writes its conversation. Crawlers and one-off visitors
+would grow these tables without bound.
+
+A background thread runs every RETENTION_INTERVAL_SEC and purges:
+
+- anonymous users (no password, anon_*@temp.com) whose sessions have
+  been inactive for RETENTION_ANON_INACTIVE_DAYS, together with their
+  conversations (messages and archives on every shard), interactions,
+  analytics, learned preferences and sessions. Anonymous users holding
+  bookings are kept;
+- conversations without a users row behind them (guests that never came
+  back) once nothing was said in them for RETENTION_ANON_INACTIVE_DAYS,
+  with their messages, archives and older analytics. Owners holding
+  bookings are kept;
+- sessions of registered users, and deactivated sessions, idle for
+  RETENTION_SESSION_DAYS (login sessions now live in Redis, sessions.py;
+  these rows predate that).
+
+Deletes run in batches of RETENTION_BATCH users / conversations / sessions, one short
+write transaction each, and a run stops once RETENTION_TIME_BUDGET_MS is
+spent - the next run carries on. Runs are idempotent, so several workers
+may run them concurrently. Rows reclaimed are reported per table
+(stats(), /metrics).
+
+    python retention.py              # one run with the configured windows
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+try:
+    from backend.storage import transaction, get_connection, shard_indexes
+except ImportError:
+    from storage import transaction, get_connection, shard_indexes
+
+logger = logging.getLogger(__name__)
+
+RETENTION_ANON_INACTIVE_DAYS = int(os.getenv("RETENTION_ANON_INACTIVE_DAYS", "30"))
+RETENTION_SESSION_DAYS = int(os.getenv("RETENTION_SESSION_DAYS", "30"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_TIME_BUDGET_MS = int(os.getenv("RETENTION_TIME_BUDGET_MS", "2000"))
+RETENTION_INTERVAL_SEC = int(os.getenv("RETENTION_INTERVAL_SEC", "3600"))     # 0 disables the thread
+
+# Rows created by ensure_anonymous_user
+ANONYMOUS_USER = "u.password_hash IS NULL AND u.email LIKE 'anon_%@temp.com'"
+
+_INACTIVE_ANONYMOUS_USERS = f'''
+    SELECT u.id FROM users u
+    WHERE {ANONYMOUS_USER}
+      AND u.created_at < ?
+      AND NOT EXISTS (SELECT 1 FROM user_sessions s WHERE s.user_id = u.id AND s.last_activity >= ?)
+      AND NOT EXISTS (SELECT 1 FROM bookings b WHERE b.user_id = u.id)
+    LIMIT ?
+'''
+
+# Per shard, keyset-paged by id; owners are checked in the main database
+_IDLE_CONVERSATIONS = '''
+    SELECT c.id, c.user_id FROM conversations c
+    WHERE c.created_at < ? AND c.id > ?
+      AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.conversation_id = c.id AND m.timestamp >= ?)
+    ORDER BY c.id
+    LIMIT ?
+'''
+
+_STALE_SESSIONS = '''
+    SELECT s.id FROM user_sessions s
+    JOIN users u ON u.id = s.user_id
+    WHERE s.last_activity < ? AND (u.password_hash IS NOT NULL OR s.is_active = FALSE)
+    LIMIT ?
+'''
+
+# Per-user rows in the main database, children before the users row
+_USER_TABLES = (
+    ("user_interactions", "user_id"),
+    ("user_analytics", "user_id"),
+    ("user_learning_data", "user_id"),
+    ("user_interaction_counts", "user_id"),
+    ("user_preferences", "user_id"),
+    ("user_sessions", "user_id"),
+    ("users", "id"),
+)
+
+
+def _cutoff(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _count(reclaimed: Dict[str, int], table: str, rows: int):
+    if rows > 0:
+        reclaimed[table] = reclaimed.get(table, 0) + rows
+
+
+class RetentionEngine:
+    """Batched, time-boxed purge runs on a background thread"""
+
+    def __init__(self, anon_inactive_days: int = RETENTION_ANON_INACTIVE_DAYS,
+                 session_days: int = RETENTION_SESSION_DAYS,
+                 batch: int = RETENTION_BATCH,
+                 time_budget_ms: int = RETENTION_TIME_BUDGET_MS,
+                 interval_sec: int = RETENTION_INTERVAL_SEC):
+        self._anon_inactive_days = anon_inactive_days
+        self._session_days = session_days
+        self._batch = batch
+        self._time_budget = time_budget_ms / 1000
+        self._interval = interval_sec
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._runs = 0
+        self._reclaimed: Dict[str, int] = {}
+        self._last_run: Optional[Dict] = None
+
+    def run_once(self) -> Dict:
+        """One time-boxed purge; returns rows reclaimed per table and whether it caught up"""
+        started = time.monotonic()
+        deadline = started + self._time_budget
+        reclaimed: Dict[str, int] = {}
+        complete = (self._purge_anonymous_users(deadline, reclaimed)
+                    and self._purge_ownerless_conversations(deadline, reclaimed)
+                    and self._purge_stale_sessions(deadline, reclaimed))
+        report = {
+            "reclaimed": reclaimed,
+            "complete": complete,
+            "elapsed_ms": round((time.monotonic() - started) * 1000, 1),
+            "finished_at": datetime.now().isoformat(),
+        }
+        with self._lock:
+            self._runs += 1
+            for table, rows in reclaimed.items():
+                _count(self._reclaimed, table, rows)
+            self._last_run = report
+        if reclaimed:
+            logger.info(f"🧹 Retention reclaimed {sum(reclaimed.values())} rows "
+                        f"in {report['elapsed_ms']}ms: {reclaimed}{'' if complete else ' (budget spent)'}")
+        return report
+
+    def _purge_anonymous_users(self, deadline: float, reclaimed: Dict[str, int]) -> bool:
+        cutoff = _cutoff(self._anon_inactive_days)
+        while time.monotonic() < deadline:
+            user_ids = [row[0] for row in get_connection().execute(
+                _INACTIVE_ANONYMOUS_USERS, (cutoff, cutoff, self._batch))]
+            if not user_ids:
+                return True
+            self._delete_users(user_ids, reclaimed)
+            if len(user_ids) < self._batch:
+                return True
+        return False
+
+    def _delete_users(self, user_ids: List[str], reclaimed: Dict[str, int]):
+        placeholders = ", ".join("?" * len(user_ids))
+        owned = f"SELECT id FROM conversations WHERE user_id IN ({placeholders})"
+        # Conversations first: a crash in between leaves the user row for the next run
+        for shard in shard_indexes():
+            with transaction(immediate=True, shard=shard) as conn:
+                for table, column in (("messages", "conversation_id"),
+                                      ("conversation_archive", "conversation_id")):
+                    _count(reclaimed, table, conn.execute(
+                        f"DELETE FROM {table} WHERE {column} IN ({owned})", user_ids).rowcount)
+                _count(reclaimed, "conversations", conn.execute(
+                    f"DELETE FROM conversations WHERE user_id IN ({placeholders})", user_ids).rowcount)
+        with transaction(immediate=True) as conn:
+            for table, column in _USER_TABLES:
+                _count(reclaimed, table, conn.execute(
+                    f"DELETE FROM {table} WHERE {column} IN ({placeholders})", user_ids).rowcount)
+
+    def _purge_ownerless_conversations(self, deadline: float, reclaimed: Dict[str, int]) -> bool:
+        cutoff = _cutoff(self._anon_inactive_days)
+        for shard in shard_indexes():
+            after = ""
+            while True:
+                if time.monotonic() >= deadline:
+                    return False
+                rows = get_connection(shard).execute(
+                    _IDLE_CONVERSATIONS, (cutoff, after, cutoff, self._batch)).fetchall()
+                if not rows:
+                    break
+                after = rows[-1][0]
+                owners = sorted({user_id for _, user_id in rows if user_id})
+                if owners:
+                    placeholders = ", ".join("?" * len(owners))
+                    kept = {row[0] for row in get_connection().execute(
+                        f"SELECT id FROM users WHERE id IN ({placeholders}) "
+                        f"UNION SELECT user_id FROM bookings WHERE user_id IN ({placeholders})", owners * 2)}
+                    ownerless = [(conversation_id, user_id) for conversation_id, user_id in rows
+                                 if user_id and user_id not in kept]
+                    if ownerless:
+                        self._delete_conversations(shard, ownerless, cutoff, reclaimed)
+                if len(rows) < self._batch:
+                    break
+        return True
+
+    def _delete_conversations(self, shard: Optional[int], ownerless: List[tuple], cutoff: str,
+                              reclaimed: Dict[str, int]):
+        conversation_ids = [conversation_id for conversation_id, _ in ownerless]
+        placeholders = ", ".join("?" * len(conversation_ids))
+        with transaction(immediate=True, shard=shard) as conn:
+            for table, column in (("messages", "conversation_id"),
+                                  ("conversation_archive", "conversation_id"),
+                                  ("conversations", "id")):
+                _count(reclaimed, table, conn.execute(
+                    f"DELETE FROM {table} WHERE {column} IN ({placeholders})", conversation_ids).rowcount)
+        owners = sorted({user_id for _, user_id in ownerless})
+        with transaction(immediate=True) as conn:
+            _count(reclaimed, "user_analytics", conn.execute(
+                f"DELETE FROM user_analytics WHERE user_id IN ({', '.join('?' * len(owners))}) AND timestamp < ?",
+                [*owners, cutoff]).rowcount)
+
+    def _purge_stale_sessions(self, deadline: float, reclaimed: Dict[str, int]) -> bool:
+        cutoff = _cutoff(self._session_days)
+        while time.monotonic() < deadline:
+            with transaction(immediate=True) as conn:
+                session_ids = [row[0] for row in conn.execute(_STALE_SESSIONS, (cutoff, self._batch))]
+                if session_ids:
+                    _count(reclaimed, "user_sessions", conn.execute(
+                        f"DELETE FROM user_sessions WHERE id IN ({', '.join('?' * len(session_ids))})",
+                        session_ids).rowcount)
+            if len(session_ids) < self._batch:
+                return True
+        return False
+
+    def start(self):
+        """Start the background thread (no-op when RETENTION_INTERVAL_SEC is 0)"""
+        if self._interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # Spread workers that started together
+        if self._stopping.wait(random.uniform(0, min(self._interval, 60))):
+            return
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f"Retention run failed: {e}")
+            self._stopping.wait(self._interval)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "runs": self._runs,
+                "reclaimed": dict(self._reclaimed),
+                "last_run": self._last_run,
+                "interval_sec": self._interval,
+            }
+
+
+retention = RetentionEngine()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        from backend.migrations import migrate
+    except ImportError:
+        from migrations import migrate
+    migrate()
+    result = retention.run_once()
+    print(f"🧹 Reclaimed {sum(result['reclaimed'].values())} rows in {result['elapsed_ms']}ms"
+          f"{'' if result['complete'] else ' (time budget spent, run again)'}")
+    for table, rows in sorted(result["reclaimed"].items()):
+        print(f"   {table:<28} {rows:>10}")
@@ -0,0 +1,272 @@
+# rollups.py - INCREMENTAL HOURLY / DAILY ANALYTICS ROLLUPS
+"""
+Dashboards read small aggregate tables instead of scanning raw
+user_analytics and user_interactions rows.
+
+Each source table has a high-water mark (rollup_state.last_id). A run
+reads only rows past it, in id order and batches of ROLLUP_BATCH_ROWS,
+folds them into:
+
+    analytics_rollup_hourly / analytics_rollup_daily
+        (bucket, metric, dimension) -> value, e.g.
+        ("2025-01-15", "searches", "flight:NYC-LIS") -> 42
+        metrics: events (by event_type), interactions (by type),
+                 searches (by route), bookings (by type),
+                 active_users / searching_users / booking_users (daily)
+    analytics_daily_users
+        (day, kind, user_id) - distinct users per day, so user counts
+        stay exact when a user shows up in several runs
+
+and moves the mark, all in one write transaction - a batch is counted
+exactly once even with several workers running the job. Rows newer than
+ROLLUP_SETTLE_SEC are left for the next run, so a slow writer's rows with
+lower ids are never skipped. Buckets are UTC.
+
+/analytics/summary reads nothing but these tables.
+
+    python rollups.py            # catch up now
+"""
+
+import os
+import time
+import json
+import random
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+try:
+    from backend.storage import transaction, get_connection, dialect
+except ImportError:
+    from storage import transaction, get_connection, dialect
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_BATCH_ROWS = int(os.getenv("ROLLUP_BATCH_ROWS", "5000"))
+ROLLUP_INTERVAL_SEC = int(os.getenv("ROLLUP_INTERVAL_SEC", "60"))     # 0 disables the thread
+ROLLUP_SETTLE_SEC = int(os.getenv("ROLLUP_SETTLE_SEC", "5"))
+ROLLUP_TIME_BUDGET_MS = int(os.getenv("ROLLUP_TIME_BUDGET_MS", "5000"))
+
+# Analytics event types the chat endpoint records (see main.record_turn_analytics)
+SEARCH_EVENT = "search"
+BOOKING_EVENT = "booking_confirmed"
+
+# source table -> (type column, JSON data column, metric)
+_SOURCES = {
+    "user_analytics": ("event_type", "event_data", "events"),
+    "user_interactions": ("interaction_type", "interaction_data", "interactions"),
+}
+
+_UPSERT_ROLLUP = '''
+    INSERT INTO {table} (bucket, metric, dimension, value) VALUES (?, ?, ?, ?)
+    ON CONFLICT (bucket, metric, dimension) DO UPDATE SET value = {table}.value + excluded.value
+'''
+
+_RECOUNT_DAILY_USERS = '''
+    INSERT INTO analytics_rollup_daily (bucket, metric, dimension, value)
+    SELECT day, kind || '_users', '', COUNT(*) FROM analytics_daily_users
+    WHERE day = ?
+    GROUP BY day, kind
+    ON CONFLICT (bucket, metric, dimension) DO UPDATE SET value = excluded.value
+'''
+
+
+def _utc(seconds_ago: float = 0) -> str:
+    return (datetime.now(timezone.utc) - timedelta(seconds=seconds_ago)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _fold(source: str, rows: List[tuple]) -> Tuple[Counter, Set[Tuple[str, str, str]]]:
+    """Raw (id, user_id, type, data, timestamp) rows -> (hour, metric, dimension) counts and daily users"""
+    _, _, metric = _SOURCES[source]
+    counts: Counter = Counter()
+    users: Set[Tuple[str, str, str]] = set()
+    for _, user_id, kind, data, timestamp in rows:
+        hour = timestamp[:13] + ":00:00"
+        counts[(hour, metric, kind or "")] += 1
+        day = timestamp[:10]
+        if user_id:
+            users.add((day, "active", user_id))
+        if source != "user_analytics" or kind not in (SEARCH_EVENT, BOOKING_EVENT):
+            continue
+        try:
+            details = json.loads(data) if data else {}
+        except ValueError:
+            details = {}
+        if kind == SEARCH_EVENT:
+            route = f"{details.get('type') or 'unknown'}:{details.get('route') or 'unknown'}"
+            counts[(hour, "searches", route)] += 1
+            if user_id:
+                users.add((day, "searching", user_id))
+        else:
+            counts[(hour, "bookings", details.get("type") or "unknown")] += 1
+            if user_id:
+                users.add((day, "booking", user_id))
+    return counts, users
+
+
+class RollupJob:
+    """Folds new raw rows into the rollup tables, on demand or on a background thread"""
+
+    def __init__(self, batch_rows: int = ROLLUP_BATCH_ROWS, interval_sec: int = ROLLUP_INTERVAL_SEC,
+                 settle_sec: int = ROLLUP_SETTLE_SEC, time_budget_ms: int = ROLLUP_TIME_BUDGET_MS):
+        self._batch_rows = batch_rows
+        self._interval = interval_sec
+        self._settle = settle_sec
+        self._time_budget = time_budget_ms / 1000
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"runs": 0, "rows": 0, "batches": 0}
+
+    def run_once(self) -> Dict[str, int]:
+        """Catch up every source (within the time budget); returns rows folded per source"""
+        deadline = time.monotonic() + self._time_budget
+        folded = {}
+        for source in _SOURCES:
+            folded[source] = 0
+            while time.monotonic() < deadline:
+                rows = self._fold_batch(source)
+                folded[source] += rows
+                if rows < self._batch_rows:
+                    break
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["rows"] += sum(folded.values())
+        if any(folded.values()):
+            logger.info(f"📊 Rolled up {folded}")
+        return folded
+
+    def _fold_batch(self, source: str) -> int:
+        type_column, data_column, _ = _SOURCES[source]
+        settled = _utc(self._settle)
+        with transaction(immediate=True) as conn:
+            lock = " FOR UPDATE" if dialect() == "postgres" else ""
+            state = conn.execute(f"SELECT last_id FROM rollup_state WHERE source = ?{lock}", (source,)).fetchone()
+            last_id = state[0] if state else 0
+            rows = conn.execute(f'''
+                SELECT id, user_id, {type_column}, {data_column}, timestamp FROM {source}
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (last_id, self._batch_rows)).fetchall()
+            # Stop at the first row that may still have uncommitted neighbours
+            for position, row in enumerate(rows):
+                if row[4] is None or row[4] >= settled:
+                    rows = rows[:position]
+                    break
+            if not rows:
+                return 0
+
+            counts, users = _fold(source, rows)
+            daily: Counter = Counter()
+            for (hour, metric, dimension), n in counts.items():
+                daily[(hour[:10], metric, dimension)] += n
+            conn.executemany(_UPSERT_ROLLUP.format(table="analytics_rollup_hourly"),
+                             [key + (n,) for key, n in counts.items()])
+            conn.executemany(_UPSERT_ROLLUP.format(table="analytics_rollup_daily"),
+                             [key + (n,) for key, n in daily.items()])
+            if users:
+                conn.executemany('''
+                    INSERT INTO analytics_daily_users (day, kind, user_id) VALUES (?, ?, ?)
+                    ON CONFLICT (day, kind, user_id) DO NOTHING
+                ''', sorted(users))
+                conn.executemany(_RECOUNT_DAILY_USERS, [(day,) for day in sorted({u[0] for u in users})])
+            conn.execute('''
+                INSERT INTO rollup_state (source, last_id) VALUES (?, ?)
+                ON CONFLICT (source) DO UPDATE SET last_id = excluded.last_id, updated_at = CURRENT_TIMESTAMP
+            ''', (source, rows[-1][0]))
+        with self._lock:
+            self._stats["batches"] += 1
+        return len(rows)
+
+    def start(self):
+        """Start the background thread (no-op when ROLLUP_INTERVAL_SEC is 0)"""
+        if self._interval <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        # Spread workers that started together
+        if self._stopping.wait(random.uniform(0, min(self._interval, 10))):
+            return
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.warning(f"Analytics rollup failed: {e}")
+            self._stopping.wait(self._interval)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            high_water = {source: last_id for source, last_id in
+                          get_connection().execute("SELECT source, last_id FROM rollup_state")}
+            return dict(self._stats, high_water=high_water, interval_sec=self._interval)
+
+
+rollups = RollupJob()
+
+
+def summary(days: int = 7, granularity: str = "day", top_routes: int = 10) -> Dict:
+    """Dashboard numbers for the last `days` days, read from the rollup tables only"""
+    conn = get_connection()
+    since_day = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    table = "analytics_rollup_hourly" if granularity == "hour" else "analytics_rollup_daily"
+
+    buckets: Dict[str, Dict] = {}
+    for bucket, metric, dimension, value in conn.execute(f'''
+        SELECT bucket, metric, dimension, value FROM {table}
+        WHERE bucket >= ?
+        ORDER BY bucket
+    ''', (since_day,)):
+        entry = buckets.setdefault(bucket, {})
+        if metric.endswith("_users"):
+            entry[metric] = value
+        else:
+            entry.setdefault(metric, {})[dimension] = value
+    for entry in buckets.values():
+        if "searching_users" in entry:
+            entry["booking_conversion"] = round(entry.get("booking_users", 0) / entry["searching_users"], 4)
+
+    routes = conn.execute('''
+        SELECT dimension, SUM(value) AS searches FROM analytics_rollup_daily
+        WHERE metric = 'searches' AND bucket >= ?
+        GROUP BY dimension
+        ORDER BY searches DESC, dimension
+        LIMIT ?
+    ''', (since_day, top_routes)).fetchall()
+    totals = conn.execute('''
+        SELECT metric, SUM(value) FROM analytics_rollup_daily
+        WHERE metric IN ('searching_users', 'booking_users') AND bucket >= ?
+        GROUP BY metric
+    ''', (since_day,)).fetchall()
+    totals = dict(totals)
+    return {
+        "since": since_day,
+        "granularity": "hour" if granularity == "hour" else "day",
+        "buckets": buckets,
+        "top_routes": [{"route": route, "searches": n} for route, n in routes],
+        # user-days: a user searching on two days counts twice
+        "booking_conversion": round(totals.get("booking_users", 0) / totals["searching_users"], 4)
+                              if totals.get("searching_users") else None,
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        from backend.migrations import migrate
+    except ImportError:
+        from migrations import migrate
+    migrate()
+    print(f"📊 Folded {rollups.run_once()}")
+    print(json.dumps(summary(), indent=2))
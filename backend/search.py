@@ -0,0 +1,120 @@
+# search.py - FULL-TEXT SEARCH OVER CONVERSATION HISTORY
+"""
+Ranked full-text search over a user's messages, with snippets.
+
+SQLite: an external-content FTS5 table (messages_fts) over
+messages.content, kept in sync by insert/update/delete triggers on
+messages (migration 7) - so save_message, archiving, rehydration and
+retention purges all index incrementally, with no extra code on the
+write path. Ranking is bm25. With sharding every shard has its own index;
+search_messages() queries them in parallel and merges by rank.
+PostgreSQL: a GIN index on to_tsvector('english', content), ranked with
+ts_rank and ts_headline snippets.
+
+Archived conversations are not searchable until they are rehydrated
+(their message rows are what the index covers).
+
+    python search.py --rebuild                     # rebuild + optimize the index
+    python search.py --user USER_ID lisbon hotel   # search from the shell
+"""
+
+import re
+import sys
+import logging
+from typing import Dict, List
+
+from fastapi import HTTPException
+
+try:
+    from backend.storage import get_connection, dialect, fan_out, shard_indexes
+except ImportError:
+    from storage import get_connection, dialect, fan_out, shard_indexes
+
+logger = logging.getLogger(__name__)
+
+SNIPPET_OPEN, SNIPPET_CLOSE = "[", "]"
+SNIPPET_TOKENS = 16
+
+_SQLITE_SEARCH = f'''
+    SELECT m.conversation_id, m.id, m.role, m.timestamp,
+           snippet(messages_fts, 0, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', {SNIPPET_TOKENS}),
+           bm25(messages_fts) AS rank
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    JOIN conversations c ON c.id = m.conversation_id
+    WHERE messages_fts MATCH ? AND c.user_id = ?
+    ORDER BY rank
+    LIMIT ?
+'''
+
+_POSTGRES_SEARCH = f'''
+    SELECT m.conversation_id, m.id, m.role, m.timestamp,
+           ts_headline('english', m.content, q,
+                       'StartSel={SNIPPET_OPEN}, StopSel={SNIPPET_CLOSE}, MaxWords={SNIPPET_TOKENS}, MinWords=4'),
+           -ts_rank(to_tsvector('english', m.content), q) AS rank
+    FROM messages m
+    JOIN conversations c ON c.id = m.conversation_id
+    CROSS JOIN websearch_to_tsquery('english', ?) q
+    WHERE to_tsvector('english', m.content) @@ q AND c.user_id = ?
+    ORDER BY rank
+    LIMIT ?
+'''
+
+
+def _match_expression(text: str) -> str:
+    """User text -> FTS5 query: every word must match, the last one as a prefix"""
+    terms = re.findall(r"\w+", text)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query needs at least one word")
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _search_database(conn, user_id: str, query: str, limit: int) -> List[tuple]:
+    if dialect() == "postgres":
+        return conn.execute(_POSTGRES_SEARCH, (query, user_id, limit)).fetchall()
+    return conn.execute(_SQLITE_SEARCH, (_match_expression(query), user_id, limit)).fetchall()
+
+
+def search_messages(user_id: str, query: str, limit: int) -> List[Dict]:
+    """Best matching messages of one user's conversations, best first"""
+    if dialect() == "sqlite":
+        _match_expression(query)   # reject empty queries before fanning out
+    rows = [row for shard_rows in fan_out(_search_database, user_id, query, limit) for row in shard_rows]
+    rows.sort(key=lambda row: row[5])
+    return [
+        {"conversation_id": row[0], "message_id": row[1], "role": row[2], "timestamp": row[3],
+         "snippet": row[4], "rank": round(-row[5], 4)}
+        for row in rows[:limit]
+    ]
+
+
+def rebuild_index():
+    """Rebuild the full-text index from messages (every shard) and merge its segments"""
+    for shard in shard_indexes():
+        conn = get_connection(shard)
+        if dialect() == "postgres":
+            conn.execute("REINDEX INDEX idx_messages_fts")
+        else:
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        logger.info(f"🔎 Rebuilt message search index{'' if shard is None else f' (shard {shard})'}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        from backend.migrations import migrate
+    except ImportError:
+        from migrations import migrate
+    migrate()
+    if "--rebuild" in sys.argv:
+        rebuild_index()
+    elif "--user" in sys.argv:
+        position = sys.argv.index("--user")
+        user_id, words = sys.argv[position + 1], sys.argv[1:position] + sys.argv[position + 2:]
+        for hit in search_messages(user_id, " ".join(words), 20):
+            print(f"{hit['rank']:>8.3f}  {hit['conversation_id']}  {hit['timestamp']}  {hit['role']:<9} {hit['snippet']}")
+    else:
+        print(__doc__)
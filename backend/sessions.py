@@ -0,0 +1,186 @@
+# sessions.py - REDIS SESSION STORE WITH SLIDING EXPIRY AND REVOCATION
+"""
+Login sessions of registered users live in Redis (the mcp_tools client),
+not in user_sessions - they expire on their own, no SQL, no cleanup job.
+
+    session:{sid}          hash: user_id, created_at, ip, user_agent
+                           EXPIRE SESSION_IDLE_DAYS, renewed on use (sliding)
+    user_sessions:{uid}    sorted set sid -> expiry, for per-user listing
+
+The sid travels in the JWT ("sid" claim). Checking it is O(1): a worker
+trusts a session it confirmed within SESSION_CHECK_INTERVAL_SEC from
+memory (live cache), otherwise one pipelined EXPIRE both confirms and
+slides it. revoke() deletes the key and drops the sid from every
+worker's live cache through the RedisInvalidator, so the token stops
+working on the next request anywhere.
+
+While Redis is unreachable, new logins get tokens without a sid and
+checks pass (SESSION_FAIL_OPEN, default on) - authentication then rests on
+the JWT alone, as it did before. Tokens without a sid cannot be revoked.
+"""
+
+import os
+import time
+import uuid
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from redis.exceptions import RedisError
+
+try:
+    from backend.cache import TTLCache
+except ImportError:
+    from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+SESSION_IDLE_DAYS = int(os.getenv("SESSION_IDLE_DAYS", "14"))
+SESSION_CHECK_INTERVAL_SEC = float(os.getenv("SESSION_CHECK_INTERVAL_SEC", "60"))
+SESSION_FAIL_OPEN = os.getenv("SESSION_FAIL_OPEN", "true").lower() in ("1", "true", "yes")
+SESSION_CACHE_MAX_ITEMS = int(os.getenv("SESSION_CACHE_MAX_ITEMS", "10000"))
+
+
+def _session_key(sid: str) -> str:
+    return f"session:{sid}"
+
+
+def _index_key(user_id: str) -> str:
+    return f"user_sessions:{user_id}"
+
+
+class SessionStore:
+    """Sessions with sliding expiry, revocation and per-user listing"""
+
+    def __init__(self, client_factory: Callable[[], Any], idle_sec: int = SESSION_IDLE_DAYS * 86400,
+                 check_interval_sec: float = SESSION_CHECK_INTERVAL_SEC, fail_open: bool = SESSION_FAIL_OPEN,
+                 name: str = "live_sessions"):
+        self._client_factory = client_factory
+        self._idle = idle_sec
+        self._fail_open = fail_open
+        # sid -> user_id of sessions confirmed recently; revocation drops it in every worker
+        self.live = TTLCache(name, max_items=SESSION_CACHE_MAX_ITEMS, ttl=check_interval_sec)
+        self._warned = False
+
+    def _unavailable(self, e: Exception):
+        if not self._warned:
+            logger.warning(f"Session store unavailable ({e}); "
+                           f"{'accepting tokens on their signature alone' if self._fail_open else 'rejecting sessions'}")
+            self._warned = True
+
+    def create(self, user_id: str, ip_address: str = "", user_agent: str = "") -> Optional[str]:
+        """New session id, None when Redis is unreachable"""
+        sid = uuid.uuid4().hex
+        now = int(time.time())
+        try:
+            pipe = self._client_factory().pipeline(transaction=True)
+            pipe.hset(_session_key(sid), mapping={
+                "user_id": user_id, "created_at": now, "ip": ip_address, "user_agent": user_agent,
+            })
+            pipe.expire(_session_key(sid), self._idle)
+            pipe.zadd(_index_key(user_id), {sid: now + self._idle})
+            # The index outlives every member: each touch pushes both to now + idle
+            pipe.expire(_index_key(user_id), self._idle)
+            pipe.execute()
+        except RedisError as e:
+            self._unavailable(e)
+            return None
+        self._warned = False
+        self.live.set(sid, user_id)
+        return sid
+
+    def cached(self, sid: str, user_id: str) -> bool:
+        """Confirmed live within SESSION_CHECK_INTERVAL_SEC (memory only, no I/O)"""
+        return self.live.get(sid) == user_id
+
+    def check(self, sid: str, user_id: str) -> bool:
+        """Is the session live? Confirms and slides its expiry in one round trip when not cached"""
+        if self.cached(sid, user_id):
+            return True
+        stamp = self.live.stamp(sid)
+        try:
+            pipe = self._client_factory().pipeline(transaction=True)
+            pipe.expire(_session_key(sid), self._idle)
+            pipe.hget(_session_key(sid), "user_id")
+            pipe.zadd(_index_key(user_id), {sid: int(time.time()) + self._idle}, xx=True)
+            pipe.expire(_index_key(user_id), self._idle)
+            alive, owner, _, _ = pipe.execute()
+        except RedisError as e:
+            self._unavailable(e)
+            return self._fail_open
+        self._warned = False
+        if not alive or owner != user_id:
+            return False
+        # Skipped if revoked while we were asking
+        self.live.set(sid, user_id, if_stamp=stamp)
+        return True
+
+    def revoke(self, sid: str, user_id: str) -> bool:
+        """End one of the user's sessions (here and in every worker); False when it has no such session"""
+        client = self._client_factory()
+        if client.hget(_session_key(sid), "user_id") != user_id:
+            client.zrem(_index_key(user_id), sid)
+            return False
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.delete(_session_key(sid))
+            pipe.zrem(_index_key(user_id), sid)
+            deleted, _ = pipe.execute()
+        finally:
+            self.live.invalidate(sid)
+        return bool(deleted)
+
+    def revoke_all(self, user_id: str) -> int:
+        """End every session of a user; returns how many were live"""
+        client = self._client_factory()
+        sids = client.zrange(_index_key(user_id), 0, -1)
+        pipe = client.pipeline(transaction=True)
+        for sid in sids:
+            pipe.delete(_session_key(sid))
+        pipe.delete(_index_key(user_id))
+        try:
+            revoked = sum(pipe.execute()[:-1])
+        finally:
+            for sid in sids:
+                self.live.invalidate(sid)
+        return revoked
+
+    def list(self, user_id: str) -> List[Dict[str, Any]]:
+        """Live sessions of a user, most recently used first"""
+        client = self._client_factory()
+        now = int(time.time())
+        client.zremrangebyscore(_index_key(user_id), "-inf", now)
+        sids = client.zrange(_index_key(user_id), 0, -1)
+        pipe = client.pipeline(transaction=False)
+        for sid in sids:
+            pipe.hgetall(_session_key(sid))
+            pipe.ttl(_session_key(sid))
+        replies = pipe.execute()
+        sessions, gone = [], []
+        for i, sid in enumerate(sids):
+            data, ttl = replies[2 * i], replies[2 * i + 1]
+            if not data or ttl < 0:
+                gone.append(sid)
+                continue
+            sessions.append({
+                "session_id": sid,
+                "created_at": int(data.get("created_at", 0)),
+                # Every use renews the TTL to idle, so the time since then is idle - ttl
+                "last_seen": now - (self._idle - ttl),
+                "expires_at": now + ttl,
+                "ip": data.get("ip", ""),
+                "user_agent": data.get("user_agent", ""),
+            })
+        if gone:
+            client.zrem(_index_key(user_id), *gone)
+        return sorted(sessions, key=lambda s: s["last_seen"], reverse=True)
+
+
+def _redis():
+    try:
+        from backend.mcp_tools import rds
+    except ImportError:
+        from mcp_tools import rds
+    return rds
+
+
+sessions = SessionStore(_redis)
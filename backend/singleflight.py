@@ -0,0 +1,160 @@
+# singleflight.py - REQUEST COALESCING FOR IDENTICAL UPSTREAM CALLS
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Cross-worker coalescing through Redis is opt-in; per-process merging is always on
+SINGLEFLIGHT_REDIS = os.getenv("SINGLEFLIGHT_REDIS", "false").lower() in ("1", "true", "yes")
+SINGLEFLIGHT_LOCK_TTL_SEC = float(os.getenv("SINGLEFLIGHT_LOCK_TTL_SEC", "30"))
+SINGLEFLIGHT_RESULT_TTL_SEC = float(os.getenv("SINGLEFLIGHT_RESULT_TTL_SEC", "5"))
+SINGLEFLIGHT_POLL_SEC = 0.05
+
+# Delete the lock only if we still own it
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+_groups: Dict[str, "SingleFlight"] = {}
+
+
+def make_key(*parts: Any) -> str:
+    """Stable hash of the normalized call arguments"""
+    raw = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Merge concurrent identical calls into one execution.
+    The first caller for a key runs the function; everyone else arriving
+    while it is in flight waits and receives the same result (read-only).
+    With a Redis client, the leader also holds a short Redis lock so other
+    workers poll for its published result instead of calling upstream.
+    """
+
+    def __init__(self, name: str, redis_client_factory: Optional[Callable[[], Any]] = None,
+                 decode: Optional[Callable[[Any], Any]] = None,
+                 lock_ttl: float = SINGLEFLIGHT_LOCK_TTL_SEC,
+                 result_ttl: float = SINGLEFLIGHT_RESULT_TTL_SEC):
+        self.name = name
+        self._redis_client_factory = redis_client_factory if SINGLEFLIGHT_REDIS else None
+        self._decode = decode
+        self._lock_ttl = lock_ttl
+        self._result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._stats = {"calls": 0, "executions": 0, "merged": 0, "redis_merged": 0}
+        _groups[name] = self
+
+    def do(self, key: str, fn: Callable, *args, **kwargs):
+        """Run fn(*args, **kwargs) once per key across concurrent callers"""
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self._stats["merged"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_leader(key, fn, args, kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._calls))
+
+    def _execute(self, fn, args, kwargs):
+        with self._lock:
+            self._stats["executions"] += 1
+        return fn(*args, **kwargs)
+
+    def _run_leader(self, key, fn, args, kwargs):
+        rds = self._redis_client_factory() if self._redis_client_factory else None
+        if rds is None:
+            return self._execute(fn, args, kwargs)
+
+        lock_key = f"sf:{self.name}:lock:{key}"
+        result_key = f"sf:{self.name}:result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = rds.set(lock_key, token, nx=True, px=int(self._lock_ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Singleflight Redis unavailable ({self.name}): {e}")
+            return self._execute(fn, args, kwargs)
+
+        if acquired:
+            try:
+                result = self._execute(fn, args, kwargs)
+                try:
+                    rds.set(result_key, json.dumps(result, default=str),
+                            px=int(self._result_ttl * 1000))
+                except Exception as e:
+                    logger.warning(f"Singleflight result publish failed ({self.name}): {e}")
+                return result
+            finally:
+                try:
+                    rds.eval(_RELEASE_LOCK_LUA, 1, lock_key, token)
+                except Exception:
+                    pass  # Lock expires on its own
+
+        # Another worker is the leader - wait for its published result
+        deadline = time.monotonic() + self._lock_ttl
+        try:
+            while time.monotonic() < deadline:
+                raw = rds.get(result_key)
+                if raw is not None:
+                    with self._lock:
+                        self._stats["redis_merged"] += 1
+                    value = json.loads(raw)
+                    return self._decode(value) if self._decode else value
+                if not rds.exists(lock_key):
+                    # Leader finished without publishing (it raised) - one more look, then go ourselves
+                    raw = rds.get(result_key)
+                    if raw is not None:
+                        value = json.loads(raw)
+                        return self._decode(value) if self._decode else value
+                    break
+                time.sleep(SINGLEFLIGHT_POLL_SEC)
+        except Exception as e:
+            logger.warning(f"Singleflight Redis wait failed ({self.name}): {e}")
+        return self._execute(fn, args, kwargs)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Counters for every registered singleflight group"""
+    return {name: group.stats() for name, group in _groups.items()}
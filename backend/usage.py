@@ -0,0 +1,72 @@
+# usage.py - PER-REQUEST METER OF LLM TOKENS AND UPSTREAM CALLS
+"""
+What one chat turn cost us, counted where the cost is incurred:
+
+    with metering() as usage:
+        process_travel_turn(...)
+    usage.llm_tokens, usage.upstream_calls
+
+The agent records the tokens of every completion (AIMessage.usage_metadata),
+mcp_tools the tokens of its helper completions and every Amadeus /
+Booking.com request it makes. Outside metering() recording is a no-op.
+
+The meter lives in a ContextVar; LangGraph runs tools on threads with a
+copy of the caller's context, which still points at the same meter. Calls
+coalesced by singleflight are charged to the request that made them.
+"""
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+
+class Usage:
+    """LLM tokens and upstream calls of one request (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.llm_tokens = 0
+        self.upstream_calls = 0
+
+    def add(self, llm_tokens: int = 0, upstream_calls: int = 0):
+        with self._lock:
+            self.llm_tokens += llm_tokens
+            self.upstream_calls += upstream_calls
+
+    def as_dict(self) -> Dict[str, int]:
+        with self._lock:
+            return {"llm_tokens": self.llm_tokens, "upstream_calls": self.upstream_calls}
+
+
+_current: ContextVar[Optional[Usage]] = ContextVar("request_usage", default=None)
+
+
+@contextmanager
+def metering() -> Iterator[Usage]:
+    """Meter everything recorded inside the block"""
+    usage = Usage()
+    token = _current.set(usage)
+    try:
+        yield usage
+    finally:
+        _current.reset(token)
+
+
+def record_llm_tokens(usage_metadata: Any):
+    """Tokens of a completion: a LangChain usage_metadata dict or an OpenAI usage object"""
+    usage = _current.get()
+    if usage is None or not usage_metadata:
+        return
+    if isinstance(usage_metadata, dict):
+        total = usage_metadata.get("total_tokens", 0)
+    else:
+        total = getattr(usage_metadata, "total_tokens", 0)
+    usage.add(llm_tokens=int(total or 0))
+
+
+def record_upstream_call(n: int = 1):
+    """One (or n) requests to a paid provider API"""
+    usage = _current.get()
+    if usage is not None:
+        usage.add(upstream_calls=n)
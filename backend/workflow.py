@@ -1,7 +1,7 @@
 # workflow.py - FIXED INTELLIGENT WORKFLOW WITH PROPER LANGGRAPH
 import os
 import json
-from typing import Dict, Any, List, Optional, Literal
+from typing import Dict, Any, List, Optional, Literal, Tuple
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, SystemMessage, ToolMessage
 from langgraph.graph import StateGraph, END
@@ -14,11 +14,18 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Tool exchanges kept in conversation history (see serialize_tool_exchange)
+TOOL_HISTORY_TURNS = int(os.getenv("TOOL_HISTORY_TURNS", "3"))         # replay the last N turns' tool results
+TOOL_RESULT_MAX_ITEMS = int(os.getenv("TOOL_RESULT_MAX_ITEMS", "10"))  # per list in a stored result
+TOOL_RESULT_MAX_CHARS = int(os.getenv("TOOL_RESULT_MAX_CHARS", "6000"))
+
 # Import the real MCP tools
 try:
-    from backend.mcp_tools import get_real_mcp_tools
+    from backend.mcp_tools import get_real_mcp_tools, OPENAI_BASE_URL
+    from backend.usage import record_llm_tokens
 except ImportError:
-    from mcp_tools import get_real_mcp_tools
+    from mcp_tools import get_real_mcp_tools, OPENAI_BASE_URL
+    from usage import record_llm_tokens
 
 class AgentState(TypedDict):
     """State for the travel agent workflow"""
@@ -39,7 +46,8 @@ class IntelligentTravelAgent:
         self.llm = ChatOpenAI(
             model="gpt-4o-mini",
             temperature=0.3,
-            api_key=openai_api_key
+            api_key=openai_api_key,
+            base_url=OPENAI_BASE_URL
         )
         logger.info(f"🔍 Using model → {self.llm.model_name}")
 
@@ -59,6 +67,8 @@ CRITICAL RULES:
 3. For GENERAL chat - respond helpfully without tools
 4. NEVER loop unnecessarily - determine intent and act accordingly
 5. Extract information from natural language intelligently (no regex/hardcoding)
+6. Earlier tool calls and their results in this conversation are still valid - answer follow-up
+   questions about them from that data; only search again if the user changes the trip details
 
 WHEN TO USE TOOLS:
 - Flight searches: When user asks about flights, flying, airlines
@@ -112,6 +122,7 @@ Be conversational and helpful. Only use tools when actually needed for travel ta
         
         # Get LLM response
         response = self.llm_with_tools.invoke(messages)
+        record_llm_tokens(getattr(response, "usage_metadata", None))
         if hasattr(response, "tool_calls") and response.tool_calls:
             logger.info(f"🛠️  LLM requested tools: {response.tool_calls}")
         else:
@@ -141,45 +152,112 @@ Be conversational and helpful. Only use tools when actually needed for travel ta
         Process a user request
         Returns the final response string
         """
+        return self.process_turn(message, history)[0]
+
+    def process_turn(self, message: str, history: List[BaseMessage] = None) -> Tuple[str, List[BaseMessage]]:
+        """
+        Process a user request
+        Returns the final response string and the tool calls / tool results of this turn
+        """
         # Prepare messages
-        initial_messages = history or []
+        initial_messages = _trim_tool_history(history or [], TOOL_HISTORY_TURNS)
         initial_messages.append(HumanMessage(content=message))
-        
+
         # Run the workflow
         try:
             result = self.workflow.invoke(
                 {"messages": initial_messages},
                 config={"recursion_limit": 10}  # Reasonable limit
             )
-            
+
             # Extract the final AI response
             if result and "messages" in result:
+                new_messages = result["messages"][len(initial_messages):]
+                tool_exchange = [m for m in new_messages
+                                 if isinstance(m, ToolMessage) or (isinstance(m, AIMessage) and m.tool_calls)]
                 # Find the last AI message
                 for msg in reversed(result["messages"]):
                     if isinstance(msg, AIMessage):
-                        # Handle tool responses in content
-                        if isinstance(msg.content, str):
-                            return msg.content
-                        elif isinstance(msg.content, list):
-                            # Sometimes content is a list of text blocks
-                            text_parts = []
-                            for part in msg.content:
-                                if isinstance(part, dict) and 'text' in part:
-                                    text_parts.append(part['text'])
-                                elif isinstance(part, str):
-                                    text_parts.append(part)
-                            return " ".join(text_parts)
-                        else:
-                            return str(msg.content)
-            
-            return "I'm here to help with your travel needs! You can ask me to search for flights, hotels, or help plan your trip."
-            
+                        return _message_text(msg), tool_exchange
+
+            return "I'm here to help with your travel needs! You can ask me to search for flights, hotels, or help plan your trip.", []
+
         except Exception as e:
             if "recursion_limit" in str(e):
-                return "I apologize, but I'm having trouble processing that request. Could you please rephrase it more simply?"
+                return "I apologize, but I'm having trouble processing that request. Could you please rephrase it more simply?", []
             else:
                 raise e
 
+def _message_text(msg: AIMessage) -> str:
+    # Handle tool responses in content
+    if isinstance(msg.content, str):
+        return msg.content
+    elif isinstance(msg.content, list):
+        # Sometimes content is a list of text blocks
+        text_parts = []
+        for part in msg.content:
+            if isinstance(part, dict) and 'text' in part:
+                text_parts.append(part['text'])
+            elif isinstance(part, str):
+                text_parts.append(part)
+        return " ".join(text_parts)
+    else:
+        return str(msg.content)
+
+def _trim_tool_history(history: List[BaseMessage], keep_turns: int) -> List[BaseMessage]:
+    """Copy of history without tool calls/results older than the last keep_turns user turns"""
+    human_positions = [i for i, m in enumerate(history) if isinstance(m, HumanMessage)]
+    if len(human_positions) <= keep_turns:
+        return list(history)
+    cutoff = human_positions[-keep_turns] if keep_turns > 0 else len(history)
+    return [m for i, m in enumerate(history)
+            if i >= cutoff or not (isinstance(m, ToolMessage) or (isinstance(m, AIMessage) and m.tool_calls))]
+
+def _compact(value: Any) -> Any:
+    """Drop empty fields and cap list lengths of a tool result"""
+    if isinstance(value, dict):
+        return {k: _compact(v) for k, v in value.items() if v not in (None, "", [], {})}
+    if isinstance(value, list):
+        return [_compact(v) for v in value[:TOOL_RESULT_MAX_ITEMS]]
+    return value
+
+def _compact_tool_result(content: Any) -> str:
+    text = content if isinstance(content, str) else json.dumps(content, default=str)
+    try:
+        text = json.dumps(_compact(json.loads(text)), separators=(",", ":"), default=str)
+    except ValueError:
+        pass  # Plain-text result
+    if len(text) > TOOL_RESULT_MAX_CHARS:
+        text = text[:TOOL_RESULT_MAX_CHARS] + "…[truncated]"
+    return text
+
+def serialize_tool_exchange(messages: List[BaseMessage]) -> List[Dict[str, Any]]:
+    """Tool calls and compacted tool results of one turn, as JSON-able dicts for storage"""
+    stored = []
+    for msg in messages:
+        if isinstance(msg, ToolMessage):
+            stored.append({"type": "tool", "tool_call_id": msg.tool_call_id, "name": msg.name,
+                           "content": _compact_tool_result(msg.content)})
+        elif isinstance(msg, AIMessage) and msg.tool_calls:
+            stored.append({"type": "ai", "content": _message_text(msg),
+                           "tool_calls": [{"id": c["id"], "name": c["name"], "args": c["args"]}
+                                          for c in msg.tool_calls]})
+    return stored
+
+def deserialize_tool_exchange(stored: List[Dict[str, Any]]) -> List[BaseMessage]:
+    """Inverse of serialize_tool_exchange"""
+    messages = []
+    for item in stored:
+        if item.get("type") == "tool":
+            messages.append(ToolMessage(content=item["content"], tool_call_id=item["tool_call_id"],
+                                        name=item.get("name")))
+        elif item.get("type") == "ai":
+            messages.append(AIMessage(content=item.get("content", ""), tool_calls=[
+                {"id": c["id"], "name": c["name"], "args": c["args"], "type": "tool_call"}
+                for c in item.get("tool_calls", [])
+            ]))
+    return messages
+
 def build_travel_workflow(openai_api_key: str):
     """Build the intelligent travel workflow"""
     agent = IntelligentTravelAgent(openai_api_key)
@@ -190,37 +268,46 @@ def process_travel_request(message: str, openai_api_key: str, history: List = No
     Process travel request with intelligent workflow
     NO HARDCODING, proper LangGraph usage
     """
+    return process_travel_turn(message, openai_api_key, history)[0]
+
+def process_travel_turn(message: str, openai_api_key: str,
+                        history: List = None) -> Tuple[str, List[BaseMessage]]:
+    """
+    Like process_travel_request, but also returns the turn's tool calls and
+    tool results so they can be stored and replayed on follow-up turns
+    """
     if not openai_api_key:
-        return "OpenAI API key required for intelligent processing"
-    
+        return "OpenAI API key required for intelligent processing", []
+
     try:
         # Create the agent
         agent = IntelligentTravelAgent(openai_api_key)
-        
+
         # Process the request
-        response = agent.process_request(message, history)
-        
+        response, tool_exchange = agent.process_turn(message, history)
+
         # Ensure we have a valid response
         if not response or len(response.strip()) < 2:
             # Fallback for empty responses
             if any(greeting in message.lower() for greeting in ['hi', 'hello', 'hey']):
-                return "Hello! I'm your AI travel assistant. I can help you search for flights, find hotels, plan trips, and manage bookings. What would you like to do today?"
+                return "Hello! I'm your AI travel assistant. I can help you search for flights, find hotels, plan trips, and manage bookings. What would you like to do today?", tool_exchange
             else:
-                return "I'm here to help with your travel needs. You can ask me to search for flights, hotels, or help plan your trip."
-        
-        return response
-        
+                return "I'm here to help with your travel needs. You can ask me to search for flights, hotels, or help plan your trip.", tool_exchange
+
+        return response, tool_exchange
+
     except Exception as e:
         import logging
         logging.error(f"Error in travel request processing: {str(e)}")
-        
+
         # User-friendly error messages
         if "rate_limit" in str(e).lower():
-            return "I'm experiencing high demand right now. Please try again in a moment."
+            return "I'm experiencing high demand right now. Please try again in a moment.", []
         elif "api" in str(e).lower():
-            return "I'm having trouble connecting to travel services. Please check that all API keys are configured correctly."
+            return "I'm having trouble connecting to travel services. Please check that all API keys are configured correctly.", []
         else:
-            return f"I encountered an issue processing your request. Please try rephrasing or ask for something else. Error: {str(e)}"
+            return f"I encountered an issue processing your request. Please try rephrasing or ask for something else. Error: {str(e)}", []
 
 # Export main functions
-__all__ = ['build_travel_workflow', 'process_travel_request', 'IntelligentTravelAgent']
\ No newline at end of file
+__all__ = ['build_travel_workflow', 'process_travel_request', 'process_travel_turn',
+           'serialize_tool_exchange', 'deserialize_tool_exchange', 'IntelligentTravelAgent']
\ No newline at end of file
@@ -0,0 +1,176 @@
+# write_behind.py - BATCHED BACKGROUND WRITES FOR INTERACTIONS AND ANALYTICS
+"""
+Analytics rows should never cost a user-facing request a commit.
+
+Callers enqueue (sql, params) rows or small read-modify-write jobs; one
+background thread drains the bounded queue and writes everything that
+arrived within WRITE_BEHIND_FLUSH_MS (or WRITE_BEHIND_BATCH_ROWS items)
+in a single transaction, grouping identical statements into executemany.
+
+When the queue is full the "drop" policy discards the item and counts it;
+the "block" policy waits up to WRITE_BEHIND_BLOCK_TIMEOUT_MS for room
+(backpressure) before dropping. stop() drains everything on shutdown.
+"""
+
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Tuple
+
+try:
+    from backend.storage import transaction
+except ImportError:
+    from storage import transaction
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+WRITE_BEHIND_BATCH_ROWS = int(os.getenv("WRITE_BEHIND_BATCH_ROWS", "500"))
+WRITE_BEHIND_FLUSH_MS = int(os.getenv("WRITE_BEHIND_FLUSH_MS", "200"))
+WRITE_BEHIND_FULL_POLICY = os.getenv("WRITE_BEHIND_FULL_POLICY", "drop")    # drop, block
+WRITE_BEHIND_BLOCK_TIMEOUT_MS = int(os.getenv("WRITE_BEHIND_BLOCK_TIMEOUT_MS", "50"))
+
+_SQL = "sql"
+_CALL = "call"
+_STOP = object()
+
+
+class WriteBehindQueue:
+    """Bounded queue plus one writer thread that commits in batches"""
+
+    def __init__(self, max_queue: int = WRITE_BEHIND_MAX_QUEUE,
+                 batch_rows: int = WRITE_BEHIND_BATCH_ROWS,
+                 flush_ms: int = WRITE_BEHIND_FLUSH_MS,
+                 full_policy: str = WRITE_BEHIND_FULL_POLICY,
+                 block_timeout_ms: int = WRITE_BEHIND_BLOCK_TIMEOUT_MS):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._batch_rows = batch_rows
+        self._flush_sec = flush_ms / 1000.0
+        self._block = full_policy == "block"
+        self._block_timeout = block_timeout_ms / 1000.0
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+    # ── producer side ───────────────────────────────────────
+
+    def submit(self, sql: str, params: Tuple) -> bool:
+        """Queue one row for an INSERT/UPDATE statement"""
+        return self._put((_SQL, sql, params))
+
+    def submit_call(self, fn: Callable, *args: Any) -> bool:
+        """Queue a job that runs inside the writer's batch transaction"""
+        return self._put((_CALL, fn, args))
+
+    def _put(self, item) -> bool:
+        self._ensure_started()
+        try:
+            if self._block:
+                self._queue.put(item, timeout=self._block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            self._count("dropped")
+            return False
+        self._count("enqueued")
+        return True
+
+    # ── writer side ─────────────────────────────────────────
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def start(self) -> None:
+        self._ensure_started()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                first = self._queue.get(timeout=self._flush_sec)
+            except queue.Empty:
+                continue
+            batch = []
+            if first is _STOP:
+                stopping = True
+            else:
+                batch.append(first)
+            deadline = time.monotonic() + self._flush_sec
+            while not stopping and len(batch) < self._batch_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+            if stopping:
+                # Drain whatever is left without waiting
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not _STOP:
+                        batch.append(item)
+            self._write(batch)
+
+    def _write(self, batch: List[Tuple]):
+        statements: Dict[str, List[Tuple]] = {}
+        calls = []
+        for kind, target, params in batch:
+            if kind == _SQL:
+                statements.setdefault(target, []).append(params)
+            else:
+                calls.append((target, params))
+        try:
+            with transaction(immediate=True) as conn:
+                for sql, rows in statements.items():
+                    conn.executemany(sql, rows)
+                for fn, args in calls:
+                    fn(*args)
+        except Exception as e:
+            logger.error(f"Write-behind batch of {len(batch)} failed: {e}")
+            self._count("failed", len(batch))
+            return
+        self._count("written", len(batch))
+        self._count("batches")
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    # ── lifecycle ───────────────────────────────────────────
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush everything queued and stop the writer thread"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Write-behind queue full at shutdown; writer may not drain completely")
+        thread.join(timeout)
+        self._thread = None
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return dict(self._stats, queue_depth=self._queue.qsize())
+
+
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.stop)
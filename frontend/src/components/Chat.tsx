@@ -57,6 +57,28 @@ interface User {
   is_demo_user: boolean;
 }
 
+// Guest identity: the API issues a signed id in the X-Anonymous-Id header.
+// Requests are cross-origin without cookies, so keep it and send it back -
+// otherwise every message would start a new guest.
+const ANON_ID_HEADER = 'X-Anonymous-Id';
+const ANON_ID_KEY = 'anon_id';
+
+axios.interceptors.request.use((config) => {
+  const anonId = localStorage.getItem(ANON_ID_KEY);
+  if (anonId) {
+    config.headers.set(ANON_ID_HEADER, anonId);
+  }
+  return config;
+});
+
+axios.interceptors.response.use((response) => {
+  const anonId = response.headers[ANON_ID_HEADER.toLowerCase()];
+  if (anonId) {
+    localStorage.setItem(ANON_ID_KEY, anonId);
+  }
+  return response;
+});
+
 const Chat: React.FC = () => {
   // Authentication state - SIMPLIFIED
   const [user, setUser] = useState<User | null>(null);